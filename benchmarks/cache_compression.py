@@ -0,0 +1,96 @@
+'''
+Compares the size and decode time of a cached report value stored as plain
+JSON text and compressed with zlib (and zstd, if the "zstandard" package is
+installed), as set by the ckanext-report.cache_compression option.
+
+The data is shaped like the tagless-datasets report, at the given number of
+rows. It does not need CKAN or a database:
+
+    $ python benchmarks/cache_compression.py --rows 500000
+'''
+import argparse
+import datetime
+import json
+import random
+import string
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def tagless_report_data(num_rows):
+    random.seed(0)
+    created = datetime.datetime(2015, 1, 1)
+
+    def word(length=8):
+        return ''.join(random.choice(string.ascii_lowercase)
+                       for _ in range(length))
+
+    table = []
+    for i in range(num_rows):
+        name = '%s-%s-%s' % (word(), word(5), i)
+        table.append(OrderedDict((
+            ('name', name),
+            ('title', name.replace('-', ' ').title()),
+            ('notes', random.choice(('', 'Harvested', 'Unpublished'))),
+            ('user', 'user-%s' % random.randint(1, 200)),
+            ('created', (created + datetime.timedelta(minutes=i)).isoformat()),
+        )))
+    return {
+        'table': table,
+        'num_packages': num_rows * 5,
+        'packages_without_tags_percent': 20,
+        'average_tags_per_package': 3.5,
+    }
+
+
+def codecs():
+    yield 'none', lambda data: data, lambda data: data
+    yield 'zlib', zlib.compress, zlib.decompress
+    if zstandard is not None:
+        yield ('zstd', zstandard.ZstdCompressor().compress,
+               zstandard.ZstdDecompressor().decompress)
+
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def decode(decompress, data):
+    return json.loads(decompress(data).decode('utf8'),
+                      object_pairs_hook=OrderedDict)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    value = json.dumps(tagless_report_data(args.rows)).encode('utf8')
+    if zstandard is None:
+        print('(zstandard is not installed - skipping zstd)')
+    print('%d rows' % args.rows)
+    print('%-6s %14s %8s %12s %12s' % ('codec', 'bytes', 'ratio',
+                                       'encode (s)', 'decode (s)'))
+    for name, compress, decompress in codecs():
+        stored = compress(value)
+        encode_time = best_of(args.repeat, compress, value)
+        decode_time = best_of(args.repeat, decode, decompress, stored)
+        print('%-6s %14d %8.2f %12.3f %12.3f' % (
+            name, len(stored), float(len(value)) / len(stored),
+            encode_time, decode_time))
+
+
+if __name__ == '__main__':
+    main()
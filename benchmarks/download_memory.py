@@ -0,0 +1,82 @@
+'''
+Measures the peak memory (RSS) of serving a report as a CSV or JSON download,
+building the whole response (as ckanext-report used to) compared with
+streaming it (lib.iter_csv_from_dicts / lib.iter_json).
+
+The data is shaped like the tagless-datasets report, at the given number of
+rows. Each measurement runs in its own process, and reports how much the peak
+RSS grew beyond that of the decoded data itself. Run it in a CKAN virtualenv
+(ckanext.report.lib imports ckan):
+
+    $ python benchmarks/download_memory.py --rows 500000
+'''
+import argparse
+import json
+import multiprocessing
+import resource
+
+from cache_compression import tagless_report_data
+
+
+def build_csv(data):
+    from ckanext.report import lib
+    body = lib.make_csv_from_dicts(data['table'])
+    # the response copies the string into bytes
+    return len(body.encode('utf8'))
+
+
+def build_json(data):
+    body = json.dumps(data)
+    return len(body.encode('utf8'))
+
+
+def stream_csv(data):
+    from ckanext.report import lib
+    return sum(len(chunk.encode('utf8')) for chunk in
+               lib.join_chunks(lib.iter_csv_from_dicts(data['table'])))
+
+
+def stream_json(data):
+    from ckanext.report import lib
+    return sum(len(chunk.encode('utf8')) for chunk in
+               lib.join_chunks(lib.iter_json(data)))
+
+
+METHODS = [build_csv, stream_csv, build_json, stream_json]
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(method, num_rows, results):
+    data = tagless_report_data(num_rows)
+    # import before taking the baseline, so it is not counted
+    from ckanext.report import lib  # noqa: F401
+    baseline = peak_rss_kb()
+    size = method(data)
+    results.put((method.__name__, size, peak_rss_kb() - baseline, baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('%d rows' % args.rows)
+    print('%-12s %14s %16s %16s' % (
+        'method', 'response bytes', 'data RSS (MB)', 'extra peak (MB)'))
+    results = multiprocessing.Queue()
+    for method in METHODS:
+        process = multiprocessing.Process(target=measure,
+                                          args=(method, args.rows, results))
+        process.start()
+        name, size, extra_kb, baseline_kb = results.get()
+        process.join()
+        print('%-12s %14d %16.1f %16.1f' % (name, size, baseline_kb / 1024.0,
+                                            extra_kb / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
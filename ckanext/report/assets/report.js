@@ -4,5 +4,64 @@ $(document).ready(function()
             console.log('foo')
             $(this).closest("form").submit();
         });
+
+        // Organization option - suggests organizations as the user types
+        $(".js-organization-autocomplete").each(function () {
+            var widget = $(this);
+            var input = widget.find("input[type=text]");
+            var value = widget.find("input[type=hidden]");
+            var results = widget.find(".report-organization-results");
+            var timer = null;
+            var request = null;
+
+            function select(name, title) {
+                value.val(name);
+                input.val(title);
+                results.hide();
+                widget.closest("form").submit();
+            }
+
+            function show(organizations) {
+                results.empty();
+                $.each(organizations, function (i, org) {
+                    $("<a href='#'>").text(org.title).data("name", org.name)
+                        .appendTo($("<li>").appendTo(results));
+                });
+                results.toggle(organizations.length > 0);
+            }
+
+            function search() {
+                if (request) {
+                    request.abort();
+                }
+                request = $.getJSON(widget.data("source"), {q: input.val()}, show);
+            }
+
+            input.on("input focus", function () {
+                clearTimeout(timer);
+                timer = setTimeout(search, 200);
+            });
+            input.on("keydown", function (e) {
+                if (e.key === "Escape") {
+                    results.hide();
+                } else if (e.key === "Enter") {
+                    e.preventDefault();
+                    if (!input.val()) {
+                        // cleared - back to the index of all organizations
+                        select("", "");
+                    } else if (results.find("a").length) {
+                        var first = results.find("a").first();
+                        select(first.data("name"), first.text());
+                    }
+                }
+            });
+            results.on("mousedown", "a", function (e) {
+                e.preventDefault();
+                select($(this).data("name"), $(this).text());
+            });
+            input.on("blur", function () {
+                results.hide();
+            });
+        });
     }
 );
@@ -1,13 +1,18 @@
 # encoding: utf-8
+import gzip
 import six
 import json
-from flask import Blueprint, request, make_response
+from flask import Blueprint, Response, request, make_response
 
+import ckan.lib.helpers as h
 import ckan.plugins.toolkit as t
 from jinja2.exceptions import TemplateNotFound
 
-from ckanext.report.report_registry import Report
-from ckanext.report.lib import make_csv_from_dicts, ensure_data_is_dicts, anonymise_user_names
+from ckanext.report.report_registry import Report, ReportRegistry
+from ckanext.report.lib import (iter_csv_from_dicts, iter_json, join_chunks, ensure_data_is_dicts,
+                                anonymise_user_names, search_organizations, report_cache_validators,
+                                is_not_modified, http_cache_headers)
+from ckanext.report.helpers import organization_display_title, relative_url_for
 
 
 import logging
@@ -72,6 +77,16 @@ def view(report_name, organization=None, refresh=False):
         format = options.pop('format')
     else:
         format = None
+    page_number = options.pop('page', None)
+    # Filtering, searching and sorting the table rows
+    row_query = {}
+    for param in list(options):
+        if param in report['option_defaults']:
+            continue
+        if param in ('q', 'sort'):
+            row_query[param] = options.pop(param)
+        elif param.startswith('filter-'):
+            row_query.setdefault('filters', {})[param[len('filter-'):]] = options.pop(param)
     if 'organization' in report['option_defaults']:
         options['organization'] = organization
     options_html = {}
@@ -107,14 +122,23 @@ def view(report_name, organization=None, refresh=False):
 
     if refresh:
         try:
-            t.get_action('report_refresh')({}, {'id': report_name, 'options': options})
+            refresh_job = t.get_action('report_refresh')(
+                {}, {'id': report_name, 'options': options})['job_id']
         except t.NotAuthorized:
             t.abort(401)
-        # Don't want the refresh=1 in the url once it is done
+        # Don't want the refresh=1 in the url, but do want the job, to show
+        # its progress
         if organization:
-            t.redirect_to(t.url_for('report.org', report_name=report_name, organization=organization))
+            return t.redirect_to(t.url_for('report.org', report_name=report_name, organization=organization,
+                                           refresh_job=refresh_job))
         else:
-            t.redirect_to(t.url_for('report.view', report_name=report_name))
+            return t.redirect_to(t.url_for('report.view', report_name=report_name,
+                                           refresh_job=refresh_job))
+
+    # The progress of a refresh (the page reloads itself until it is done)
+    refresh_status = _refresh_status(options.pop('refresh_job', None))
+    if refresh_status and refresh_status['status'] in ('done', 'unknown'):
+        return t.redirect_to(relative_url_for(refresh_job=None))
 
     # Check for any options not allowed by the report
     for key in options:
@@ -122,49 +146,175 @@ def view(report_name, organization=None, refresh=False):
             t.abort(400, 'Option not allowed by report: %s' % key)
 
     try:
-        data, report_date = t.get_action('report_data_get')({}, {'id': report_name, 'options': options})
+        key = t.get_action('report_key_get')({}, {'id': report_name, 'options': options})
+    except t.NotAuthorized:
+        t.abort(401)
+
+    response = _cached_response(report_name, format, options, key)
+    if response is not None:
+        return response
+
+    # Show a page of the table, for reports with a page_size, and the rows
+    # that match the query, if any
+    data_dict = {'id': report_name, 'options': options}
+    page_size = report.get('page_size')
+    if format in (None, 'html'):
+        data_dict.update(row_query)
+        if page_size:
+            try:
+                page_number = max(int(page_number or 1), 1)
+            except ValueError:
+                t.abort(400, 'Bad page number')
+            data_dict.update(offset=(page_number - 1) * page_size, limit=page_size)
+
+    try:
+        data, report_date = t.get_action('report_data_get')({}, data_dict)
     except t.ObjectNotFound:
         t.abort(404)
     except t.NotAuthorized:
         t.abort(401)
+    except t.ValidationError as e:
+        t.abort(400, str(e.error_summary))
+    # The validators, and the date shown, only change when the data does,
+    # not when it is checked
+    created = ReportRegistry.instance().get_report(report_name) \
+        .get_created_date(options)
+    created = created.isoformat() if created else report_date
+    cache_headers = http_cache_headers(*report_cache_validators(key, created, format, c.user),
+                                       user=c.user)
 
     if format and format != 'html':
         ensure_data_is_dicts(data)
         anonymise_user_names(data, organization=options.get('organization'))
         if format == 'csv':
-            try:
-                key = t.get_action('report_key_get')({}, {'id': report_name, 'options': options})
-            except t.NotAuthorized:
-                t.abort(401)
             filename = 'report_%s.csv' % key
-            response = make_response(make_csv_from_dicts(data['table']))
+            # Stream it, rather than holding the whole file in memory
+            response = Response(join_chunks(iter_csv_from_dicts(data['table'])))
             response.headers['Content-Type'] = 'application/csv'
             response.headers['Content-Disposition'] = six.text_type('attachment; filename=%s' % (filename))
+            response.headers.update(cache_headers)
             return response
         elif format == 'json':
-            data['generated_at'] = report_date
-            response = make_response(json.dumps(data))
+            data['generated_at'] = created
+            response = Response(join_chunks(iter_json(data)))
             response.headers['Content-Type'] = 'application/json'
+            response.headers.update(cache_headers)
             return response
         else:
             t.abort(400, 'Format not known - try html, json or csv')
 
     are_some_results = bool(data['table'] if 'table' in data
                             else data)
+    page = None
+    if 'limit' in data_dict and 'table' in data:
+        are_some_results = bool(data['total_rows'])
+        page = h.Page(collection=data['table'], page=page_number,
+                      url=_pager_url, item_count=data['total_rows'],
+                      items_per_page=page_size, presliced_list=True)
     # A couple of context variables for legacy genshi reports
     c.data = data
     c.options = options
 
-    return t.render('report/view.html', extra_vars={
+    response = make_response(t.render('report/view.html', extra_vars={
         'report': report, 'report_name': report_name, 'data': data,
-        'report_date': report_date, 'options': options,
+        'report_date': created, 'options': options,
         'options_html': options_html,
         'report_template': report['template'],
         'are_some_results': are_some_results,
-        'organization': organization})
+        'page': page, 'row_query': row_query,
+        'clear_row_query_url': relative_url_for(
+            q=None, sort=None, page=None,
+            **{'filter-' + column: None for column in row_query.get('filters', {})}),
+        'organization': organization,
+        'refresh_status': refresh_status}))
+    response.headers.update(cache_headers)
+    return response
+
+
+def _refresh_status(refresh_job):
+    '''Returns the report_refresh_status of the given refresh job, or None if
+    there is none to show.'''
+    if not refresh_job:
+        return None
+    try:
+        return t.get_action('report_refresh_status')({}, {'job_id': refresh_job})
+    except (t.NotAuthorized, t.ObjectNotFound):
+        # e.g. the url was passed on to someone else - just show the report
+        return None
+
+
+def _pager_url(q=None, page=None):
+    return relative_url_for(page=page)
+
+
+def _cached_response(report_name, format, options, key):
+    '''Returns a response for the cached report without loading its data, if
+    it is fresh and the client already has it (a 304), or it is a download
+    made when the report was generated. Otherwise None.'''
+    if format not in (None, 'html', 'csv', 'json'):
+        return None
+    try:
+        t.check_access('report_data_get', {}, {'id': report_name, 'options': options})
+    except t.NotAuthorized:
+        t.abort(401)
+    report_obj = ReportRegistry.instance().get_report(report_name)
+    report_date = report_obj.get_fresh_cached_date(options)
+    if report_date is None:
+        return None
+    etag, last_modified = report_cache_validators(key, report_date, format, c.user)
+    if is_not_modified(request.environ, etag, last_modified):
+        response = make_response('', 304)
+    elif format in ('csv', 'json'):
+        response = _download_artifact_response(report_obj, format, options, key)
+        if response is None:
+            return None
+    else:
+        return None
+    response.headers.update(http_cache_headers(etag, last_modified, user=c.user))
+    return response
+
+
+def _download_artifact_response(report_obj, format, options, key):
+    '''Returns a response with the download made when the report was
+    generated, if there is one, otherwise None.'''
+    accept_gzip = 'gzip' in request.accept_encodings
+    content, gzipped = report_obj.get_download_artifact(format, accept_gzip, **options)
+    if content is None:
+        return None
+    response = make_response(content if accept_gzip or not gzipped
+                             else gzip.decompress(content))
+    if gzipped and accept_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if format == 'csv':
+        response.headers['Content-Type'] = 'application/csv'
+        response.headers['Content-Disposition'] = six.text_type('attachment; filename=report_%s.csv' % key)
+    else:
+        response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def organization_autocomplete():
+    '''Returns JSON list of the organizations (with datasets) that match the
+    'q' parameter, for the organization option of reports.'''
+    try:
+        t.check_access('report_list', {})
+    except t.NotAuthorized:
+        t.abort(401)
+    try:
+        limit = min(t.asint(t.request.args.get('limit', 10)), 100)
+    except ValueError:
+        t.abort(400, 'Bad limit')
+    organizations = search_organizations(t.request.args.get('q', ''), limit)
+    response = make_response(json.dumps([
+        {'name': org['name'], 'title': organization_display_title(org)}
+        for org in organizations]))
+    response.headers['Content-Type'] = 'application/json'
+    return response
 
 
 report.add_url_rule(u'/report', view_func=index)
+report.add_url_rule(u'/report/organization_autocomplete', view_func=organization_autocomplete)
 report.add_url_rule(u'/reports', 'reports', view_func=redirect_to_index)
 report.add_url_rule(u'/report/<report_name>', view_func=view, methods=['GET', 'POST'])
 report.add_url_rule(u'/report/<report_name>/<organization>', 'org',  view_func=view, methods=['GET', 'POST'])
@@ -0,0 +1,232 @@
+# encoding: utf-8
+'''
+Where DataCache keeps its values.
+
+The data_cache table always has a record for each cached value, with its
+object_id, key, created date etc, but the value itself is stored by a
+backend, chosen with the config option ckanext-report.cache_backend:
+
+* "sql" (the default) - in the data_cache record itself
+* "filesystem" - in files, in the directory given by
+  ckanext-report.cache_directory, which are read through memory-mapping
+* "some.module:SomeClass" - your own subclass of CacheBackend
+
+The backend that stored a value is recorded with it (in data_cache.storage),
+so values can still be read after the option is changed.
+'''
+import hashlib
+import importlib
+import logging
+import mmap
+import os
+import tempfile
+
+import six
+
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+# Versions of each value's file kept by the filesystem backend, so that
+# readers that looked up the previous version just before it was replaced can
+# still read it. (The version the data_cache record refers to is kept too.)
+FILESYSTEM_VERSIONS_KEPT = 2
+
+
+class CacheBackend(object):
+    '''Stores the values of DataCache records.'''
+
+    # Recorded in data_cache.storage for the values it stores (a backend
+    # configured as "module:Class" is given that as its name)
+    name = None
+
+    def store(self, object_id, key, created, value):
+        '''Stores the value (a string, or None) of the record written at the
+        given created date. Returns the values of the data_cache columns
+        'value', 'value_compressed', 'compression' and 'storage' (self.name)
+        for the record.'''
+        raise NotImplementedError
+
+    def load(self, object_id, key, item):
+        '''Returns the value (a string) of a record, given its data_cache
+        columns (item.value, item.value_compressed, item.compression,
+        item.created). Returns None if it cannot be found.'''
+        raise NotImplementedError
+
+    def is_current(self, object_id, key, item):
+        '''Returns whether a record (given its data_cache columns) is stored
+        as this backend would store it now and can still be loaded. If not, it
+        is written again even though its value is unchanged.'''
+        return item.storage == self.name
+
+
+class SqlBackend(CacheBackend):
+    '''Stores values in the data_cache table, compressed if
+    ckanext-report.cache_compression is set.'''
+
+    def store(self, object_id, key, created, value):
+        from ckanext.report.model import compress_value, compression_configured
+        compression = compression_configured()
+        if compression and value is not None:
+            return {'value': None,
+                    'value_compressed': compress_value(value, compression),
+                    'compression': compression,
+                    'storage': None}
+        return {'value': value, 'value_compressed': None, 'compression': None,
+                'storage': None}
+
+    def load(self, object_id, key, item):
+        from ckanext.report.model import decompress_value
+        if item.compression:
+            return decompress_value(item.value_compressed, item.compression)
+        return item.value
+
+    def is_current(self, object_id, key, item):
+        from ckanext.report.model import compression_configured
+        return item.storage == self.name and \
+            item.compression == compression_configured()
+
+
+class FilesystemBackend(CacheBackend):
+    '''Stores each value in a file, compressed if
+    ckanext-report.cache_compression is set. Files are written to a temporary
+    name and renamed into place, so readers never see one half-written. They
+    are read through memory-mapping, so processes on the same host share them
+    in the OS page cache.
+
+    A file is written before the transaction that records it in data_cache
+    commits, so if that fails, the record still refers to the previous
+    version - which is therefore never removed while it does.'''
+
+    name = 'filesystem'
+
+    @property
+    def directory(self):
+        directory = config.get('ckanext-report.cache_directory')
+        if not directory and config.get('ckan.storage_path'):
+            directory = os.path.join(config['ckan.storage_path'], 'report_cache')
+        if not directory:
+            raise ValueError('The filesystem cache backend needs '
+                             'ckanext-report.cache_directory to be set')
+        return directory
+
+    def store(self, object_id, key, created, value):
+        from ckanext.report.model import compress_value, compression_configured
+        if value is None:
+            return {'value': None, 'value_compressed': None,
+                    'compression': None, 'storage': None}
+        compression = compression_configured()
+        data = compress_value(value, compression) if compression \
+            else six.text_type(value).encode('utf8')
+        _write_atomically(self._path(object_id, key, created), data)
+        self._remove_old_versions(object_id, key)
+        return {'value': None, 'value_compressed': None,
+                'compression': compression, 'storage': self.name}
+
+    def load(self, object_id, key, item):
+        from ckanext.report.model import decompress_value
+        path = self._path(object_id, key, item.created)
+        try:
+            with open(path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return u''
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            log.warning('Cache file missing: %s/%s %s', object_id, key, path)
+            return None
+        try:
+            if item.compression:
+                return decompress_value(data, item.compression)
+            return six.text_type(data, 'utf8')
+        finally:
+            data.close()
+
+    def is_current(self, object_id, key, item):
+        from ckanext.report.model import compression_configured
+        return item.storage == self.name and \
+            item.compression == compression_configured() and \
+            os.path.exists(self._path(object_id, key, item.created))
+
+    def _base_path(self, object_id, key):
+        digest = hashlib.sha1(u'{}\0{}'.format(object_id or u'', key)
+                              .encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _path(self, object_id, key, created):
+        return '%s-%s.value' % (self._base_path(object_id, key),
+                                created.strftime('%Y%m%dT%H%M%S%f'))
+
+    def _remove_old_versions(self, object_id, key):
+        '''Removes the files of the value apart from the latest versions and
+        the one that its data_cache record refers to (as committed, since the
+        record is not yet updated for the version just written).'''
+        from ckanext.report.model import DataCache
+        base_path = self._base_path(object_id, key)
+        prefix = os.path.basename(base_path) + '-'
+        directory = os.path.dirname(base_path)
+        versions = sorted(name for name in os.listdir(directory)
+                          if name.startswith(prefix) and name.endswith('.value'))
+        old_versions = versions[:-FILESYSTEM_VERSIONS_KEPT]
+        metadata = DataCache.get_metadata([(object_id, key)])[0] \
+            if old_versions else None
+        if metadata is not None:
+            recorded = os.path.basename(self._path(object_id, key, metadata.created))
+            old_versions = [name for name in old_versions if name != recorded]
+        for name in old_versions:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass  # e.g. another process removed it
+
+
+def _write_atomically(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+BUILT_IN_BACKENDS = {
+    'sql': SqlBackend,
+    'filesystem': FilesystemBackend,
+}
+
+_backends = {}
+
+
+def get_backend(storage=None):
+    '''Returns the backend that stored a value, given the value of its
+    data_cache.storage column (None for the data_cache table itself).'''
+    storage = storage or 'sql'
+    if storage not in _backends:
+        if storage in BUILT_IN_BACKENDS:
+            backend_class = BUILT_IN_BACKENDS[storage]
+        else:
+            module_name, _, class_name = storage.partition(':')
+            try:
+                backend_class = getattr(importlib.import_module(module_name), class_name)
+            except (ImportError, AttributeError, ValueError):
+                raise ValueError('Unknown cache backend: %r' % storage)
+        backend = backend_class()
+        if storage not in BUILT_IN_BACKENDS:
+            # record values it stores as stored by it
+            backend.name = storage
+        _backends[storage] = backend
+    return _backends[storage]
+
+
+def configured_backend():
+    '''Returns the backend to store new values with, according to the config
+    option ckanext-report.cache_backend.'''
+    return get_backend(config.get('ckanext-report.cache_backend') or 'sql')
@@ -24,18 +24,84 @@ def initdb():
 
 @report.command()
 @click.argument(u'report_list', required=False)
-def generate(report_list):
+@click.option(u'--workers', u'-w', default=1, type=int,
+              help=u'Number of processes to generate the option combinations in')
+@click.option(u'--batch-size', u'-b', default=1, type=int,
+              help=u'Number of option combinations to write to the cache '
+              u'in each transaction')
+@click.option(u'--batch-mb', default=None, type=float,
+              help=u'Write a batch early once its data reaches this many '
+              u'megabytes')
+@click.option(u'--atomic', is_flag=True,
+              help=u'Commit all of a report\'s option combinations together')
+@click.option(u'--resume', is_flag=True,
+              help=u'Carry on from where the last run of the same reports '
+              u'got to, if it was interrupted')
+def generate(report_list, workers, batch_size, batch_mb, atomic, resume):
     """
     Generate and cache reports - all of them unless you specify
     a comma separated list of them.
     """
+    if atomic and workers > 1:
+        raise click.UsageError(u'--atomic cannot be used with --workers')
     if report_list:
         report_list = [s.strip() for s in report_list.split(',')]
-    timings = utils.generate(report_list)
+    timings = utils.generate(report_list, workers=workers,
+                             batch_size=batch_size, batch_megabytes=batch_mb,
+                             atomic=atomic, resume=resume)
 
     click.secho(u'Report generation complete %s' % timings, fg=u"green")
 
 
+@report.command()
+@click.option(u'--interval', u'-i', default=60, type=int,
+              help=u'Seconds between checks for reports that are due')
+@click.option(u'--once', is_flag=True,
+              help=u'Generate the reports that are due and then exit')
+@click.option(u'--workers', u'-w', default=1, type=int,
+              help=u'Number of processes to generate the option combinations in')
+@click.option(u'--enqueue', is_flag=True,
+              help=u'Queue the option combinations that are due for '
+              u'"report worker" processes, instead of generating them')
+def scheduler(interval, once, workers, enqueue):
+    """
+    Keeps the report caches up to date, by regenerating each option
+    combination when it is older than the report's schedule.
+    """
+    utils.scheduler(interval, once=once, workers=workers, enqueue=enqueue)
+
+
+@report.command()
+@click.argument(u'report_list', required=False)
+def enqueue(report_list):
+    """
+    Queue the option combinations of reports - all of them unless you
+    specify a comma separated list of them - for "report worker" processes
+    to generate.
+    """
+    if report_list:
+        report_list = [s.strip() for s in report_list.split(',')]
+    num_queued = utils.enqueue(report_list)
+    click.secho(u'Queued %s report option combinations' % num_queued,
+                fg=u"green")
+
+
+@report.command()
+@click.option(u'--once', is_flag=True,
+              help=u'Exit once the queue is empty')
+@click.option(u'--poll-interval', u'-i', default=10, type=int,
+              help=u'Seconds between checks of the queue, when it is empty')
+@click.option(u'--claim', u'-c', default=1, type=int,
+              help=u'Number of option combinations to claim at a time')
+def worker(once, poll_interval, claim):
+    """
+    Generates the report option combinations that are queued (by "report
+    enqueue" or "report scheduler --enqueue"). Run any number of these, on
+    any hosts that share the database.
+    """
+    utils.worker(once=once, poll_interval=poll_interval, claim=claim)
+
+
 @report.command()
 def list():
     """ Lists the reports
@@ -3,9 +3,10 @@ from builtins import str
 from ckan.lib.helpers import json
 import ckan.plugins.toolkit as t
 import ckanext.report.helpers as helpers
-from ckanext.report.report_registry import Report
+from ckanext.report.report_registry import Report, ReportRegistry
 from jinja2.exceptions import TemplateNotFound
-from ckanext.report.lib import make_csv_from_dicts, ensure_data_is_dicts, anonymise_user_names
+from ckanext.report.lib import (make_csv_from_dicts, ensure_data_is_dicts, anonymise_user_names,
+                                report_cache_validators, is_not_modified, http_cache_headers)
 
 log = __import__('logging').getLogger(__name__)
 
@@ -85,39 +86,74 @@ class ReportController(t.BaseController):
 
         if refresh:
             try:
-                t.get_action('report_refresh')({}, {'id': report_name, 'options': options})
+                refresh_job = t.get_action('report_refresh')(
+                    {}, {'id': report_name, 'options': options})['job_id']
             except t.NotAuthorized:
                 t.abort(401)
-            # Don't want the refresh=1 in the url once it is done
-            t.redirect_to(helpers.relative_url_for(refresh=None))
+            # Don't want the refresh=1 in the url, but do want the job, to
+            # show its progress
+            t.redirect_to(helpers.relative_url_for(refresh=None, refresh_job=refresh_job))
+
+        # The progress of a refresh (the page reloads itself until it is done)
+        refresh_status = None
+        refresh_job = options.pop('refresh_job', None)
+        if refresh_job:
+            try:
+                refresh_status = t.get_action('report_refresh_status')({}, {'job_id': refresh_job})
+            except (t.NotAuthorized, t.ObjectNotFound):
+                # e.g. the url was passed on to someone else - just show it
+                pass
+            if refresh_status and refresh_status['status'] in ('done', 'unknown'):
+                t.redirect_to(helpers.relative_url_for(refresh_job=None))
 
         # Check for any options not allowed by the report
         for key in options:
             if key not in report['option_defaults']:
                 t.abort(400, 'Option not allowed by report: %s' % key)
 
+        try:
+            key = t.get_action('report_key_get')({}, {'id': report_name, 'options': options})
+            t.check_access('report_data_get', {}, {'id': report_name, 'options': options})
+        except t.NotAuthorized:
+            t.abort(401)
+
+        # Reply 304 if the client already has the (fresh) cached report,
+        # without loading it
+        if format in (None, 'html', 'csv', 'json'):
+            cached_date = ReportRegistry.instance().get_report(report_name) \
+                .get_fresh_cached_date(options)
+            if cached_date is not None:
+                etag, last_modified = report_cache_validators(key, cached_date, format, c.user)
+                if is_not_modified(t.request.environ, etag, last_modified):
+                    t.response.headers.update(http_cache_headers(etag, last_modified, user=c.user))
+                    t.response.status_int = 304
+                    return ''
+
         try:
             data, report_date = t.get_action('report_data_get')({}, {'id': report_name, 'options': options})
         except t.ObjectNotFound:
             t.abort(404)
         except t.NotAuthorized:
             t.abort(401)
+        # The validators, and the date shown, only change when the data does,
+        # not when it is checked
+        created = ReportRegistry.instance().get_report(report_name) \
+            .get_created_date(options)
+        created = created.isoformat() if created else report_date
+        t.response.headers.update(http_cache_headers(
+            *report_cache_validators(key, created, format, c.user), user=c.user))
 
         if format and format != 'html':
             ensure_data_is_dicts(data)
             anonymise_user_names(data, organization=options.get('organization'))
             if format == 'csv':
-                try:
-                    key = t.get_action('report_key_get')({}, {'id': report_name, 'options': options})
-                except t.NotAuthorized:
-                    t.abort(401)
                 filename = 'report_%s.csv' % key
                 t.response.headers['Content-Type'] = 'application/csv'
                 t.response.headers['Content-Disposition'] = str('attachment; filename=%s' % (filename))
                 return make_csv_from_dicts(data['table'])
             elif format == 'json':
                 t.response.headers['Content-Type'] = 'application/json'
-                data['generated_at'] = report_date
+                data['generated_at'] = created
                 return json.dumps(data)
             else:
                 t.abort(400, 'Format not known - try html, json or csv')
@@ -129,8 +165,9 @@ class ReportController(t.BaseController):
         c.options = options
         return t.render('report/view.html', extra_vars={
             'report': report, 'report_name': report_name, 'data': data,
-            'report_date': report_date, 'options': options,
+            'report_date': created, 'options': options,
             'options_html': options_html,
             'report_template': report['template'],
             'are_some_results': are_some_results,
-            'organization': organization})
+            'organization': organization,
+            'refresh_status': refresh_status})
@@ -4,7 +4,7 @@ from six.moves import range
 from flask import request
 from ckan.plugins import toolkit as tk
 from ckan.lib import helpers as h
-from ckanext.report.lib import get_all_organizations
+from ckanext.report.lib import get_all_organizations, get_organization_index
 from ckanext.report.report_registry import ReportRegistry
 
 log = __import__('logging').getLogger(__name__)
@@ -55,6 +55,23 @@ def organization_list(only_orgs_with_packages=False):
     return get_all_organizations(only_orgs_with_packages)
 
 
+def organization_display_title(org):
+    '''Returns the title to display for an organization dict from
+    organization_list, in the current language if it is translated.'''
+    if isinstance(org.get('title_translated'), dict):
+        title = h.get_translated(org, 'title')
+        if title:
+            return title
+    return org.get('title') or org.get('name')
+
+
+def organization_title(name):
+    '''Returns the title to display for the organization with the given name,
+    or the name if it is not found.'''
+    org = get_organization_index().get(name)
+    return organization_display_title(org) if org else name
+
+
 def render_datetime(datetime_, date_format=None, with_hours=False):
     '''Render a datetime object or timestamp string as a pretty string
     (Y-m-d H:m).
@@ -28,8 +28,47 @@ class IReport(p.Interface):
                           # values that covers all the combinations (assuming
                           # you want to pre-cache these combinations. If there
                           # are no options, just use None.
-            'generate': feedback_report
+            'generate': feedback_report,
                           # The report function. Should return the data as a
-                          # JSON-ifyable object.
+                          # JSON-ifyable object. Or for a big table, it can be
+                          # a generator yielding the table rows (dicts) one by
+                          # one, and the other values as lib.ReportFields, so
+                          # that the rows are cached without all being held in
+                          # memory.
+            'max_age': datetime.timedelta(hours=1),
+                          # (optional) How old the cached data can be before it
+                          # is regenerated when viewed. A timedelta or number of
+                          # seconds. Defaults to 2 days.
+            'schedule': datetime.timedelta(minutes=30),
+                          # (optional) How often "ckan report scheduler"
+                          # regenerates each option combination. A timedelta or
+                          # number of seconds. Defaults to the max_age.
+            'invalidate_on_change': True,
+                          # (optional) Whether changes to a dataset or
+                          # organization mark the cached data of that
+                          # organization (and those above it) as dirty, for the
+                          # scheduler to regenerate. Defaults to False.
+            'download_artifacts': ('csv', 'json.gz'),
+                          # (optional) The downloads to make when the report
+                          # is generated, served as they are while the cached
+                          # data is fresh. Any of 'csv', 'json', 'csv.gz' and
+                          # 'json.gz'. Defaults to none.
+            'timeout': datetime.timedelta(minutes=30),
+                          # (optional) How long generating one option
+                          # combination can take before it is killed (in a
+                          # subprocess) and counted as failed. A timedelta or
+                          # number of seconds. Defaults to the config option
+                          # ckanext-report.generate_timeout, if set.
+            'memory_limit': 4096,
+                          # (optional) The memory (in megabytes) that
+                          # generating one option combination can use, beyond
+                          # what the generating process already uses, before
+                          # it fails. Defaults to the config option
+                          # ckanext-report.generate_memory_limit, if set.
+            'page_size': 100,
+                          # (optional) Show the table this many rows per page,
+                          # with its rows also cached individually, so a page
+                          # can be read without loading the whole table.
+                          # Defaults to None (all rows on one page).
         }
         """
@@ -0,0 +1,142 @@
+# encoding: utf-8
+'''
+Regenerating reports in the background, with CKAN's background jobs.
+
+Set ckanext-report.job_queue = sync to run the "background" jobs immediately
+in the calling process instead, e.g. for tests.
+'''
+import hashlib
+import logging
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+# the refresh status shown for each rq job status
+REFRESH_STATUSES = {
+    'queued': 'queued',
+    'deferred': 'queued',
+    'scheduled': 'queued',
+    'started': 'running',
+    'finished': 'done',
+    'failed': 'failed',
+    'stopped': 'failed',
+    'canceled': 'failed',
+}
+REFRESH_JOB_ID_PREFIX = 'report-refresh-'
+
+# Seconds that a refresh job may run for, if the report has no timeout (see
+# Report.get_generation_limits), and that it claims its cache key for, in
+# Redis, so that no other is queued for it meanwhile. The job releases the
+# claim when it finishes, so this is only reached if its worker dies.
+REFRESH_CLAIM_TIMEOUT = 3600
+# Seconds added to a report's timeout for the job's, so that the generation
+# is stopped by its own timeout rather than the job being killed
+REFRESH_JOB_TIMEOUT_MARGIN = 60
+
+
+def enqueue_refresh(report, option_dict):
+    '''Queues a job to regenerate the report for the given options, unless one
+    is already queued or running. Returns the job id.
+
+    The job id is the same for every refresh of the cache key, and is claimed
+    in Redis (SET NX) before the job is queued, so concurrent requests can't
+    both queue one. The job releases its claim just before rq records it as
+    finished, so a job that still has an unfinished status is not queued
+    again either.
+
+    The job is given the report's timeout (plus REFRESH_JOB_TIMEOUT_MARGIN),
+    or else REFRESH_CLAIM_TIMEOUT, rather than ckan.jobs.timeout.'''
+    job_id = refresh_job_id(report, option_dict)
+    if config.get('ckanext-report.job_queue') == 'sync':
+        refresh_report(report.name, option_dict)
+        return job_id
+
+    timeout = report.get_generation_limits()[0]
+    job_timeout = int(timeout) + REFRESH_JOB_TIMEOUT_MARGIN if timeout \
+        else REFRESH_CLAIM_TIMEOUT
+    redis = _connect_to_redis()
+    if not redis.set(_claim_key(job_id), job_id, nx=True, ex=job_timeout):
+        log.debug('Report refresh already queued: %s', job_id)
+        return job_id
+    job = get_job(job_id)
+    if job is not None and \
+            REFRESH_STATUSES.get(job.get_status()) in ('queued', 'running'):
+        # it has released its claim, but rq has not recorded it finished yet
+        redis.delete(_claim_key(job_id))
+        log.debug('Report refresh still running: %s', job_id)
+        return job_id
+    try:
+        toolkit.enqueue_job(refresh_report, [report.name, option_dict, job_id],
+                            title='Refresh report %s' % report.generate_key(option_dict),
+                            rq_kwargs={'job_id': job_id, 'timeout': job_timeout})
+    except Exception:
+        redis.delete(_claim_key(job_id))
+        raise
+    log.info('Report refresh queued: %s', job_id)
+    return job_id
+
+
+def refresh_job_id(report, option_dict):
+    '''Returns the id of the job that refreshes a report's cache key, so that
+    requests for the same key share one job.'''
+    key = report.generate_key(option_dict)
+    return REFRESH_JOB_ID_PREFIX + hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def refresh_status(job_id):
+    '''Returns the status of a refresh job: queued, running, done or failed,
+    and the error if it failed - or unknown, if there is no such job.
+
+    rq deletes a finished job after its result_ttl (500 seconds by default),
+    after which it is unknown too, as is any job with
+    ckanext-report.job_queue = sync (they are done before enqueue_refresh
+    returns).
+
+    Returns (status, error)
+    '''
+    if config.get('ckanext-report.job_queue') == 'sync':
+        return 'unknown', None
+    job = get_job(job_id)
+    if job is None:
+        # it may be just about to be queued
+        if _connect_to_redis().exists(_claim_key(job_id)):
+            return 'queued', None
+        return 'unknown', None
+    status = REFRESH_STATUSES.get(job.get_status(), 'queued')
+    error = None
+    if status == 'failed' and job.exc_info:
+        # the last line of the traceback is the exception
+        error = job.exc_info.strip().splitlines()[-1]
+    return status, error
+
+
+def get_job(job_id):
+    '''Returns the rq job with the given id, or None.'''
+    from ckan.lib import jobs
+    try:
+        return jobs.job_from_id(job_id)
+    except KeyError:
+        return None
+
+
+def refresh_report(report_name, option_dict, job_id=None):
+    '''The background job: regenerates the report for the given options, and
+    then releases the job's claim on the cache key.'''
+    from ckanext.report.report_registry import ReportRegistry
+    try:
+        report = ReportRegistry.instance().get_report(report_name)
+        report.refresh_cache_once(option_dict)
+    finally:
+        if job_id and config.get('ckanext-report.job_queue') != 'sync':
+            _connect_to_redis().delete(_claim_key(job_id))
+
+
+def _claim_key(job_id):
+    return 'ckanext-report:claim:%s' % job_id
+
+
+def _connect_to_redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
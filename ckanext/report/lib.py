@@ -1,9 +1,14 @@
 '''
 These functions are for use by other extensions for their reports.
 '''
+import contextlib
+import heapq
+import json
+import time
+from collections import defaultdict
 from datetime import datetime
 import six
-from six.moves import cStringIO as StringIO, zip
+from six.moves import zip
 try:
     from collections import OrderedDict  # from python 2.7
 except ImportError:
@@ -12,14 +17,18 @@ except ImportError:
 import ckan.plugins as p
 from ckan.plugins.toolkit import config
 from ckan import model
-from typing import Generator, Union, Dict, TypedDict, Optional
-from sqlalchemy import func
+from typing import Generator, Union, Dict, List, TypedDict, Optional
+from sqlalchemy import and_, func, select
 
 Organization = TypedDict('Organization', {'id': str,
                                           'name': str,
                                           'title': str,
                                           'title_translated': Optional[Dict[str, str]]})
 
+# Default for ckanext-report.organization_cache_ttl - how long (in seconds) the
+# list of organizations is cached in each process
+ORGANIZATION_CACHE_TTL = 300
+
 
 def all_organizations(include_none=False) -> Generator[Union[str, None], None, None]:
     '''Yields all the organization names, and also None if requested. Useful
@@ -34,28 +43,129 @@ def all_organizations(include_none=False) -> Generator[Union[str, None], None, N
 
 
 def get_all_organizations(only_orgs_with_packages=False) -> Generator[Organization, None, None]:
-    organizations = model.Session.query(model.Group.id, model.Group.name, model.Group.title,
-                                        func.count(model.Package.id).label('package_count')).\
+    '''Yields all the active organizations, ordered by title. The list is
+    cached in this process (see clear_organization_cache).'''
+    for org, package_count in _get_organizations_with_package_counts():
+        if only_orgs_with_packages and not package_count:
+            continue
+        yield dict(org)
+
+
+_organization_cache = None  # (time loaded, [(Organization, package_count)])
+
+
+def _get_organizations_with_package_counts():
+    global _organization_cache
+    ttl = p.toolkit.asint(config.get('ckanext-report.organization_cache_ttl',
+                                     ORGANIZATION_CACHE_TTL))
+    if _organization_cache is not None and \
+            time.time() - _organization_cache[0] < ttl:
+        return _organization_cache[1]
+
+    package_count = func.count(model.Package.id).label('package_count')
+    rows = model.Session.query(model.Group.id, model.Group.name, model.Group.title,
+                               func.max(model.GroupExtra.value).label('title_translated'),
+                               package_count).\
         filter(model.Group.type == 'organization').\
         filter(model.Group.state == 'active').\
-        outerjoin(model.Package, model.Package.owner_org == model.Group.id).\
+        outerjoin(model.Package, and_(model.Package.owner_org == model.Group.id,
+                                      model.Package.state == 'active')).\
+        outerjoin(model.GroupExtra, and_(model.GroupExtra.group_id == model.Group.id,
+                                         model.GroupExtra.key == 'title_translated')).\
         group_by(model.Group.id).order_by(model.Group.title).all()
 
-    for organization in organizations:
-        extras = model.Session.query(model.GroupExtra.value.label('title_translated')).filter(
-            model.GroupExtra.key == 'title_translated', model.GroupExtra.group_id == organization.id).first()
-        title_translated: Dict[str,
-                               str] = extras.title_translated if extras else {}
-        org: Organization = {'id': organization.id,
-                             'name': organization.name,
-                             'title': organization.title,
-                             'title_translated': title_translated}
-
-        if only_orgs_with_packages:
-            if organization.package_count > 0:
-                yield (org)
-        else:
-            yield (org)
+    organizations = []
+    for row in rows:
+        org: Organization = {'id': row.id,
+                             'name': row.name,
+                             'title': row.title,
+                             'title_translated': row.title_translated or {}}
+        organizations.append((org, row.package_count))
+    _organization_cache = (time.time(), organizations)
+    return organizations
+
+
+class OrganizationIndex(object):
+    '''An in-memory index of organizations, for finding the ones that match
+    what a user has typed, by name or title (in any language).'''
+
+    # Ranks of the ways that a search term can match, best first
+    EXACT, PREFIX, WORD_PREFIX, SUBSTRING = range(4)
+
+    def __init__(self, organizations):
+        self._entries = []  # (org, [(text, words)])
+        self._by_name = {}
+        for org in organizations:
+            self._by_name[org['name']] = org
+            texts = [org['name'], org['title'] or '']
+            if isinstance(org['title_translated'], dict):
+                texts.extend(org['title_translated'].values())
+            texts = set(text.lower() for text in texts if text)
+            self._entries.append((org, [(text, text.split()) for text in texts]))
+
+    def get(self, name):
+        '''Returns the organization with the given name, or None'''
+        return self._by_name.get(name)
+
+    def search(self, term, limit):
+        '''Returns up to limit organizations matching the search term, best
+        matches first: exact, then prefix, then the start of a word, then
+        anywhere in the name or title. Equal matches stay in title order.'''
+        term = term.strip().lower()
+        if not term:
+            return [org for org, texts in self._entries[:limit]]
+        matches = []
+        for position, (org, texts) in enumerate(self._entries):
+            ranks = [rank for rank in (self._rank(term, text, words)
+                                       for text, words in texts)
+                     if rank is not None]
+            if ranks:
+                matches.append((min(ranks), position, org))
+        return [org for rank, position, org in
+                heapq.nsmallest(limit, matches, key=lambda m: m[:2])]
+
+    def _rank(self, term, text, words):
+        if text == term:
+            return self.EXACT
+        if text.startswith(term):
+            return self.PREFIX
+        if any(word.startswith(term) for word in words):
+            return self.WORD_PREFIX
+        if term in text:
+            return self.SUBSTRING
+        return None
+
+
+_organization_index = None  # (organizations it was built from, index)
+
+
+def get_organization_index(only_orgs_with_packages=False):
+    '''Returns the OrganizationIndex of all the organizations (or just those
+    with datasets). It is rebuilt whenever the cached list of organizations is
+    refreshed.'''
+    global _organization_index
+    organizations = _get_organizations_with_package_counts()
+    if _organization_index is None or _organization_index[0] is not organizations:
+        _organization_index = (organizations, {
+            only_with_packages: OrganizationIndex(
+                org for org, package_count in organizations
+                if package_count or not only_with_packages)
+            for only_with_packages in (False, True)})
+    return _organization_index[1][bool(only_orgs_with_packages)]
+
+
+def search_organizations(term, limit=10, only_orgs_with_packages=True):
+    '''Returns up to limit organizations matching the search term (see
+    OrganizationIndex.search).'''
+    return get_organization_index(only_orgs_with_packages).search(term, limit)
+
+
+def clear_organization_cache():
+    '''Clears this process's cache of get_all_organizations, e.g. because an
+    organization has changed. (Other processes pick up changes when their cache
+    expires, after ckanext-report.organization_cache_ttl seconds.)'''
+    global _organization_cache
+    _organization_cache = None
 
 
 def go_down_tree(organization):
@@ -71,6 +181,105 @@ def go_down_tree(organization):
             yield grandchild
 
 
+def organization_and_ancestor_names(organization):
+    '''Given an organization (object, name or id), returns its name and the
+    names of the organizations above it in the hierarchy, i.e. those whose
+    reports with include_sub_organizations would include it.
+    '''
+    if isinstance(organization, six.string_types):
+        organization = model.Group.get(organization)
+    if not organization:
+        return []
+    return [organization.name] + \
+        [parent.name for parent in
+         organization.get_parent_group_hierarchy(type='organization')]
+
+
+def get_organization_and_descendant_ids(organization_id) -> List[str]:
+    '''Returns the ids of the given organization and of all the active
+    organizations below it in the hierarchy, found in a single recursive
+    query.
+
+    During report generation (see organization_hierarchy_for_run) the
+    hierarchy is loaded once and reused instead.
+    '''
+    if _run_hierarchy is not None:
+        return _run_hierarchy.get_organization_and_descendant_ids(organization_id)
+    group = model.group_table
+    member = model.member_table
+    tree = select(group.c.id).where(group.c.id == organization_id) \
+        .cte('organization_tree', recursive=True)
+    # A sub-organization is a Member with group_id=<child>, table_id=<parent>.
+    # UNION rather than UNION ALL, so a loop in the hierarchy terminates
+    tree = tree.union(
+        select(group.c.id)
+        .select_from(group.join(member, member.c.group_id == group.c.id)
+                     .join(tree, member.c.table_id == tree.c.id))
+        .where(member.c.table_name == 'group')
+        .where(member.c.state == 'active')
+        .where(group.c.type == 'organization')
+        .where(group.c.state == 'active'))
+    return sorted(row[0] for row in model.Session.execute(select(tree.c.id)))
+
+
+class OrganizationHierarchy(object):
+    '''The whole hierarchy of active organizations, loaded in one query, so
+    that the sub-organizations of every organization can be worked out without
+    further queries. It is not updated when organizations change, so is for
+    use during one batch of report generation.
+    '''
+
+    def __init__(self):
+        group = model.group_table
+        member = model.member_table
+        self._ids_by_name = dict(
+            model.Session.query(model.Group.name, model.Group.id)
+            .filter(model.Group.type == 'organization')
+            .filter(model.Group.state == 'active'))
+        self._children = defaultdict(list)
+        rows = model.Session.execute(
+            select(member.c.table_id, member.c.group_id)
+            .select_from(member.join(group, member.c.group_id == group.c.id))
+            .where(member.c.table_name == 'group')
+            .where(member.c.state == 'active')
+            .where(group.c.type == 'organization')
+            .where(group.c.state == 'active'))
+        for parent_id, child_id in rows:
+            self._children[parent_id].append(child_id)
+        self._descendant_ids = {}  # parent id: sorted ids of it and below
+
+    def get_id(self, name):
+        return self._ids_by_name.get(name)
+
+    def get_organization_and_descendant_ids(self, organization_id):
+        if organization_id not in self._descendant_ids:
+            ids = set()
+            to_visit = [organization_id]
+            while to_visit:
+                id_ = to_visit.pop()
+                if id_ not in ids:
+                    ids.add(id_)
+                    to_visit.extend(self._children[id_])
+            self._descendant_ids[organization_id] = sorted(ids)
+        return self._descendant_ids[organization_id]
+
+
+_run_hierarchy = None
+
+
+@contextlib.contextmanager
+def organization_hierarchy_for_run():
+    '''Context manager that loads the OrganizationHierarchy, for
+    filter_by_organizations to use while generating a batch of reports.'''
+    global _run_hierarchy
+    previous = _run_hierarchy
+    _run_hierarchy = OrganizationHierarchy()
+    try:
+        yield _run_hierarchy
+    finally:
+        _run_hierarchy = previous
+
+
 def filter_by_organizations(query, organization, include_sub_organizations):
     '''Given an SQLAlchemy ORM query object, it returns it filtered by the
     given organization and optionally its sub organizations too.
@@ -78,14 +287,19 @@ def filter_by_organizations(query, organization, include_sub_organizations):
     if not organization:
         return query
     if isinstance(organization, six.string_types):
-        organization = model.Group.get(organization)
-        assert organization
+        organization_id = _run_hierarchy.get_id(organization) \
+            if _run_hierarchy is not None else None
+        if not organization_id:
+            organization = model.Group.get(organization)
+            assert organization
+            organization_id = organization.id
+    else:
+        organization_id = organization.id
     if include_sub_organizations:
-        orgs = sorted([x for x in go_down_tree(organization)], key=lambda x: x.name)
-        org_ids = [org.id for org in orgs]
+        org_ids = get_organization_and_descendant_ids(organization_id)
         return query.filter(model.Package.owner_org.in_(org_ids))
     else:
-        return query.filter(model.Package.owner_org == organization.id)
+        return query.filter(model.Package.owner_org == organization_id)
 
 
 def dataset_notes(pkg):
@@ -104,11 +318,18 @@ def percent(numerator, denominator):
 
 
 def make_csv_from_dicts(rows):
+    return ''.join(iter_csv_from_dicts(rows))
+
+
+def iter_csv_from_dicts(rows):
+    '''Yields the CSV for the rows (dicts) a line at a time, so that it can
+    be streamed rather than built up in memory. The rows are iterated twice,
+    first to find all the columns.'''
     import csv
 
-    csvout = StringIO()
+    line = _LastLine()
     csvwriter = csv.writer(
-        csvout,
+        line,
         dialect='excel',
         quoting=csv.QUOTE_NONNUMERIC
     )
@@ -123,6 +344,7 @@ def make_csv_from_dicts(rows):
             if header in new_headers:
                 headers_ordered.append(header)
     csvwriter.writerow(headers_ordered)
+    yield line.value
     for row in rows:
         items = []
         for header in headers_ordered:
@@ -140,8 +362,199 @@ def make_csv_from_dicts(rows):
             csvwriter.writerow(items)
         except Exception as e:
             raise Exception('%s: %s, %s' % (e, row, items))
-    csvout.seek(0)
-    return csvout.read()
+        yield line.value
+
+
+class _LastLine(object):
+    '''File-like object that keeps just the last thing written - csv.writer
+    writes each row with one write().'''
+    value = ''
+
+    def write(self, value):
+        self.value = value
+
+
+def iter_json(data):
+    '''Yields the same JSON as json.dumps(data), but in pieces - each row of
+    the table is encoded separately - so that it can be streamed rather than
+    built up in memory. The table can be any iterable of rows.'''
+    if not isinstance(data, dict) or \
+            isinstance(data.get('table'), (dict, type(None)) + six.string_types):
+        yield json.dumps(data)
+        return
+    yield '{'
+    for i, (key, value) in enumerate(data.items()):
+        yield '%s%s: ' % (', ' if i else '', json.dumps(six.text_type(key)))
+        if key == 'table':
+            yield '['
+            for j, row in enumerate(value):
+                yield '%s%s' % (', ' if j else '', json.dumps(row))
+            yield ']'
+        else:
+            yield json.dumps(value)
+    yield '}'
+
+
+def join_chunks(pieces, size=64 * 1024):
+    '''Joins an iterable of small strings into chunks of about size
+    characters, to stream a response in fewer, bigger writes.'''
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+DOWNLOAD_ARTIFACT_FORMATS = ('csv', 'json', 'csv.gz', 'json.gz')
+
+
+def make_download_artifacts(data, generated_at, formats):
+    '''Returns the report data as downloads in the given formats (see
+    DOWNLOAD_ARTIFACT_FORMATS) - the same as the report view would serve,
+    optionally gzipped - as a dict of format: bytes.
+
+    The table can be any iterable of dicts that can be iterated more than
+    once, e.g. one that reads the rows from the database. The gzipped formats
+    are compressed as they are made, so only the compressed bytes are held in
+    memory.'''
+    data = dict(data)  # leave the caller's data unchanged
+    if isinstance(data['table'], list):
+        ensure_data_is_dicts(data)
+    artifacts = {}
+    for format in formats:
+        if format not in DOWNLOAD_ARTIFACT_FORMATS:
+            raise ValueError('Unknown download artifact format: %r' % format)
+        if format.startswith('csv'):
+            pieces = iter_csv_from_dicts(data['table'])
+        else:
+            pieces = iter_json(dict(data, generated_at=generated_at.isoformat()))
+        artifacts[format] = _encode_artifact(join_chunks(pieces),
+                                             format.endswith('.gz'))
+    return artifacts
+
+
+def _encode_artifact(chunks, gzipped):
+    import gzip
+    import io
+    if not gzipped:
+        return ''.join(chunks).encode('utf8')
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        for chunk in chunks:
+            gzip_file.write(chunk.encode('utf8'))
+    return buffer.getvalue()
+
+
+class ReportFields(OrderedDict):
+    '''Yielded by a report's generate function, if it yields its data rather
+    than returning it (see IReport), to give fields of the data other than
+    the table rows, e.g. yield ReportFields(num_packages=10).'''
+
+
+def can_anonymise_user_names():
+    '''Says whether anonymise_user_names changes data (depending on the user),
+    in which case it can't be served from a precomputed download.'''
+    try:
+        import ckanext.dgu.lib.helpers  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def report_cache_validators(report_key, report_date, format=None, user=None):
+    '''Returns the (ETag, Last-Modified date) of the HTTP response for a report,
+    given the date its data was written (a datetime or isoformat string) -
+    its 'created' date, which is not changed when it is regenerated unchanged.
+    The ETag also depends on the format and, as the page or anonymised data
+    differs for each, the user.'''
+    import hashlib
+    if isinstance(report_date, six.string_types):
+        from ckan.lib.helpers import date_str_to_datetime
+        report_date = date_str_to_datetime(report_date)
+    etag = hashlib.sha1(u'|'.join((
+        report_key, report_date.isoformat(), format or u'html', user or u'',
+    )).encode('utf8')).hexdigest()
+    return etag, report_date.replace(microsecond=0)
+
+
+def is_not_modified(environ, etag, last_modified):
+    '''Says whether the request is conditional (If-None-Match or
+    If-Modified-Since) and the client already has this version of the report,
+    so a 304 response can be sent.'''
+    from werkzeug.http import is_resource_modified
+    if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+        return False
+    if not (environ.get('HTTP_IF_NONE_MATCH') or environ.get('HTTP_IF_MODIFIED_SINCE')):
+        return False
+    return not is_resource_modified(environ, etag=etag, last_modified=last_modified)
+
+
+def http_cache_headers(etag, last_modified, user=None):
+    '''Returns the ETag, Last-Modified and Cache-Control headers for a report
+    response. Responses for logged-in users are only cached by the browser.'''
+    from werkzeug.http import http_date, quote_etag
+    max_age = p.toolkit.asint(config.get('ckanext-report.http_max_age', 0))
+    return {
+        'ETag': quote_etag(etag, weak=True),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': '%s, max-age=%d' % ('private' if user else 'public', max_age),
+    }
+
+
+def filter_and_sort_rows(rows, filters=None, search=None, sort=None, descending=False):
+    '''Returns the table rows (dicts) that have the values given in filters (a
+    dict of column: value, compared as text - see json_value_text) and contain
+    the search text in one of their values (case-insensitive), sorted by the
+    sort column, if given. Rows that are missing the sort column's value go
+    last.'''
+    if filters:
+        filters = dict((column, json_value_text(value))
+                       for column, value in filters.items())
+        rows = [row for row in rows
+                if all(json_value_text(row.get(column)) == value
+                       for column, value in filters.items())]
+    if search:
+        search = search.lower()
+        rows = [row for row in rows
+                if any(search in six.text_type(value).lower()
+                       for value in row.values() if value is not None)]
+    if sort:
+        present = [row for row in rows if row.get(sort) is not None]
+        missing = [row for row in rows if row.get(sort) is None]
+        rows = sorted(present, key=lambda row: _json_sort_key(row[sort]),
+                      reverse=descending) + missing
+    return list(rows)
+
+
+def json_value_text(value):
+    '''Returns a value of a table row as text, as Postgres gives a JSON value
+    as text (the ->> operator), so that filter values, which are strings (e.g.
+    from the URL), match values of other types, such as numbers.'''
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return six.text_type(value)
+
+
+def _json_sort_key(value):
+    '''Orders values of mixed types as Postgres orders JSON values: strings,
+    then numbers, then booleans, then anything else.'''
+    if isinstance(value, six.string_types):
+        return (0, value)
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, six.integer_types + (float,)):
+        return (1, value)
+    return (3, json.dumps(value, sort_keys=True))
 
 
 def ensure_data_is_dicts(data):
@@ -167,6 +580,10 @@ def anonymise_user_names(data, organization=None):
     except ImportError:
         # If this is not DGU then cannot do the anonymization
         return
+    if not isinstance(data['table'], list):
+        # e.g. rows read from the cache as they are used - the changes to
+        # them need keeping
+        data['table'] = list(data['table'])
     column_names = data['table'][0].keys() if data['table'] else []
     for col in column_names:
         if col.lower() in ('user', 'username', 'user name', 'author'):
@@ -1,6 +1,7 @@
 from ckanext.report.report_registry import ReportRegistry
 import ckan.plugins as p
 import ckan.logic as logic
+import six
 
 
 @logic.side_effect_free
@@ -62,6 +63,27 @@ def report_data_get(context=None, data_dict=None):
     :param options: Dictionary of options to pass to the report (optional)
     :type options: dict
 
+    :param offset: Return the table rows from this one (optional, default 0)
+    :type offset: int
+
+    :param limit: Return at most this number of table rows (optional)
+    :type limit: int
+
+    :param filters: Return only the table rows with these values, as a dict of
+        column name: value (optional)
+    :type filters: dict
+
+    :param q: Return only the table rows with a value containing this text,
+        case-insensitively (optional)
+    :type q: string
+
+    :param sort: The column to sort the table rows by, optionally followed by
+        " asc" or " desc" (optional)
+    :type sort: string
+
+    If any of offset, limit, filters, q or sort are given, the number of rows
+    that match (before offset and limit) is given in the data as 'total_rows'.
+
     :returns: A list containing the data and the date on which it was created
     :rtype: list
     """
@@ -72,11 +94,71 @@ def report_data_get(context=None, data_dict=None):
 
     report = ReportRegistry.instance().get_report(id)
 
-    data, date = report.get_fresh_report(**options)
+    if any(data_dict.get(param) is not None
+           for param in ('offset', 'limit', 'filters', 'q', 'sort')):
+        errors = {}
+        offset = _as_natural_number(data_dict.get('offset', 0), 'offset', errors)
+        limit = _as_natural_number(data_dict.get('limit'), 'limit', errors)
+        filters = data_dict.get('filters') or None
+        if filters is not None and not isinstance(filters, dict):
+            errors['filters'] = ['Must be a dict']
+        if errors:
+            raise p.toolkit.ValidationError(errors)
+        try:
+            data, date = report.get_fresh_report_page(
+                offset or 0, limit, filters=filters, search=data_dict.get('q') or None,
+                sort=data_dict.get('sort') or None, **options)
+        except ValueError as e:
+            raise p.toolkit.ValidationError({'columns': [str(e)]})
+    else:
+        data, date = report.get_fresh_report(**options)
 
     return data, date.isoformat()
 
 
+@logic.side_effect_free
+def report_data_get_many(context=None, data_dict=None):
+    """
+    Returns the data for several reports, or one report with several sets of
+    options, in one call. The cached data is looked up in a single query.
+
+    Each item is authorized in the same way as report_data_get.
+
+    :param items: The reports to get, each a dict with the keys 'id' (the name
+        of the report) and 'options' (optional, as for report_data_get)
+    :type items: list of dicts
+
+    :returns: A list with an item for each one requested, each a list
+        containing the data and the date on which it was created
+    :rtype: list
+    """
+    logic.check_access('report_data_get_many', context, data_dict)
+
+    items = logic.get_or_bust(data_dict, 'items')
+    if not isinstance(items, list):
+        raise p.toolkit.ValidationError({'items': ['Must be a list']})
+
+    registry = ReportRegistry.instance()
+    report_options = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise p.toolkit.ValidationError({'items': ['Each item must be a dict']})
+        id = logic.get_or_bust(item, 'id')
+        options = item.get('options') or {}
+        if not isinstance(options, dict):
+            raise p.toolkit.ValidationError({'options': ['Must be a dict']})
+        try:
+            registry.get_report(id)
+        except KeyError:
+            raise p.toolkit.ObjectNotFound('Report not found: %s' % id)
+        logic.check_access('report_data_get', context,
+                           {'id': id, 'options': options})
+        report_options.append((id, options))
+
+    return [(data, date.isoformat())
+            for data, date in registry.get_fresh_reports(report_options)]
+
+
 @logic.side_effect_free
 def report_key_get(context=None, data_dict=None):
     """
@@ -99,3 +181,44 @@ def report_key_get(context=None, data_dict=None):
     report = ReportRegistry.instance().get_report(id)
 
     return report.generate_key(options).replace('?', '_')
+
+
+@logic.side_effect_free
+def report_refresh_status(context=None, data_dict=None):
+    """
+    Returns the status of a refresh started by report_refresh
+
+    :param job_id: The id of the refresh job, returned by report_refresh
+    :type job_id: string
+
+    :returns: A dictionary with the 'job_id', its 'status' - one of 'queued',
+        'running', 'done' or 'failed', or 'unknown' if there is no such job
+        (e.g. it finished a while ago) - and the 'error' if it failed
+    :rtype: dictionary
+    """
+    logic.check_access('report_refresh_status', context, data_dict)
+
+    from ckanext.report import jobs
+    job_id = logic.get_or_bust(data_dict, 'job_id')
+    if not isinstance(job_id, six.string_types):
+        raise p.toolkit.ValidationError({'job_id': ['Must be a string']})
+    if not job_id.startswith(jobs.REFRESH_JOB_ID_PREFIX):
+        raise p.toolkit.ObjectNotFound('Report refresh job not found: %s' % job_id)
+
+    status, error = jobs.refresh_status(job_id)
+    return {'job_id': job_id, 'status': status, 'error': error}
+
+
+def _as_natural_number(value, name, errors):
+    '''Returns the value as an int >= 0 (or None), adding to the errors if it
+    is not one.'''
+    if value is None or value == '':
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = -1
+    if number < 0:
+        errors[name] = ['Must be a natural number']
+        return None
+    return number
@@ -1,23 +1,53 @@
 from ckanext.report.report_registry import ReportRegistry
 
+import ckan.plugins as p
 import ckan.logic as logic
 
 
 def report_refresh(context=None, data_dict=None):
     """
-    Causes the cached data of the report to be refreshed
+    Causes the cached data of the report to be refreshed, by a background job
+
+    If a refresh of the report with these options is already queued or
+    running, that job is shared rather than another being queued.
 
     :param id: The name of the report
     :type id: string
 
     :param options: Dictionary of options to pass to the report
     :type options: dict
+
+    :returns: A dictionary with the 'job_id' of the refresh job, for
+        report_refresh_status
+    :rtype: dictionary
     """
     logic.check_access('report_refresh', context, data_dict)
 
     id = logic.get_or_bust(data_dict, 'id')
-    options = data_dict.get('options')
+    options = data_dict.get('options') or {}
+
+    try:
+        report = ReportRegistry.instance().get_report(id)
+    except KeyError:
+        raise p.toolkit.ObjectNotFound('Report not found: %s' % id)
 
-    report = ReportRegistry.instance().get_report(id)
+    from ckanext.report import jobs
+    job_id = jobs.enqueue_refresh(report, report.add_option_defaults(options))
+    return {'job_id': job_id}
 
-    report.refresh_cache(options)
+
+@p.toolkit.chained_action
+def package_owner_org_update(original_action, context, data_dict):
+    """
+    Wraps CKAN's package_owner_org_update, which moves a dataset to another
+    organization without calling IPackageController.edit, to mark the cached
+    reports of both organizations dirty.
+    """
+    from ckan import model
+    from ckanext.report.plugin import mark_organizations_dirty
+    package = model.Package.get(data_dict.get('id'))
+    previous_owner_org = package.owner_org if package else None
+    result = original_action(context, data_dict)
+    if package:
+        mark_organizations_dirty([previous_owner_org, package.owner_org])
+    return result
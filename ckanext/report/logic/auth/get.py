@@ -27,6 +27,16 @@ def report_data_get(context=None, data_dict=None):
     return {'success': True}
 
 
+@auth_allow_anonymous_access
+def report_data_get_many(context=None, data_dict=None):
+    # each of the items is checked with report_data_get by the action
+    return {'success': True}
+
+
 @auth_allow_anonymous_access
 def report_key_get(context=None, data_dict=None):
     return {'success': True}
+
+
+def report_refresh_status(context=None, data_dict=None):
+    return {'success': False}  # Don't allow non-sysadmins
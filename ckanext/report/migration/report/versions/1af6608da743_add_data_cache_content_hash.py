@@ -0,0 +1,29 @@
+"""Add data_cache content_hash and checked columns
+
+Revision ID: 1af6608da743
+Revises: 3ae300028ada
+Create Date: 2026-10-18 17:11:45.630218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1af6608da743'
+down_revision = '3ae300028ada'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_cache', sa.Column('content_hash', sa.UnicodeText))
+    op.add_column('data_cache', sa.Column('checked', sa.DateTime))
+    # existing values have a content_hash of NULL, so they are written again
+    # the next time they are generated
+    op.execute('UPDATE data_cache SET checked = created')
+
+
+def downgrade():
+    op.drop_column('data_cache', 'checked')
+    op.drop_column('data_cache', 'content_hash')
@@ -0,0 +1,24 @@
+"""Add data_cache storage column
+
+Revision ID: 3ae300028ada
+Revises: 3c15e8e98927
+Create Date: 2026-10-18 16:02:31.772094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3ae300028ada'
+down_revision = '3c15e8e98927'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_cache', sa.Column('storage', sa.UnicodeText))
+
+
+def downgrade():
+    op.drop_column('data_cache', 'storage')
@@ -0,0 +1,25 @@
+"""Add GIN index on data_cache_row.row
+
+Revision ID: 3c15e8e98927
+Revises: e1753c41aa65
+Create Date: 2026-10-18 15:20:48.104937
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3c15e8e98927'
+down_revision = 'e1753c41aa65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_data_cache_row_row', 'data_cache_row', ['row'],
+                    postgresql_using='gin',
+                    postgresql_ops={'row': 'jsonb_path_ops'})
+
+
+def downgrade():
+    op.drop_index('idx_data_cache_row_row', 'data_cache_row')
@@ -0,0 +1,89 @@
+"""Add compressed storage of data_cache values
+
+Revision ID: 4983e0d59b96
+Revises: a964f3b40f56
+Create Date: 2026-10-18 10:02:17.845310
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4983e0d59b96'
+down_revision = 'a964f3b40f56'
+branch_labels = None
+depends_on = None
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+data_cache = sa.table(
+    'data_cache',
+    sa.column('id', sa.UnicodeText),
+    sa.column('value', sa.UnicodeText),
+    sa.column('value_compressed', sa.LargeBinary),
+    sa.column('compression', sa.UnicodeText),
+)
+
+
+def upgrade():
+    op.add_column('data_cache', sa.Column('value_compressed', sa.LargeBinary))
+    op.add_column('data_cache', sa.Column('compression', sa.UnicodeText))
+
+    # If compression is configured, compress the existing values too - with
+    # the same functions and compression names as DataCache.set
+    from ckanext.report.model import compress_value, compression_configured
+    compression = compression_configured()
+    if compression is None:
+        return
+
+    connection = op.get_bind()
+    converted = 0
+    while True:
+        # Rows drop out of this query once compressed, so it gets the next batch
+        rows = connection.execute(
+            sa.select(data_cache.c.id, data_cache.c.value)
+            .where(data_cache.c.compression.is_(None))
+            .where(data_cache.c.value.isnot(None))
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            connection.execute(
+                data_cache.update()
+                .where(data_cache.c.id == row.id)
+                .values(value=None,
+                        value_compressed=compress_value(row.value, compression),
+                        compression=compression))
+        converted += len(rows)
+        log.info('Compressed %s data_cache values', converted)
+
+
+def downgrade():
+    from ckanext.report.model import decompress_value
+    connection = op.get_bind()
+    decompressed = 0
+    while True:
+        # Rows drop out of this query once decompressed, so it gets the next
+        # batch
+        rows = connection.execute(
+            sa.select(data_cache.c.id, data_cache.c.value_compressed,
+                      data_cache.c.compression)
+            .where(data_cache.c.value_compressed.isnot(None))
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            connection.execute(
+                data_cache.update()
+                .where(data_cache.c.id == row.id)
+                .values(value=decompress_value(row.value_compressed, row.compression),
+                        value_compressed=None, compression=None))
+        decompressed += len(rows)
+        log.info('Decompressed %s data_cache values', decompressed)
+    op.drop_column('data_cache', 'compression')
+    op.drop_column('data_cache', 'value_compressed')
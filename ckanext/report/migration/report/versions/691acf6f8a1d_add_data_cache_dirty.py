@@ -0,0 +1,25 @@
+"""Add data_cache dirty flag
+
+Revision ID: 691acf6f8a1d
+Revises: 4983e0d59b96
+Create Date: 2026-10-18 11:20:52.116483
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '691acf6f8a1d'
+down_revision = '4983e0d59b96'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_cache', sa.Column('dirty', sa.Boolean, nullable=False,
+                                          server_default='false'))
+
+
+def downgrade():
+    op.drop_column('data_cache', 'dirty')
@@ -0,0 +1,46 @@
+"""Add report_generation_run and report_generation_item tables
+
+Revision ID: 998486c5d5d3
+Revises: 1af6608da743
+Create Date: 2026-10-18 18:02:37.114582
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '998486c5d5d3'
+down_revision = '1af6608da743'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'report_generation_run',
+        sa.Column('id', sa.UnicodeText, primary_key=True),
+        sa.Column('reports', sa.UnicodeText, nullable=False),
+        sa.Column('started', sa.DateTime),
+        sa.Column('finished', sa.DateTime),
+    )
+    op.create_table(
+        'report_generation_item',
+        sa.Column('id', sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column('run_id', sa.UnicodeText,
+                  sa.ForeignKey('report_generation_run.id', ondelete='CASCADE'),
+                  nullable=False),
+        sa.Column('report_name', sa.UnicodeText, nullable=False),
+        sa.Column('key', sa.UnicodeText, nullable=False),
+        sa.Column('options', sa.UnicodeText, nullable=False),
+        sa.Column('state', sa.UnicodeText, nullable=False),
+        sa.Column('error', sa.UnicodeText),
+        sa.Column('updated', sa.DateTime),
+    )
+    op.create_index('idx_report_generation_item_run_id_key',
+                    'report_generation_item', ['run_id', 'key'], unique=True)
+
+
+def downgrade():
+    op.drop_table('report_generation_item')
+    op.drop_table('report_generation_run')
@@ -0,0 +1,38 @@
+"""Make data_cache (object_id, key) unique
+
+Revision ID: a964f3b40f56
+Revises: 8fda3d90a882
+Create Date: 2026-10-18 09:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a964f3b40f56'
+down_revision = '8fda3d90a882'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Concurrent refreshes could have saved the same object_id/key twice -
+    # keep only the most recently created row of each.
+    op.execute(
+        "DELETE FROM data_cache a USING data_cache b "
+        "WHERE a.key = b.key "
+        "AND coalesce(a.object_id, '') = coalesce(b.object_id, '') "
+        "AND (coalesce(a.created, '-infinity'::timestamp), a.id) "
+        "< (coalesce(b.created, '-infinity'::timestamp), b.id)")
+
+    op.drop_index('idx_data_cache_object_id_key', 'data_cache', if_exists=True)
+    # object_id is NULL for reports that are not about a particular entity, and
+    # NULLs never conflict in a plain unique index, hence the coalesce
+    op.create_index('idx_data_cache_object_id_key', 'data_cache',
+                    [sa.text("coalesce(object_id, '')"), 'key'], unique=True)
+
+
+def downgrade():
+    op.drop_index('idx_data_cache_object_id_key', 'data_cache')
+    op.create_index('idx_data_cache_object_id_key', 'data_cache', ['object_id'])
@@ -0,0 +1,36 @@
+"""Add data_cache_artifact table
+
+Revision ID: d2caab7819b2
+Revises: 691acf6f8a1d
+Create Date: 2026-10-18 12:41:07.392615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2caab7819b2'
+down_revision = '691acf6f8a1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'data_cache_artifact',
+        sa.Column('id', sa.UnicodeText, primary_key=True),
+        sa.Column('object_id', sa.UnicodeText),
+        sa.Column('key', sa.UnicodeText, nullable=False),
+        sa.Column('format', sa.UnicodeText, nullable=False),
+        sa.Column('content', sa.LargeBinary),
+        sa.Column('created', sa.DateTime),
+    )
+    op.create_index('idx_data_cache_artifact_object_id_key_format',
+                    'data_cache_artifact',
+                    [sa.text("coalesce(object_id, '')"), 'key', 'format'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_table('data_cache_artifact')
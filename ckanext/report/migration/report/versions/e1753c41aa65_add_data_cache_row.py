@@ -0,0 +1,37 @@
+"""Add data_cache_row table
+
+Revision ID: e1753c41aa65
+Revises: d2caab7819b2
+Create Date: 2026-10-18 14:05:22.518304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1753c41aa65'
+down_revision = 'd2caab7819b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'data_cache_row',
+        sa.Column('id', sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column('object_id', sa.UnicodeText),
+        sa.Column('key', sa.UnicodeText, nullable=False),
+        sa.Column('position', sa.Integer, nullable=False),
+        sa.Column('row', JSONB, nullable=False),
+        sa.Column('created', sa.DateTime),
+    )
+    op.create_index('idx_data_cache_row_object_id_key_position',
+                    'data_cache_row',
+                    [sa.text("coalesce(object_id, '')"), 'key', 'position'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_table('data_cache_row')
@@ -0,0 +1,39 @@
+"""Add report generation queue and lease columns
+
+Revision ID: fedabcb66a79
+Revises: 998486c5d5d3
+Create Date: 2026-10-18 18:47:09.302114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fedabcb66a79'
+down_revision = '998486c5d5d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('report_generation_run',
+                  sa.Column('queued', sa.Boolean, nullable=False,
+                            server_default='false'))
+    op.add_column('report_generation_item',
+                  sa.Column('lease_owner', sa.UnicodeText))
+    op.add_column('report_generation_item',
+                  sa.Column('lease_expires', sa.DateTime))
+    op.add_column('report_generation_item',
+                  sa.Column('attempts', sa.Integer, nullable=False,
+                            server_default='0'))
+    op.create_index('idx_report_generation_item_state',
+                    'report_generation_item', ['state'])
+
+
+def downgrade():
+    op.drop_index('idx_report_generation_item_state', 'report_generation_item')
+    op.drop_column('report_generation_item', 'attempts')
+    op.drop_column('report_generation_item', 'lease_expires')
+    op.drop_column('report_generation_item', 'lease_owner')
+    op.drop_column('report_generation_run', 'queued')
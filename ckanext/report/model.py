@@ -1,21 +1,66 @@
 # encoding: utf-8
 
+import contextlib
 import datetime
+import hashlib
+import itertools
 import logging
 import json
+import os
+import sys
+import threading
+import time
+import zlib
 
-from sqlalchemy import types, Table, Column, Index, MetaData
+import six
+
+from sqlalchemy import (types, Table, Column, ForeignKey, Index, MetaData, func,
+                        or_, select, text, tuple_)
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.orm import mapper
 
 from ckan import model
+from ckan.plugins.toolkit import asint, config
+from ckanext.report import cache_backend
 try:
     from collections import OrderedDict  # from python 2.7
 except ImportError:
     from sqlalchemy.util import OrderedDict
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger(__name__)
 
-__all__ = ['DataCache', 'data_cache_table', 'init_tables']
+__all__ = ['DataCache', 'data_cache_table', 'DataCacheArtifact',
+           'data_cache_artifact_table', 'DataCacheRow', 'data_cache_row_table',
+           'GenerationRun', 'generation_run_table', 'generation_item_table',
+           'init_tables']
+
+# How old a cached value can be before get_if_fresh() ignores it
+FRESH_MAX_AGE = datetime.timedelta(days=2)
+
+# Number of (object_id, key) pairs looked up per query by get_many()
+GET_MANY_CHUNK_SIZE = 500
+
+# Number of rows written per INSERT by DataCacheRow.set_rows()
+SET_ROWS_CHUNK_SIZE = 1000
+
+# Number of finished generation runs whose records are kept
+GENERATION_RUNS_KEPT = 10
+
+# Age after which the records of a generation run are deleted even if it did
+# not finish (e.g. it crashed), when it is not one of the last kept
+GENERATION_RUN_MAX_AGE = datetime.timedelta(days=7)
+
+# Default limits of the in-memory cache of decoded values
+MEMORY_CACHE_MAX_ENTRIES = 50
+MEMORY_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# Number of the rows of a table that decoded_size() measures, to estimate
+# the size of them all
+DECODED_SIZE_SAMPLE_ROWS = 100
 
 metadata = MetaData()
 
@@ -27,9 +72,103 @@ data_cache_table = Table(
     Column('key', types.UnicodeText, nullable=False),
     Column('value', types.UnicodeText),
     Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    # When the value is compressed, it is stored here instead of in 'value',
+    # and 'compression' says how (see compress_value)
+    Column('value_compressed', types.LargeBinary),
+    Column('compression', types.UnicodeText),
+    # Set when something the value was calculated from has changed since
+    Column('dirty', types.Boolean, nullable=False, default=False,
+           server_default='false'),
+    # The cache backend that stores the value, if it is not stored in this
+    # table (see cache_backend)
+    Column('storage', types.UnicodeText),
+    # Hash of the value (as stored, before compression), so a value that is
+    # generated again the same needn't be written again
+    Column('content_hash', types.UnicodeText),
+    # When the value was last generated. 'created' is when it was last
+    # written, which is earlier if it has since been generated unchanged.
+    Column('checked', types.DateTime),
 )
-Index('idx_data_cache_object_id_key', data_cache_table.c.object_id,
-      data_cache_table.c.key)
+# object_id is NULL for reports that are not about a particular entity, and
+# NULLs never conflict in a plain unique index, hence the coalesce
+data_cache_unique_elements = [func.coalesce(data_cache_table.c.object_id, ''),
+                              data_cache_table.c.key]
+Index('idx_data_cache_object_id_key', *data_cache_unique_elements, unique=True)
+
+data_cache_artifact_table = Table(
+    'data_cache_artifact', metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=model.types.make_uuid),
+    Column('object_id', types.UnicodeText),
+    Column('key', types.UnicodeText, nullable=False),
+    Column('format', types.UnicodeText, nullable=False),
+    Column('content', types.LargeBinary),
+    Column('created', types.DateTime),
+)
+Index('idx_data_cache_artifact_object_id_key_format',
+      func.coalesce(data_cache_artifact_table.c.object_id, ''),
+      data_cache_artifact_table.c.key, data_cache_artifact_table.c.format,
+      unique=True)
+
+data_cache_row_table = Table(
+    'data_cache_row', metadata,
+    Column('id', types.BigInteger, primary_key=True, autoincrement=True),
+    Column('object_id', types.UnicodeText),
+    Column('key', types.UnicodeText, nullable=False),
+    # the row's index in the table, from 0
+    Column('position', types.Integer, nullable=False),
+    Column('row', JSONB, nullable=False),
+    Column('created', types.DateTime),
+)
+Index('idx_data_cache_row_object_id_key_position',
+      func.coalesce(data_cache_row_table.c.object_id, ''),
+      data_cache_row_table.c.key, data_cache_row_table.c.position,
+      unique=True)
+# for filtering rows by the values of their columns (JSONB containment)
+Index('idx_data_cache_row_row', data_cache_row_table.c.row,
+      postgresql_using='gin', postgresql_ops={'row': 'jsonb_path_ops'})
+
+generation_run_table = Table(
+    'report_generation_run', metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=model.types.make_uuid),
+    # the names of the reports generated, comma-separated
+    Column('reports', types.UnicodeText, nullable=False),
+    Column('started', types.DateTime, default=datetime.datetime.utcnow),
+    Column('finished', types.DateTime),
+    # Set for a run that is queued for "ckan report worker" processes, rather
+    # than run by "ckan report generate"
+    Column('queued', types.Boolean, nullable=False, default=False,
+           server_default='false'),
+)
+
+generation_item_table = Table(
+    'report_generation_item', metadata,
+    Column('id', types.BigInteger, primary_key=True, autoincrement=True),
+    Column('run_id', types.UnicodeText,
+           ForeignKey('report_generation_run.id', ondelete='CASCADE'),
+           nullable=False),
+    Column('report_name', types.UnicodeText, nullable=False),
+    # the report's cache key for the option combination
+    Column('key', types.UnicodeText, nullable=False),
+    # the option combination, as JSON
+    Column('options', types.UnicodeText, nullable=False),
+    # 'pending', 'running' (in a queued run), 'done' or 'failed'
+    Column('state', types.UnicodeText, nullable=False),
+    # the traceback, if it failed
+    Column('error', types.UnicodeText),
+    Column('updated', types.DateTime),
+    # In a queued run, the worker that has claimed the item, and when its
+    # claim expires unless renewed
+    Column('lease_owner', types.UnicodeText),
+    Column('lease_expires', types.DateTime),
+    # the number of times a worker has claimed it
+    Column('attempts', types.Integer, nullable=False, default=0,
+           server_default='0'),
+)
+Index('idx_report_generation_item_run_id_key',
+      generation_item_table.c.run_id, generation_item_table.c.key, unique=True)
+Index('idx_report_generation_item_state', generation_item_table.c.state)
 
 
 class DataCache(object):
@@ -71,69 +210,1028 @@ class DataCache(object):
     @classmethod
     def get(cls, object_id, key, convert_json=False, max_age=None):
         """
-        Retrieves the value and date that it was written if the record with
-        object_id/key exists. If not it will return None/None.
+        Retrieves the value and the date that it was last generated (its
+        'checked' date) if the record with object_id/key exists. If not it
+        will return None/None.
         """
-        item = model.Session.query(cls) \
-            .filter(cls.key == key) \
-            .filter(cls.object_id == object_id) \
-            .first()
-        if not item:
-            return (None, None)
-
-        if max_age:
-            age = datetime.datetime.utcnow() - item.created
-            if age > max_age:
-                log.debug('Cache not returned - it is older than requested %s/%s %r > %r',
-                          object_id, key, age, max_age)
-                return (None, None)
-
-        value = item.value
-        if convert_json:
-            # Use OrderedDict instead of dict, so that the order of the columns
-            # in the data is preserved from the data when it was written (assuming
-            # it was written as an OrderedDict in the report's code).
-            try:
-                # Python 2.7's json library has object_pairs_hook
-                import json
-                value = json.loads(value, object_pairs_hook=OrderedDict)
-            except TypeError:  # Untested
-                # Python 2.4-2.6
-                import simplejson as json
+        return cls.get_many([(object_id, key)], convert_json=convert_json,
+                            max_age=max_age)[0]
+
+    @classmethod
+    def get_date(cls, object_id, key):
+        """
+        Returns just the date that the record with object_id/key was last
+        generated, or None if it does not exist.
+        """
+        return cls.get_dates([(object_id, key)])[0]
+
+    @classmethod
+    def get_dates(cls, object_ids_and_keys):
+        """
+        Returns the dates that the records for a list of (object_id, key) were
+        last generated (None for any that do not exist), in the same order.
+        """
+        object_ids_and_keys = list(object_ids_and_keys)
+        items = cls._query(list(OrderedDict.fromkeys(object_ids_and_keys)),
+                           cls.checked)
+        return [items[object_id_and_key].checked
+                if object_id_and_key in items else None
+                for object_id_and_key in object_ids_and_keys]
+
+    @classmethod
+    def get_metadata(cls, object_ids_and_keys):
+        """
+        Returns the created and checked dates and dirty flag of the records
+        for a list of (object_id, key), without their values. Returns a list in
+        the same order, of rows with attributes 'created', 'checked' and
+        'dirty', or None for any records that do not exist.
+        """
+        object_ids_and_keys = list(object_ids_and_keys)
+        items = cls._query(list(OrderedDict.fromkeys(object_ids_and_keys)),
+                           cls.created, cls.checked, cls.dirty)
+        return [items.get(object_id_and_key)
+                for object_id_and_key in object_ids_and_keys]
+
+    @classmethod
+    def mark_dirty(cls, object_ids, key_prefixes):
+        """
+        Flags the records for the given object_ids (which may include None)
+        as dirty, i.e. needing to be regenerated. Only records whose key is one
+        of key_prefixes, or starts with one followed by '?' (as report keys
+        do), are marked.
+        """
+        object_ids = set(object_ids)
+        key_prefixes = list(key_prefixes)
+        if not object_ids or not key_prefixes:
+            return
+        object_id_clause = cls.object_id.in_(
+            [object_id for object_id in object_ids if object_id is not None])
+        if None in object_ids:
+            object_id_clause = or_(object_id_clause, cls.object_id.is_(None))
+        model.Session.query(cls) \
+            .filter(object_id_clause) \
+            .filter(func.split_part(cls.key, '?', 1).in_(key_prefixes)) \
+            .filter(cls.dirty.is_(False)) \
+            .update({'dirty': True}, synchronize_session=False)
+        log.debug('Cache marked dirty: %r %r', object_ids, key_prefixes)
+
+    @classmethod
+    def get_many(cls, object_ids_and_keys, convert_json=False, max_age=None):
+        """
+        Retrieves many records at once, given a list of (object_id, key). The
+        lookups are done in a few queries on the (object_id, key) index,
+        rather than one per record.
+
+        Returns a list of (value, date) in the same order as requested, with
+        None/None for any records that do not exist (or are too old), as for
+        get().
+
+        Values converted from JSON are kept in memory (see
+        DecodedValueCache), and are only fetched and decoded again if the
+        record has been written since. So that the copy in memory is not
+        altered, the value returned is a copy of the top-level dict and of the
+        rows of its 'table' - anything nested deeper must not be changed.
+        """
+        object_ids_and_keys = list(object_ids_and_keys)
+        wanted = list(OrderedDict.fromkeys(object_ids_and_keys))
+        memory_cache = decoded_value_cache() if convert_json else None
+        results = {}
+        if memory_cache:
+            # Get just the dates first, so the values that are already in
+            # memory needn't be transferred and decoded again
+            to_fetch = []
+            for object_id_and_key, item in cls._query(wanted, cls.created, cls.checked).items():
+                if cls._too_old(object_id_and_key, item.checked, max_age):
+                    continue
+                value = memory_cache.get(object_id_and_key, item.created)
+                if value is None:
+                    to_fetch.append(object_id_and_key)
+                else:
+                    results[object_id_and_key] = (_copy_value(value), item.checked)
+        else:
+            to_fetch = wanted
+
+        items = cls._query(to_fetch, cls.value, cls.value_compressed,
+                           cls.compression, cls.storage, cls.created, cls.checked)
+        for object_id_and_key, item in items.items():
+            if cls._too_old(object_id_and_key, item.checked, max_age):
+                continue
+            value = cache_backend.get_backend(item.storage).load(
+                object_id_and_key[0], object_id_and_key[1], item)
+            if value is None and item.storage:
+                # it has gone missing, so treat it as not cached
+                continue
+            if convert_json and value is not None:
+                # Use OrderedDict instead of dict, so that the order of the columns
+                # in the data is preserved from the data when it was written (assuming
+                # it was written as an OrderedDict in the report's code).
                 value = json.loads(value, object_pairs_hook=OrderedDict)
-        return value, item.created
+                if memory_cache:
+                    memory_cache.put(object_id_and_key, item.created, value,
+                                     decoded_size(value))
+                    value = _copy_value(value)
+            results[object_id_and_key] = (value, item.checked)
+
+        return [results.get(object_id_and_key, (None, None))
+                for object_id_and_key in object_ids_and_keys]
+
+    @classmethod
+    def _query(cls, object_ids_and_keys, *columns):
+        '''Returns the given columns of the records, as a dict keyed by
+        (object_id, key)'''
+        items = {}
+        for chunk in _chunks(object_ids_and_keys, GET_MANY_CHUNK_SIZE):
+            rows = model.Session.query(cls.object_id, cls.key, *columns) \
+                .filter(tuple_(*data_cache_unique_elements).in_(
+                    [(object_id or '', key) for object_id, key in chunk]))
+            for row in rows:
+                items[(row.object_id, row.key)] = row
+        return items
+
+    @staticmethod
+    def _too_old(object_id_and_key, created, max_age):
+        if not max_age:
+            return False
+        age = datetime.datetime.utcnow() - created
+        if age > max_age:
+            log.debug('Cache not returned - it is older than requested %s/%s %r > %r',
+                      object_id_and_key[0], object_id_and_key[1], age, max_age)
+            return True
+        return False
+
+    @classmethod
+    def invalidate(cls, object_id, key):
+        """
+        Drops any decoded copy of the record held in this process's memory.
+        (Copies are checked against the record's date before use anyway, so
+        this is to free the memory promptly, rather than for correctness.)
+        """
+        memory_cache = decoded_value_cache()
+        if memory_cache:
+            memory_cache.invalidate((object_id, key))
+
+    @classmethod
+    def memory_cache_stats(cls):
+        """
+        Returns the counters of the in-memory cache of decoded values (see
+        DecodedValueCache.stats) or None if it is disabled.
+        """
+        memory_cache = decoded_value_cache()
+        return memory_cache.stats() if memory_cache else None
 
     @classmethod
     def get_if_fresh(cls, *args, **kwargs):
-        return cls.get(*args, max_age=datetime.timedelta(days=2), **kwargs)
+        return cls.get(*args, max_age=FRESH_MAX_AGE, **kwargs)
+
+    @classmethod
+    def get_many_if_fresh(cls, *args, **kwargs):
+        return cls.get_many(*args, max_age=FRESH_MAX_AGE, **kwargs)
 
     @classmethod
     def set(cls, object_id, key, value, convert_json=False):
         """
-        This method looks up any existing record for the object_id/key and if
-        found will update the value and created fields, otherwise it will
-        create a new record.  All values will be returned as a string, unless
+        This method updates the value and dates of any existing record for the
+        object_id/key, otherwise it will create a new record. It is a single
+        INSERT ... ON CONFLICT statement, so concurrent writers cannot create
+        duplicates. All values will be returned as a string, unless
         convert_json is done to convert from JSON.
         """
-        if convert_json:
-            value = json.dumps(value)
+        return cls.set_many([(object_id, key, value)], convert_json=convert_json)
+
+    @classmethod
+    def set_many(cls, items, convert_json=False):
+        """
+        Saves many (object_id, key, value) items, in the same way as set(). If
+        an object_id/key appears more than once, the last value wins. Returns
+        the date given to all of them.
+        """
+        return cls.set_many_if_changed(items, convert_json=convert_json)[0]
+
+    @classmethod
+    def set_many_if_changed(cls, items, convert_json=False, now=None):
+        """
+        Saves many (object_id, key, value) items, in the same way as set(), but
+        a value that is the same as the one already stored (judging by its
+        content_hash) is not written again - just its 'checked' date is
+        updated, and its dirty flag cleared - unless it is no longer stored the
+        way the configured backend and compression would store it, or its file
+        has gone missing (see CacheBackend.is_current). The others are written
+        in one INSERT ... ON CONFLICT statement, with 'created' and 'checked'
+        dates - the current time, unless now is given.
+
+        Returns the date given to all of them, and a list of the
+        (object_id, key) of the values that were written.
+        """
+        now = now or datetime.datetime.utcnow()
+        values = OrderedDict()
+        for object_id, key, value in items:
+            if convert_json:
+                value = json.dumps(value)
+            values[(object_id, key)] = value
+        hashes = dict((object_id_and_key, content_hash(value))
+                      for object_id_and_key, value in values.items())
+        stored = cls._query(list(values), cls.content_hash, cls.storage,
+                            cls.compression, cls.created)
+        backend = cache_backend.configured_backend()
+        unchanged = [object_id_and_key for object_id_and_key in values
+                     if hashes[object_id_and_key] is not None and
+                     object_id_and_key in stored and
+                     stored[object_id_and_key].content_hash == hashes[object_id_and_key] and
+                     backend.is_current(object_id_and_key[0], object_id_and_key[1],
+                                        stored[object_id_and_key])]
+        changed = [object_id_and_key for object_id_and_key in values
+                   if object_id_and_key not in unchanged]
+
+        for chunk in _chunks(unchanged, GET_MANY_CHUNK_SIZE):
+            model.Session.query(cls) \
+                .filter(tuple_(*data_cache_unique_elements).in_(
+                    [(object_id or '', key) for object_id, key in chunk])) \
+                .update({'checked': now, 'dirty': False},
+                        synchronize_session=False)
+
+        if changed:
+            rows = []
+            for object_id, key in changed:
+                row = {'id': model.types.make_uuid(),
+                       'object_id': object_id,
+                       'key': key,
+                       'content_hash': hashes[(object_id, key)],
+                       'dirty': False,
+                       'created': now,
+                       'checked': now}
+                row.update(backend.store(object_id, key, now, values[(object_id, key)]))
+                rows.append(row)
+            statement = insert(data_cache_table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=data_cache_unique_elements,
+                set_={'value': statement.excluded.value,
+                      'value_compressed': statement.excluded.value_compressed,
+                      'compression': statement.excluded.compression,
+                      'storage': statement.excluded.storage,
+                      'content_hash': statement.excluded.content_hash,
+                      'dirty': statement.excluded.dirty,
+                      'created': statement.excluded.created,
+                      'checked': statement.excluded.checked})
+            model.Session.execute(statement)
+
+        if changed:
+            log.debug('Cache save: %s', ', '.join('%s/%s' % k for k in changed))
+        if unchanged:
+            log.debug('Cache unchanged: %s', ', '.join('%s/%s' % k for k in unchanged))
+        return now, changed
+
+
+@contextlib.contextmanager
+def generation_lock(name, timeout, poll_interval=0.5):
+    '''Context manager that holds a Postgres advisory lock identified by the
+    given name (e.g. a report's cache key), so that only one process at a time
+    does the work. Waits up to timeout seconds for another holder to release
+    it.
+
+    The lock is held on its own connection, so it is unaffected by commits of
+    the Session. Yields True if the lock was acquired, or False if timed out.
+    '''
+    lock_id = int(hashlib.sha1(name.encode('utf8')).hexdigest()[:15], 16)
+    connection = model.meta.engine.connect() \
+        .execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        deadline = time.time() + timeout
+        while True:
+            acquired = connection.execute(
+                select(func.pg_try_advisory_lock(lock_id))).scalar()
+            if acquired or time.time() >= deadline:
+                break
+            time.sleep(poll_interval)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(select(func.pg_advisory_unlock(lock_id)))
+    finally:
+        connection.close()
+
+
+# Held by lease_heartbeat's thread while it renews the leases, and taken by a
+# process before it forks, so that the child is never made while the thread
+# holds locks (of logging, the database driver etc) - which nothing in the
+# child would release, as the thread is not copied to it
+_heartbeat_lock = threading.Lock()
+
+
+def _before_fork():
+    _heartbeat_lock.acquire()
+
+
+def _after_fork_in_parent():
+    _heartbeat_lock.release()
+
+
+def _after_fork_in_child():
+    global _heartbeat_lock
+    _heartbeat_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork,
+                        after_in_parent=_after_fork_in_parent,
+                        after_in_child=_after_fork_in_child)
+
+
+@contextlib.contextmanager
+def lease_heartbeat(worker_id, item_ids, lease_seconds):
+    '''Context manager that renews the worker's claim on the given generation
+    items (see GenerationRun.claim) every third of lease_seconds, in a
+    background thread, until the block exits - so the claim only expires if
+    the worker dies or hangs.
+
+    The thread has its own engine, so it is unaffected by the Session, or the
+    main engine being disposed of. The process can fork meanwhile (e.g. for
+    run_in_subprocess) - forking waits for any renewal to finish.
+    '''
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+    engine = create_engine(config['sqlalchemy.url'], poolclass=NullPool)
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_seconds / 3.0):
+            with _heartbeat_lock:
+                try:
+                    with engine.begin() as connection:
+                        GenerationRun.renew_leases(connection, worker_id, item_ids,
+                                                   lease_seconds)
+                except Exception:
+                    log.exception('Failed to renew the lease of %s', worker_id)
+
+    thread = threading.Thread(target=renew, name='report-lease-heartbeat')
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        engine.dispose()
+
+
+class DecodedValueCache(object):
+    """
+    An in-process LRU cache of values that DataCache has decoded from JSON,
+    keyed by (object_id, key). Each value is stored with the 'created' date of
+    its record, and is only used while the record still has that date, so it
+    never serves data that has been regenerated since.
+
+    It is bounded by the number of entries and by their total size, in bytes
+    of memory (as estimated by decoded_size), which is several times the
+    length of their JSON. Values bigger than the whole limit are not cached.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # (object_id, key): (created, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, object_id_and_key, created):
+        '''Returns the value, or None if it is not cached for that date'''
+        with self._lock:
+            entry = self._entries.get(object_id_and_key)
+            if entry is None or entry[0] != created:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(object_id_and_key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, object_id_and_key, created, value, size):
+        with self._lock:
+            self._remove(object_id_and_key)
+            if size > self.max_bytes:
+                return
+            self._entries[object_id_and_key] = (created, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, object_id_and_key):
+        with self._lock:
+            self._remove(object_id_and_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+    def _remove(self, object_id_and_key):
+        entry = self._entries.pop(object_id_and_key, None)
+        if entry:
+            self._bytes -= entry[2]
+
+
+def decoded_size(value, sample_rows=DECODED_SIZE_SAMPLE_ROWS):
+    '''Returns an estimate of the memory, in bytes, taken by a value decoded
+    from JSON - the objects of all its dicts, lists and values. The rows of a
+    big table are estimated from a sample of sample_rows of them, spread
+    through it.'''
+    table = value.get('table') if isinstance(value, dict) else None
+    if not (isinstance(table, list) and len(table) > sample_rows):
+        return _object_size(value)
+    step = len(table) / float(sample_rows)
+    sample_size = sum(_object_size(table[int(i * step)])
+                      for i in range(sample_rows))
+    rest = dict(value)
+    del rest['table']
+    return _object_size(rest) + sys.getsizeof(table) + \
+        int(sample_size * len(table) / float(sample_rows))
+
+
+def _object_size(value):
+    size = 0
+    objects = [value]
+    while objects:
+        obj = objects.pop()
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            objects.extend(obj.keys())
+            objects.extend(obj.values())
+        elif isinstance(obj, list):
+            objects.extend(obj)
+    return size
+
+
+_decoded_value_cache = None
+
+
+def decoded_value_cache():
+    '''Returns this process's DecodedValueCache, or None if it is disabled by
+    setting ckanext-report.memory_cache_max_entries or
+    ckanext-report.memory_cache_max_bytes to 0.'''
+    global _decoded_value_cache
+    if _decoded_value_cache is None:
+        max_entries = asint(config.get('ckanext-report.memory_cache_max_entries',
+                                       MEMORY_CACHE_MAX_ENTRIES))
+        max_bytes = asint(config.get('ckanext-report.memory_cache_max_bytes',
+                                     MEMORY_CACHE_MAX_BYTES))
+        _decoded_value_cache = DecodedValueCache(max_entries, max_bytes)
+    if not _decoded_value_cache.max_entries or \
+            not _decoded_value_cache.max_bytes:
+        return None
+    return _decoded_value_cache
+
+
+def _copy_value(value):
+    '''Returns a copy of a decoded value that the caller can alter in the ways
+    that reports are used to - changing the top-level keys or the rows of the
+    table.'''
+    if not isinstance(value, dict):
+        return value
+    value = value.copy()
+    table = value.get('table')
+    if isinstance(table, list):
+        value['table'] = [row.copy() if isinstance(row, dict) else row
+                          for row in table]
+    return value
+
+
+def compression_configured():
+    '''Returns the compression to use for newly cached values, according to
+    the config option ckanext-report.cache_compression ("zlib" or "zstd"), or
+    None if they are not to be compressed. zstd needs the "zstandard" package
+    - without it zlib is used.
+
+    Values are decompressed according to how they were stored, so the option
+    can be changed at any time.
+    '''
+    compression = config.get('ckanext-report.cache_compression') or None
+    if compression in (None, 'none'):
+        return None
+    if compression == 'zstd' and zstandard is None:
+        log.warning('ckanext-report.cache_compression is zstd, but the '
+                    'zstandard package is not installed - using zlib')
+        return 'zlib'
+    if compression not in ('zlib', 'zstd'):
+        raise ValueError('Unknown ckanext-report.cache_compression: %r'
+                         % compression)
+    return compression
+
+
+def compress_value(value, compression):
+    '''Compresses a value (a string) to bytes'''
+    data = six.text_type(value).encode('utf8')
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data)
+
+
+def decompress_value(data, compression):
+    '''Decompresses bytes to the value (a string) given to compress_value'''
+    data = bytes(data)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('Cached value is compressed with zstd, but the '
+                              'zstandard package is not installed')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode('utf8')
+
+
+def content_hash(value):
+    '''Returns the hash of a value (a string) stored in data_cache.content_hash'''
+    if value is None:
+        return None
+    return hashlib.sha256(six.text_type(value).encode('utf8')).hexdigest()
+
+
+def _json_values_with_text(value_text):
+    '''Returns the JSON values whose text (see lib.json_value_text) is the given
+    text - the string itself, and the number or boolean, if it is one.'''
+    from ckanext.report.lib import json_value_text
+    values = [value_text]
+    try:
+        value = json.loads(value_text)
+    except ValueError:
+        return values
+    if isinstance(value, (bool, int, float)) and json_value_text(value) == value_text:
+        values.append(value)
+    return values
+
+
+def _survives_json(value):
+    try:
+        return json.loads(json.dumps(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+
+def _chunks(list_, size):
+    for i in range(0, len(list_), size):
+        yield list_[i:i + size]
+
+
+class DataCacheArtifact(object):
+    """
+    Files made from a DataCache value when it is written, so they can be
+    served as they are, e.g. the CSV download of a report. Each is stored with
+    the same object_id, key and created date as the value it was made from,
+    and is identified by its format, e.g. 'csv' or 'json.gz'.
+    """
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def get(cls, object_id, key, format, created):
+        """
+        Returns the content of the artifact, or None if there is none made
+        from the value written at the given created date.
+        """
+        item = model.Session.query(cls.content) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
+            .filter(cls.key == key) \
+            .filter(cls.format == format) \
+            .filter(cls.created == created) \
+            .first()
+        return item.content if item else None
+
+    @classmethod
+    def get_formats(cls, object_id, key, created):
+        """
+        Returns the set of formats of the artifacts made from the value
+        written at the given created date.
+        """
+        return set(item.format for item in model.Session.query(cls.format)
+                   .filter(func.coalesce(cls.object_id, '') == (object_id or ''))
+                   .filter(cls.key == key)
+                   .filter(cls.created == created))
+
+    @classmethod
+    def set_all(cls, object_id, key, created, artifacts):
+        """
+        Replaces the artifacts of the object_id/key with the given ones, a dict
+        of format: content (bytes), made from the value written at the given
+        created date.
+        """
+        model.Session.query(cls) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
+            .filter(cls.key == key) \
+            .delete(synchronize_session=False)
+        if artifacts:
+            model.Session.execute(data_cache_artifact_table.insert().values([
+                {'id': model.types.make_uuid(),
+                 'object_id': object_id,
+                 'key': key,
+                 'format': format,
+                 'content': content,
+                 'created': created}
+                for format, content in artifacts.items()]))
+        log.debug('Cache artifacts save: %s/%s %s', object_id, key,
+                  ', '.join(artifacts))
+
+
+class DataCacheRow(object):
+    """
+    The rows of a table in a DataCache value (e.g. a report's table), stored
+    one per record as well, so that a page of them can be read without loading
+    the whole value. Each is stored with the same object_id, key and created
+    date as the value, and its position in the table.
+    """
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
 
-        item = model.Session.query(cls) \
+    @classmethod
+    def get_rows(cls, object_id, key, created, offset=0, limit=None):
+        """
+        Returns the rows (as dicts) from the given position, at most limit of
+        them, or an empty list if none were stored with the value written at
+        the given created date.
+        """
+        query = model.Session.query(cls.row) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
             .filter(cls.key == key) \
-            .filter(cls.object_id == object_id).first()
-        if item is None:
-            item = DataCache(object_id=object_id, key=key, value=value)
-            model.Session.add(item)
-        else:
-            item.value = value
-        item.created = datetime.datetime.utcnow()
+            .filter(cls.created == created) \
+            .filter(cls.position >= offset)
+        if limit is not None:
+            query = query.filter(cls.position < offset + limit)
+        return [item.row for item in query.order_by(cls.position)]
 
-        log.debug('Cache save: %s/%s', object_id, key)
+    @classmethod
+    def query_rows(cls, object_id, key, created, filters=None, search=None,
+                   sort=None, descending=False, offset=0, limit=None):
+        """
+        Returns the rows (as dicts) stored with the value written at the given
+        created date that match the query, and the number of them, ignoring
+        offset and limit. The query is done by the database:
+
+        filters - a dict of column: value that rows must have, compared as
+                  text, so "5" matches 5 (see lib.json_value_text)
+        search - text that one of a row's values must contain (case-insensitive)
+        sort - the column to sort the rows by (otherwise they keep their order)
+
+        Returns (rows, count)
+        """
+        from ckanext.report.lib import json_value_text
+        query = model.Session.query(cls.row) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
+            .filter(cls.key == key) \
+            .filter(cls.created == created)
+        for column, value in (filters or {}).items():
+            value_text = json_value_text(value)
+            if value_text is None:
+                query = query.filter(cls.row[column].astext.is_(None))
+            else:
+                # as containment, so the GIN index is used
+                query = query.filter(or_(*[cls.row.contains({column: json_value})
+                                           for json_value in _json_values_with_text(value_text)]))
+        if search:
+            pattern = '%%%s%%' % search.replace('\\', '\\\\') \
+                .replace('%', '\\%').replace('_', '\\_')
+            query = query.filter(text(
+                'EXISTS (SELECT 1 FROM jsonb_each_text(data_cache_row.row) AS f(k, v) '
+                'WHERE f.v ILIKE :search_pattern)').bindparams(search_pattern=pattern))
+        count = query.count()
+        order_by = [cls.position]
+        if sort:
+            # rows missing the value (or it is null) go last, either way
+            order_by[:0] = [
+                func.coalesce(func.jsonb_typeof(cls.row[sort]), 'null') == 'null',
+                cls.row[sort].desc() if descending else cls.row[sort].asc()]
+        query = query.order_by(*order_by).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return [item.row for item in query], count
+
+    @classmethod
+    def count_rows(cls, object_id, key, created):
+        """
+        Returns the number of rows stored with the value written at the given
+        created date.
+        """
+        return model.Session.query(cls) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
+            .filter(cls.key == key) \
+            .filter(cls.created == created) \
+            .count()
+
+    @classmethod
+    def iter_rows(cls, object_id, key, created, chunk_size=SET_ROWS_CHUNK_SIZE):
+        """
+        Yields all the rows stored with the value written at the given created
+        date, reading them chunk_size at a time, so that they needn't all be
+        in memory at once.
+        """
+        offset = 0
+        while True:
+            rows = cls.get_rows(object_id, key, created, offset, chunk_size)
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            offset += chunk_size
+
+    @classmethod
+    def set_rows(cls, object_id, key, created, rows):
+        """
+        Replaces the rows stored for the object_id/key with the given ones (an
+        iterable of dicts), from the value written at the given created date.
+        They are inserted SET_ROWS_CHUNK_SIZE at a time, so rows can be given
+        by a generator without them all being held in memory.
+
+        Returns the number of rows.
+        """
+        model.Session.query(cls) \
+            .filter(func.coalesce(cls.object_id, '') == (object_id or '')) \
+            .filter(cls.key == key) \
+            .delete(synchronize_session=False)
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, SET_ROWS_CHUNK_SIZE))
+            if not chunk:
+                break
+            model.Session.execute(data_cache_row_table.insert(), [
+                {'object_id': object_id,
+                 'key': key,
+                 'position': count + i,
+                 'row': row,
+                 'created': created}
+                for i, row in enumerate(chunk)])
+            count += len(chunk)
+        log.debug('Cache rows save: %s/%s %s rows', object_id, key, count)
+        return count
+
+
+class GenerationRun(object):
+    """
+    A run of "ckan report generate", with a record of the state of each report
+    option combination in it - 'pending', 'done' or 'failed' (with the
+    traceback) - so that if the run is interrupted, another can carry on from
+    where it got to.
+    """
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def start(cls, reports, combinations, queued=False):
+        """
+        Records a new run of the given report names, with all the given
+        (report_name, key, option_dict) combinations pending, and commits it.
+        If queued, the combinations are for workers to claim (see claim()).
+
+        The records of older runs are deleted, apart from the last
+        GENERATION_RUNS_KEPT - those that finished, and those that didn't but
+        were started over GENERATION_RUN_MAX_AGE ago, so must have crashed.
+
+        The options are stored as JSON, with any values that are not JSON
+        types (e.g. dates) as strings, for reporting failures. A resumed run
+        goes by the recorded keys instead (see get_keys), but a queued one
+        gives workers the options as stored, so they must be JSON types -
+        otherwise ValueError is raised.
+        """
+        if queued:
+            for report_name, key, option_dict in combinations:
+                if not _survives_json(option_dict):
+                    raise ValueError('Options of queued reports must be JSON '
+                                     'types: %s %r' % (report_name, option_dict))
+        now = datetime.datetime.utcnow()
+        old_run_ids = [item.id for item in model.Session.query(cls.id)
+                       .filter(or_(cls.finished.isnot(None),
+                                   cls.started < now - GENERATION_RUN_MAX_AGE))
+                       .order_by(cls.started.desc())
+                       .offset(GENERATION_RUNS_KEPT - 1)]
+        if old_run_ids:
+            model.Session.execute(generation_item_table.delete().where(
+                generation_item_table.c.run_id.in_(old_run_ids)))
+            model.Session.query(cls).filter(cls.id.in_(old_run_ids)) \
+                .delete(synchronize_session=False)
+        run = cls(id=model.types.make_uuid(), reports=','.join(reports),
+                  started=now, queued=queued)
+        model.Session.add(run)
         model.Session.flush()
-        return item.created
+        for chunk in _chunks(combinations, SET_ROWS_CHUNK_SIZE):
+            model.Session.execute(generation_item_table.insert(), [
+                {'run_id': run.id,
+                 'report_name': report_name,
+                 'key': key,
+                 'options': json.dumps(option_dict, default=str),
+                 'state': 'pending'}
+                for report_name, key, option_dict in chunk])
+        model.Session.commit()
+        return run
+
+    @classmethod
+    def get_interrupted(cls, reports):
+        """
+        Returns the latest run of the given report names, if it did not
+        finish, otherwise None.
+        """
+        run = model.Session.query(cls) \
+            .filter(cls.reports == ','.join(reports)) \
+            .filter(cls.queued.is_(False)) \
+            .order_by(cls.started.desc()) \
+            .first()
+        return run if run and run.finished is None else None
+
+    def get_combinations(self, states=('pending', 'failed'), report_name=None):
+        """
+        Returns the (report_name, option_dict) of the combinations in the run
+        with the given states, in the order they were recorded.
+        """
+        query = model.Session.query(generation_item_table.c.report_name,
+                                    generation_item_table.c.options) \
+            .filter(generation_item_table.c.run_id == self.id) \
+            .filter(generation_item_table.c.state.in_(states))
+        if report_name:
+            query = query.filter(generation_item_table.c.report_name == report_name)
+        return [(item.report_name,
+                 json.loads(item.options, object_pairs_hook=OrderedDict))
+                for item in query.order_by(generation_item_table.c.id)]
+
+    def get_keys(self, states=('pending', 'failed')):
+        """
+        Returns the set of the cache keys of the combinations in the run with
+        the given states.
+        """
+        return set(item.key for item in
+                   model.Session.query(generation_item_table.c.key)
+                   .filter(generation_item_table.c.run_id == self.id)
+                   .filter(generation_item_table.c.state.in_(states)))
+
+    def count_states(self):
+        """
+        Returns a dict of state: the number of combinations in it.
+        """
+        return dict(model.Session.query(generation_item_table.c.state,
+                                        func.count())
+                    .filter(generation_item_table.c.run_id == self.id)
+                    .group_by(generation_item_table.c.state))
+
+    def get_failures(self):
+        """
+        Returns the (report_name, option_dict, traceback) of the combinations
+        in the run that failed.
+        """
+        query = model.Session.query(generation_item_table.c.report_name,
+                                    generation_item_table.c.options,
+                                    generation_item_table.c.error) \
+            .filter(generation_item_table.c.run_id == self.id) \
+            .filter(generation_item_table.c.state == 'failed') \
+            .order_by(generation_item_table.c.id)
+        return [(item.report_name,
+                 json.loads(item.options, object_pairs_hook=OrderedDict),
+                 item.error)
+                for item in query]
+
+    def set_state(self, key, state, error=None):
+        """
+        Records the state ('done' or 'failed', with the traceback) of the
+        combination with the given cache key. The caller commits.
+        """
+        model.Session.execute(
+            generation_item_table.update()
+            .where(generation_item_table.c.run_id == self.id)
+            .where(generation_item_table.c.key == key)
+            .values(state=state, error=error,
+                    updated=datetime.datetime.utcnow()))
+
+    def finish(self):
+        """
+        Records that the run finished, and commits.
+        """
+        self.finished = datetime.datetime.utcnow()
+        model.Session.add(self)
+        model.Session.commit()
+
+    @classmethod
+    def get_queued_keys(cls):
+        """
+        Returns the set of the cache keys of the combinations that are waiting
+        for or being generated by a worker, in queued runs.
+        """
+        return set(item.key for item in model.Session.query(generation_item_table.c.key)
+                   .join(generation_run_table,
+                         generation_run_table.c.id == generation_item_table.c.run_id)
+                   .filter(generation_run_table.c.queued.is_(True))
+                   .filter(generation_run_table.c.finished.is_(None))
+                   .filter(generation_item_table.c.state.in_(('pending', 'running'))))
+
+    @classmethod
+    def claim(cls, worker_id, lease_seconds, limit=1, max_attempts=3):
+        """
+        Claims up to limit of the combinations in queued runs for the given
+        worker, for lease_seconds (see renew_leases), and commits. They are
+        those pending, or whose claim by another worker has expired (e.g. it
+        died), unless they have been claimed max_attempts times already, in
+        which case they are marked as failed. Claimed rows are locked with
+        FOR UPDATE SKIP LOCKED, so workers never claim the same ones.
+
+        Returns a list of (item_id, report_name, option_dict).
+        """
+        now = datetime.datetime.utcnow()
+        items = generation_item_table
+        expired = (items.c.state == 'running') & (items.c.lease_expires < now)
+        model.Session.execute(
+            items.update()
+            .where(expired)
+            .where(items.c.attempts >= max_attempts)
+            .values(state='failed', lease_owner=None, lease_expires=None,
+                    updated=now,
+                    error='Abandoned by the workers that claimed it %s times '
+                    '(killed, or timed out?)' % max_attempts))
+        claimable = select(items.c.id) \
+            .select_from(items.join(generation_run_table,
+                                    generation_run_table.c.id == items.c.run_id)) \
+            .where(generation_run_table.c.queued.is_(True)) \
+            .where(generation_run_table.c.finished.is_(None)) \
+            .where(or_(items.c.state == 'pending', expired)) \
+            .where(items.c.attempts < max_attempts) \
+            .order_by(items.c.id) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True, of=items)
+        claimed = model.Session.execute(
+            items.update()
+            .where(items.c.id.in_(claimable))
+            .values(state='running', lease_owner=worker_id,
+                    lease_expires=now + datetime.timedelta(seconds=lease_seconds),
+                    attempts=items.c.attempts + 1, updated=now)
+            .returning(items.c.id, items.c.report_name, items.c.options)).fetchall()
+        model.Session.commit()
+        return sorted((item.id, item.report_name,
+                       json.loads(item.options, object_pairs_hook=OrderedDict))
+                      for item in claimed)
+
+    @staticmethod
+    def renew_leases(connection, worker_id, item_ids, lease_seconds):
+        """
+        Extends the worker's claim on the given items, using the given
+        connection (see lease_heartbeat).
+        """
+        connection.execute(
+            generation_item_table.update()
+            .where(generation_item_table.c.id.in_(item_ids))
+            .where(generation_item_table.c.lease_owner == worker_id)
+            .where(generation_item_table.c.state == 'running')
+            .values(lease_expires=datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=lease_seconds)))
+
+    @classmethod
+    def complete(cls, item_id, worker_id, error=None):
+        """
+        Records that the worker has generated the claimed item, or that it
+        failed (with the traceback), and commits. If the worker's claim has
+        expired and the item was claimed by another, it is left alone.
+        """
+        model.Session.execute(
+            generation_item_table.update()
+            .where(generation_item_table.c.id == item_id)
+            .where(generation_item_table.c.lease_owner == worker_id)
+            .values(state='failed' if error else 'done', error=error,
+                    lease_owner=None, lease_expires=None,
+                    updated=datetime.datetime.utcnow()))
+        model.Session.commit()
+
+    @classmethod
+    def finish_completed(cls):
+        """
+        Records as finished the queued runs that have no combinations left to
+        generate, and commits.
+        """
+        items = generation_item_table
+        model.Session.execute(
+            generation_run_table.update()
+            .where(generation_run_table.c.queued.is_(True))
+            .where(generation_run_table.c.finished.is_(None))
+            .where(~select(items.c.id)
+                   .where(items.c.run_id == generation_run_table.c.id)
+                   .where(items.c.state.in_(('pending', 'running')))
+                   .exists())
+            .values(finished=datetime.datetime.utcnow()))
+        model.Session.commit()
 
 
 mapper(DataCache, data_cache_table)
+mapper(DataCacheArtifact, data_cache_artifact_table)
+mapper(DataCacheRow, data_cache_row_table)
+mapper(GenerationRun, generation_run_table)
 
 
 def init_tables():
@@ -7,6 +7,8 @@ import ckanext.report.logic.auth.get as auth_get
 import ckanext.report.logic.auth.update as auth_update
 from ckan.lib.plugins import DefaultTranslation
 
+log = __import__('logging').getLogger(__name__)
+
 try:
     toolkit.requires_ckan_version("2.9")
 except toolkit.CkanVersionException:
@@ -21,12 +23,18 @@ class ReportPlugin(MixinPlugin, p.SingletonPlugin, DefaultTranslation):
     p.implements(p.IActions, inherit=True)
     p.implements(p.IAuthFunctions, inherit=True)
     p.implements(p.ITranslation)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IOrganizationController, inherit=True)
 
     # IConfigurer
 
     def update_config(self, config):
+        from ckan import model
+        from sqlalchemy import event
         p.toolkit.add_template_directory(config, '../templates')
         p.toolkit.add_resource('../assets', 'report')
+        if not event.contains(model.Session, 'before_flush', _record_previous_owner_orgs):
+            event.listen(model.Session, 'before_flush', _record_previous_owner_orgs)
 
     # ITemplateHelpers
 
@@ -36,6 +44,7 @@ class ReportPlugin(MixinPlugin, p.SingletonPlugin, DefaultTranslation):
             'report__relative_url_for': h.relative_url_for,
             'report__chunks': h.chunks,
             'report__organization_list': h.organization_list,
+            'report__organization_title': h.organization_title,
             'report__render_datetime': h.render_datetime,
             'report__explicit_default_options': h.explicit_default_options,
             'report__get_time': h.get_time
@@ -46,17 +55,50 @@ class ReportPlugin(MixinPlugin, p.SingletonPlugin, DefaultTranslation):
         return {'report_list': action_get.report_list,
                 'report_show': action_get.report_show,
                 'report_data_get': action_get.report_data_get,
+                'report_data_get_many': action_get.report_data_get_many,
                 'report_key_get': action_get.report_key_get,
-                'report_refresh': action_update.report_refresh}
+                'report_refresh_status': action_get.report_refresh_status,
+                'report_refresh': action_update.report_refresh,
+                'package_owner_org_update': action_update.package_owner_org_update}
 
     # IAuthFunctions
     def get_auth_functions(self):
         return {'report_list': auth_get.report_list,
                 'report_show': auth_get.report_show,
                 'report_data_get': auth_get.report_data_get,
+                'report_data_get_many': auth_get.report_data_get_many,
                 'report_key_get': auth_get.report_key_get,
+                'report_refresh_status': auth_get.report_refresh_status,
                 'report_refresh': auth_update.report_refresh}
 
+    # IPackageController and IOrganizationController - both call these
+    # methods, with a Package or Group respectively
+
+    def create(self, entity):
+        self._entity_changed(entity)
+
+    def edit(self, entity):
+        self._entity_changed(entity)
+
+    def delete(self, entity):
+        self._entity_changed(entity)
+
+    def _entity_changed(self, entity):
+        '''Clears the cached organization list, and marks the cached reports
+        of the organization that the changed dataset or organization is in as
+        dirty, for the scheduler to regenerate. If a dataset has moved to
+        another organization, the one it was in is marked dirty too.'''
+        from ckan import model
+        from ckanext.report.lib import clear_organization_cache
+        clear_organization_cache()
+        if isinstance(entity, model.Package):
+            organizations = [entity.owner_org] + _pop_previous_owner_orgs(entity)
+        elif isinstance(entity, model.Group) and entity.is_organization:
+            organizations = [entity]
+        else:
+            return
+        mark_organizations_dirty(organizations)
+
     # ITranslation
 
     def i18n_directory(self):
@@ -66,6 +108,55 @@ class ReportPlugin(MixinPlugin, p.SingletonPlugin, DefaultTranslation):
         return os.path.join(extension_dir, i18n_dir)
 
 
+def mark_organizations_dirty(organizations):
+    '''Marks the cached reports of the given organizations (objects or ids,
+    ignoring any that are None) dirty - see
+    ReportRegistry.mark_organization_reports_dirty.'''
+    from ckan import model
+    from ckanext.report.report_registry import ReportRegistry
+    done = set()
+    for organization in organizations:
+        if not organization or organization in done:
+            continue
+        done.add(organization)
+        # A problem with the report cache must not stop the dataset being saved
+        try:
+            with model.Session.begin_nested():
+                ReportRegistry.instance().mark_organization_reports_dirty(organization)
+        except Exception:
+            log.exception('Could not mark reports dirty for organization %s',
+                          getattr(organization, 'name', organization))
+
+
+PREVIOUS_OWNER_ORGS_KEY = 'ckanext-report.previous_owner_orgs'
+
+
+def _record_previous_owner_orgs(session, flush_context, instances):
+    '''Session before_flush listener that records the owner_org each changed
+    dataset had before, because package_update flushes before it calls
+    IPackageController.edit, so the change is no longer in the history of the
+    dataset's attributes by then.'''
+    from ckan import model
+    from sqlalchemy import inspect
+    for entity in session.dirty:
+        if isinstance(entity, model.Package):
+            previous = [owner_org for owner_org in
+                        inspect(entity).attrs.owner_org.history.deleted
+                        if owner_org]
+            if previous:
+                session.info.setdefault(PREVIOUS_OWNER_ORGS_KEY, {}) \
+                    .setdefault(entity.id, set()).update(previous)
+
+
+def _pop_previous_owner_orgs(package):
+    from ckan import model
+    from sqlalchemy import inspect
+    previous = model.Session.info.get(PREVIOUS_OWNER_ORGS_KEY, {}).pop(package.id, set())
+    # and any change that has not been flushed yet
+    previous.update(inspect(package).attrs.owner_org.history.deleted)
+    return sorted(owner_org for owner_org in previous if owner_org)
+
+
 class TaglessReportPlugin(p.SingletonPlugin):
     '''
     This is a working example only. To be kept simple and demonstrate features,
@@ -1,16 +1,26 @@
 # encoding: utf-8
 
+import collections
+import datetime
+import hashlib
+import itertools
+import json
 import logging
 import copy
 import re
+import traceback
 import six
 
 from ckan import model
-from ckan.plugins.toolkit import asbool
+from ckan.plugins.toolkit import asbool, asint, config
 try:
     from collections import OrderedDict  # from python 2.7
 except ImportError:
     from sqlalchemy.util import OrderedDict
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
 
 from ckanext.report.interfaces import IReport
 
@@ -18,7 +28,33 @@ log = logging.getLogger(__name__)
 
 REPORT_KEYS_REQUIRED = set(('name', 'generate', 'template', 'option_defaults',
                             'option_combinations'))
-REPORT_KEYS_OPTIONAL = set(('title', 'description', 'long_description', 'description_template', 'authorize'))
+REPORT_KEYS_OPTIONAL = set(('title', 'description', 'long_description', 'description_template', 'authorize',
+                            'max_age', 'schedule', 'invalidate_on_change', 'download_artifacts',
+                            'page_size', 'timeout', 'memory_limit'))
+
+# Suffix of the cache key of the data (other than the table) of reports with a
+# page_size, which have their table rows cached separately
+ROWS_SUMMARY_KEY_SUFFIX = '#summary'
+
+# Key of the cached data of reports whose generate function yields it (see
+# IReport) - the table rows are cached separately, and this is a hash of them
+TABLE_ROWS_HASH_KEY = 'table_rows_hash'
+
+# Default for ckanext-report.stale_max_age - the age (in seconds) beyond which
+# stale data is no longer served while it is regenerated
+STALE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Default for ckanext-report.generation_lock_timeout - how long (in seconds) to
+# wait for another process that is generating the same report
+GENERATION_LOCK_TIMEOUT = 60
+
+# Default for ckanext-report.worker_lease - how long (in seconds) a worker's
+# claim on a queued option combination lasts, unless renewed
+WORKER_LEASE = 300
+
+# Default for ckanext-report.worker_max_attempts - how many times a queued
+# option combination can be claimed, before it is given up as failed
+WORKER_MAX_ATTEMPTS = 3
 
 
 class Report(object):
@@ -55,6 +91,24 @@ class Report(object):
                 self.long_description = ''
             elif key == 'description_template':
                 self.description_template = ''
+            elif key == 'max_age':
+                self.max_age = None
+            elif key == 'schedule':
+                self.schedule = None
+            elif key == 'invalidate_on_change':
+                self.invalidate_on_change = False
+            elif key == 'download_artifacts':
+                self.download_artifacts = ()
+            elif key == 'page_size':
+                self.page_size = None
+            elif key == 'timeout':
+                self.timeout = None
+            elif key == 'memory_limit':
+                self.memory_limit = None
+        from ckanext.report import model as report_model
+        self.max_age = as_timedelta(self.max_age) or report_model.FRESH_MAX_AGE
+        self.schedule = as_timedelta(self.schedule) or self.max_age
+        self.timeout = as_timedelta(self.timeout)
 
     def generate_key(self, option_dict, defaults_for_missing_keys=True):
         '''Returns a key that will identify the report and options when saved
@@ -82,41 +136,503 @@ class Report(object):
         else:
             return '%s' % self.name
 
-    def refresh_cache_for_all_options(self):
-        '''Generates the report for all the option combinations and caches them.'''
-        log.info('Report: %s %s', self.plugin, self.name)
-        option_combinations = list(self.option_combinations()) \
+    def get_option_combinations(self):
+        '''Returns a list of all the option combinations that get cached.'''
+        return list(self.option_combinations()) \
             if self.option_combinations else [{}]
-        for option_dict in option_combinations:
-            self.refresh_cache(option_dict)
+
+    def refresh_cache_for_all_options(self, workers=1, stats=None,
+                                      batch_size=1, batch_megabytes=None,
+                                      atomic=False):
+        '''Generates the report for all the option combinations and caches them.
+
+        If workers > 1 then the combinations are spread over a pool of that
+        many processes, and a combination that fails does not stop the others.
+        Returns a list of the failures (see refresh_cache_in_pool). If stats (a
+        Counter) is given, the combinations that were changed and unchanged
+        are counted in it.
+
+        If batch_size > 1, the data is written in batches of that many
+        combinations (or of batch_megabytes of JSON, if that is reached
+        first), each with one commit (see CacheBatch). If atomic is True (not
+        possible with workers > 1), all the combinations are committed
+        together at the end, so readers see them change at the same time.
+        '''
+        log.info('Report: %s %s', self.plugin, self.name)
+        option_combinations = self.get_option_combinations()
+        failures = []
+        if workers > 1:
+            if atomic:
+                raise ValueError('Cannot commit the combinations atomically '
+                                 'when they are spread over several workers')
+            failures = refresh_cache_in_pool(
+                [(self.name, option_dict) for option_dict in option_combinations],
+                workers, stats=stats, batch_size=batch_size,
+                batch_megabytes=batch_megabytes)
+        elif batch_size > 1 or atomic:
+            batch = CacheBatch(batch_size=None if atomic else batch_size,
+                               batch_megabytes=batch_megabytes,
+                               commit=not atomic)
+            for option_dict in option_combinations:
+                batch.refresh(self, option_dict)
+            batch.finish()
+            failures = record_results(batch.results, stats)
+        elif any(self.get_generation_limits()):
+            failures = record_results(
+                [_refresh_cache_catching_errors((self.name, option_dict))
+                 for option_dict in option_combinations], stats)
+        else:
+            for option_dict in option_combinations:
+                self.refresh_cache(option_dict, stats=stats)
         log.info('  report done')
+        return failures
 
-    def refresh_cache(self, option_dict):
-        '''Generates a report for the given options and caches it.
+    def refresh_cache(self, option_dict, stats=None):
+        '''Generates a report for the given options and caches it. Data that
+        is the same as that already cached is not written again - it is just
+        marked as checked (see DataCache.set_many_if_changed).
 
-        Returns (data, date)
+        If stats (a Counter) is given, its 'changed' or 'unchanged' count is
+        incremented.
+
+        Returns (data, date). If the generate function yields the data (see
+        IReport), the data returned is as cached - without the table (see
+        _write_streamed_cache).
         '''
         from ckanext.report import model as report_model
         log.info('  Gen for options: %r', option_dict)
         data = self.generate(**option_dict)
+        entity_name, key = self._cache_key(option_dict)
+        if is_streamed(data):
+            data, date, changed = self._write_streamed_cache(entity_name, key, data)
+        else:
+            items, rows = self._prepare_cache(entity_name, key, data)
+            date, changed = report_model.DataCache.set_many_if_changed(items)
+            changed = self._write_cache_extras(entity_name, key, data, rows,
+                                               date, changed)
+        model.Session.commit()
+        self._cache_written(entity_name, key, changed, stats)
+        return data, date
+
+    def refresh_cache_supervised(self, option_dict):
+        '''Like refresh_cache, but if the report has a time or memory limit
+        (see get_generation_limits), it is generated in a subprocess, which is
+        killed if it goes over them. If it fails, GenerationFailed is raised,
+        and the cached data is left as it was.
+
+        The Session is removed and the database connections closed first, so
+        there must be nothing uncommitted.
+
+        Returns whether the data was changed.
+        '''
+        def refresh():
+            stats = collections.Counter()
+            self.refresh_cache(option_dict, stats=stats)
+            return bool(stats['changed'])
+
+        timeout, memory_limit = self.get_generation_limits()
+        if not (timeout or memory_limit):
+            return refresh()
+        # The subprocess would otherwise share the pooled connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+        return run_in_subprocess(refresh, timeout, memory_limit)
+
+    def get_generation_limits(self):
+        '''Returns the (timeout in seconds, memory limit in bytes) for
+        generating each option combination of the report, from its info dict
+        or else the config. Each is None if there is no limit.'''
+        timeout = self.timeout.total_seconds() if self.timeout else \
+            asint(config.get('ckanext-report.generate_timeout', 0))
+        memory_limit = self.memory_limit or \
+            asint(config.get('ckanext-report.generate_memory_limit', 0))
+        return (timeout or None,
+                memory_limit * 1024 * 1024 if memory_limit else None)
+
+    def _cache_key(self, option_dict):
+        '''Returns the (entity_name, key) that the data for the options is
+        cached under.'''
         # option_combinations should specify every key, so mustn't allow
         # default values
         key = self.generate_key(option_dict, defaults_for_missing_keys=False)
-        date = report_model.DataCache.set(extract_entity_name(option_dict),
-                                          key, data, convert_json=True)
-        model.Session.commit()
+        return extract_entity_name(option_dict), key
+
+    def _prepare_cache(self, entity_name, key, data):
+        '''Returns the DataCache (object_id, key, value) items to write for the
+        data, with the values encoded as JSON, and its table rows, if they are
+        to be cached one by one (otherwise None).
+
+        When they are, the rest of the data (the "summary") is cached too, so
+        that a page of the table can be read without loading all of it.
+        '''
+        from ckanext.report import lib
+        items = [(entity_name, key, json.dumps(data))]
+        if not (self.page_size and 'table' in data):
+            return items, None
+        summary = dict(data)
+        lib.ensure_data_is_dicts(summary)
+        rows = summary.pop('table')
+        summary['total_rows'] = len(rows)
+        # the rows are stored as JSONB, which doesn't keep the order of keys
+        summary['table_columns'] = list(OrderedDict(
+            (column, None) for row in rows for column in row))
+        items.append((entity_name, key + ROWS_SUMMARY_KEY_SUFFIX,
+                      json.dumps(summary)))
+        return items, rows
+
+    def _write_cache_extras(self, entity_name, key, data, rows, date, changed):
+        '''Writes the table rows and download artifacts that go with the data,
+        once its items (see _prepare_cache) have been written by
+        DataCache.set_many_if_changed, which returned the date and the list
+        of those changed (which can include those of other data in the same
+        batch). Only the rows of this data that changed are written. Returns
+        whether the data itself was changed.'''
+        from ckanext.report import model as report_model
+        data_changed = (entity_name, key) in changed
+        # (just the summary is new when the report has just got a page_size)
+        rows_changed = rows is not None and (
+            data_changed or (entity_name, key + ROWS_SUMMARY_KEY_SUFFIX) in changed)
+        if not (rows_changed or self.download_artifacts):
+            return data_changed
+        # the rows and artifacts go with the data as it was written
+        created = date if data_changed else \
+            report_model.DataCache.get_metadata([(entity_name, key)])[0].created
+        if rows_changed:
+            report_model.DataCacheRow.set_rows(entity_name, key, created, rows)
+        self._write_artifacts(entity_name, key, data, created, data_changed)
+        return data_changed
+
+    def _write_streamed_cache(self, entity_name, key, items):
+        '''Caches the data yielded by a streaming generate function (see
+        IReport). The table rows are written to DataCacheRow a chunk at a time
+        as they are yielded, so the table is never held in memory as a whole.
+        The rest of the data is cached as usual, with the number and columns
+        of the rows (total_rows and table_columns, as in the "summary" of
+        reports with a page_size) and a hash of them (TABLE_ROWS_HASH_KEY).
+        get_fresh_report adds the rows back to it.
+
+        The rows are only known to be unchanged once they have all been
+        written, so in that case they are rolled back to a savepoint.
+
+        Returns (data, date, changed), with the data as cached.
+        '''
+        from ckanext.report import lib
+        from ckanext.report import model as report_model
+        now = datetime.datetime.utcnow()
+        fields = OrderedDict()
+        columns = OrderedDict()
+        rows_hash = hashlib.sha256()
+
+        def rows():
+            for item in items:
+                if isinstance(item, lib.ReportFields):
+                    fields.update(item)
+                    continue
+                rows_hash.update(json.dumps(item).encode('utf8') + b'\n')
+                for column in item:
+                    columns[column] = None
+                yield item
+
+        savepoint = model.Session.begin_nested()
+        try:
+            summary = fields
+            summary['total_rows'] = report_model.DataCacheRow.set_rows(
+                entity_name, key, now, rows())
+            summary['table_columns'] = list(columns)
+            data = OrderedDict(summary)
+            data[TABLE_ROWS_HASH_KEY] = rows_hash.hexdigest()
+            values = [(entity_name, key, json.dumps(data)),
+                      (entity_name, key + ROWS_SUMMARY_KEY_SUFFIX, json.dumps(summary))]
+            date, changed = report_model.DataCache.set_many_if_changed(values, now=now)
+        except Exception:
+            savepoint.rollback()
+            raise
+        changed = (entity_name, key) in changed
+        if changed:
+            savepoint.commit()
+            created = date
+        else:
+            savepoint.rollback()
+            date, written = report_model.DataCache.set_many_if_changed(values, now=now)
+            created = report_model.DataCache.get_metadata([(entity_name, key)])[0].created
+        if self.download_artifacts:
+            self._write_artifacts(
+                entity_name, key,
+                with_table(data, CachedRows(entity_name, key, created,
+                                            data['table_columns'],
+                                            data['total_rows'])),
+                created, changed)
+        return data, date, changed
+
+    def _write_artifacts(self, entity_name, key, data, created, data_changed):
+        '''Makes the download artifacts from the data, written at the created
+        date, if it was changed or any of them are missing.'''
+        from ckanext.report import model as report_model
+        if not self.download_artifacts:
+            return
+        missing = set(self.download_artifacts) - \
+            report_model.DataCacheArtifact.get_formats(entity_name, key, created)
+        if data_changed or missing:
+            from ckanext.report import lib
+            report_model.DataCacheArtifact.set_all(
+                entity_name, key, created,
+                lib.make_download_artifacts(data, created, self.download_artifacts))
+
+    def _cache_written(self, entity_name, key, changed, stats=None):
+        '''To call once the cached data has been committed.'''
+        from ckanext.report import model as report_model
+        if changed:
+            # Free the superseded data held in memory
+            report_model.DataCache.invalidate(entity_name, key)
+        else:
+            log.info('  Unchanged: %s', key)
+        if stats is not None:
+            stats['changed' if changed else 'unchanged'] += 1
+
+    def get_fresh_report_page(self, offset=0, limit=None, filters=None,
+                              search=None, sort=None, **option_dict):
+        '''Like get_fresh_report, but the table has only the rows from the
+        given offset, at most limit of them, and data['total_rows'] says how
+        many rows there are in total.
+
+        The rows can also be filtered, searched and sorted (which total_rows
+        takes into account):
+
+        filters - a dict of column: value that rows must have
+        search - text that one of a row's values must contain (case-insensitive)
+        sort - the column to sort by, optionally followed by " asc" or " desc"
+
+        For a report with a page_size, this is done by the database, with the
+        rows that are cached individually, rather than loading the whole table.
+        Raises ValueError if the filters or sort name columns not in the table.
+
+        Returns (data, date)
+        '''
+        from ckanext.report import lib
+        from ckanext.report import model as report_model
+        sort, descending = parse_sort(sort)
+        data = None
+        if self.page_size:
+            entity_name = extract_entity_name(option_dict)
+            key = self.generate_key(option_dict)
+            summary_key = key + ROWS_SUMMARY_KEY_SUFFIX
+            summary, date = report_model.DataCache.get(
+                entity_name, summary_key, convert_json=True, max_age=self.max_age)
+            if summary is None:
+                # generate it, or get it anyway if it can be served stale
+                data, date = self.get_fresh_report(**option_dict)
+                summary, summary_date = report_model.DataCache.get(
+                    entity_name, summary_key, convert_json=True)
+                if summary_date != date:
+                    # e.g. generated before the report had a page_size
+                    summary = None
+            if summary is not None:
+                columns = summary.pop('table_columns')
+                check_columns(columns, filters, sort)
+                # the rows are stored with the date the data was written
+                metadata = report_model.DataCache.get_metadata([(entity_name, key)])[0]
+                created = metadata.created if metadata else None
+                if filters or search or sort:
+                    rows, summary['total_rows'] = report_model.DataCacheRow.query_rows(
+                        entity_name, key, created, filters=filters, search=search,
+                        sort=sort, descending=descending, offset=offset, limit=limit)
+                else:
+                    rows = report_model.DataCacheRow.get_rows(
+                        entity_name, key, created, offset, limit)
+                # (no rows might mean they were just regenerated)
+                if rows or offset >= summary['total_rows'] or limit == 0:
+                    summary['table'] = [
+                        OrderedDict((column, row[column]) for column in columns
+                                    if column in row)
+                        for row in rows]
+                    return summary, date
+
+        if data is None:
+            data, date = self.get_fresh_report(**option_dict)
+        if 'table' in data:
+            data = dict(data)
+            rows = data['table']
+            if isinstance(rows, CachedRows):
+                # the data was yielded by the generate function, so its rows
+                # are cached individually too
+                check_columns(rows.columns, filters, sort)
+                data['table'], data['total_rows'] = rows.query(
+                    filters, search, sort, descending, offset, limit)
+                return data, date
+            if filters or search or sort:
+                lib.ensure_data_is_dicts(data)
+                rows = data['table']
+                check_columns(OrderedDict((column, None) for row in rows for column in row),
+                              filters, sort)
+                rows = lib.filter_and_sort_rows(rows, filters, search, sort, descending)
+            data['total_rows'] = len(rows)
+            data['table'] = rows[offset:None if limit is None else offset + limit]
         return data, date
 
     def get_fresh_report(self, **option_dict):
+        '''Returns the cached report data, generating it if it is not cached or
+        is not fresh.
+
+        Data is fresh if it is younger than the report's max_age (default two
+        days). With ckanext-report.stale_while_revalidate enabled, data that is
+        not fresh is returned straight away (with the date it was generated) and
+        regenerated by a background job, unless it is older than
+        ckanext-report.stale_max_age seconds.
+
+        Returns (data, date)
+        '''
         from ckanext.report import model as report_model
         entity_name = extract_entity_name(option_dict)
         key = self.generate_key(option_dict)
-        data, date = report_model.DataCache.get_if_fresh(
-            entity_name, key, convert_json=True)
+        if not asbool(config.get('ckanext-report.stale_while_revalidate', False)):
+            data, date = report_model.DataCache.get(
+                entity_name, key, convert_json=True, max_age=self.max_age)
+        else:
+            stale_max_age = asint(config.get('ckanext-report.stale_max_age',
+                                             STALE_MAX_AGE))
+            data, date = report_model.DataCache.get(
+                entity_name, key, convert_json=True,
+                max_age=datetime.timedelta(seconds=stale_max_age)
+                if stale_max_age else None)
+            if data is not None and \
+                    datetime.datetime.utcnow() - date > self.max_age:
+                from ckanext.report import jobs
+                jobs.enqueue_refresh(self, self.add_option_defaults(option_dict))
         if data is None:
-            data, date = self.refresh_cache(option_dict)
+            data, date = self.refresh_cache_once(self.add_option_defaults(option_dict))
+        if TABLE_ROWS_HASH_KEY in data:
+            data, date = self._add_cached_rows(entity_name, key, data, date)
         return data, date
 
+    def _add_cached_rows(self, entity_name, key, data, date):
+        '''Returns (data, date) for data cached from a streaming generate
+        function (see _write_streamed_cache), with its table being the cached
+        rows (CachedRows), which are only read from the database as they are
+        used.'''
+        from ckanext.report import model as report_model
+        for attempt in range(2):
+            metadata = report_model.DataCache.get_metadata([(entity_name, key)])[0]
+            created = metadata.created if metadata else None
+            num_rows = report_model.DataCacheRow.count_rows(
+                entity_name, key, created) if metadata else 0
+            if num_rows == data['total_rows']:
+                break
+            # it was regenerated meanwhile - get the data that goes with the
+            # new rows
+            data, date = report_model.DataCache.get(entity_name, key,
+                                                    convert_json=True)
+        return with_table(data, CachedRows(entity_name, key, created,
+                                           data['table_columns'], num_rows)), date
+
+    def refresh_cache_once(self, option_dict):
+        '''Like refresh_cache, but if another process is already generating
+        the report for these options, waits for it to finish and returns its
+        result, rather than generating it again. If the wait exceeds
+        ckanext-report.generation_lock_timeout seconds, the cached data is
+        returned, stale or not, or if there is none, it is generated anyway.
+
+        Returns (data, date)
+        '''
+        from ckanext.report import model as report_model
+        entity_name = extract_entity_name(option_dict)
+        key = self.generate_key(option_dict)
+        date_before = report_model.DataCache.get_date(entity_name, key)
+        timeout = asint(config.get('ckanext-report.generation_lock_timeout',
+                                   GENERATION_LOCK_TIMEOUT))
+        with report_model.generation_lock(key, timeout) as acquired:
+            date = report_model.DataCache.get_date(entity_name, key)
+            generated_meanwhile = date is not None and \
+                (date_before is None or date > date_before)
+            if generated_meanwhile or (date is not None and not acquired):
+                if not acquired:
+                    log.warning('Timed out waiting for report generation - '
+                                'returning cached data: %s', key)
+                data, date = report_model.DataCache.get(
+                    entity_name, key, convert_json=True)
+                if data is not None:
+                    return data, date
+            return self.refresh_cache(option_dict)
+
+    def get_download_artifact(self, format, accept_gzip=False, **option_dict):
+        '''Returns the download of the report in the given format ('csv' or
+        'json') that was made when the cached data was generated (see the
+        download_artifacts info dict key), if the cached data is fresh.
+
+        Returns (content, gzipped), or (None, None) if there is no such
+        download, in which case it should be made from the report data. The
+        gzipped version is preferred if accept_gzip.
+        '''
+        from ckanext.report import lib
+        from ckanext.report import model as report_model
+        formats = [format + '.gz', format] if accept_gzip else [format, format + '.gz']
+        formats = [f for f in formats if f in self.download_artifacts]
+        if not formats or lib.can_anonymise_user_names():
+            return None, None
+        metadata = self._get_fresh_metadata(option_dict)
+        if metadata is None:
+            return None, None
+        entity_name = extract_entity_name(option_dict)
+        key = self.generate_key(option_dict)
+        for format_ in formats:
+            # they are stored with the date the data was written
+            content = report_model.DataCacheArtifact.get(entity_name, key,
+                                                         format_, metadata.created)
+            if content is not None:
+                return content, format_.endswith('.gz')
+        return None, None
+
+    def get_fresh_cached_date(self, option_dict):
+        '''Returns the date that the cached data for the options was written
+        (see get_created_date), if it is fresh enough to be served as it is
+        (checked within max_age), otherwise None. Does not load the data
+        itself.'''
+        metadata = self._get_fresh_metadata(option_dict)
+        return metadata.created if metadata else None
+
+    def get_created_date(self, option_dict):
+        '''Returns the date that the cached data for the options was written,
+        or None if there is none. Unlike the date it was last checked (see
+        DataCache.set_many_if_changed), this only changes when the data does,
+        so it is what HTTP caching validators are made from.'''
+        from ckanext.report import model as report_model
+        metadata = report_model.DataCache.get_metadata(
+            [(extract_entity_name(option_dict), self.generate_key(option_dict))])[0]
+        return metadata.created if metadata else None
+
+    def _get_fresh_metadata(self, option_dict):
+        '''Returns the DataCache metadata (created, checked, dirty) of the
+        cached data for the options if it is fresh, otherwise None.'''
+        from ckanext.report import model as report_model
+        entity_name = extract_entity_name(option_dict)
+        key = self.generate_key(option_dict)
+        metadata = report_model.DataCache.get_metadata([(entity_name, key)])[0]
+        if metadata is None or \
+                datetime.datetime.utcnow() - metadata.checked > self.max_age:
+            return None
+        return metadata
+
+    def add_option_defaults(self, option_dict):
+        '''Returns the option_dict with a value for every one of the report's
+        options, using the default where it is missing.'''
+        options = OrderedDict(self.option_defaults)
+        options.update(option_dict)
+        return options
+
+    def get_due_option_combinations(self, now=None):
+        '''Returns the option combinations whose cached data is older than the
+        report's schedule, has been marked dirty, or is not cached at all.'''
+        from ckanext.report import model as report_model
+        now = now or datetime.datetime.utcnow()
+        option_combinations = self.get_option_combinations()
+        metadata = report_model.DataCache.get_metadata(
+            [(extract_entity_name(option_dict),
+              self.generate_key(option_dict, defaults_for_missing_keys=False))
+             for option_dict in option_combinations])
+        return [option_dict
+                for option_dict, item in zip(option_combinations, metadata)
+                if item is None or item.dirty or
+                now - item.checked >= self.schedule]
+
     def get_cached_date(self, **option_dict):
         from ckanext.report import model as report_model
         if not option_dict:
@@ -166,6 +682,7 @@ class Report(object):
                 'long_description': self.long_description,
                 'description_template': self.description_template,
                 'option_defaults': self.option_defaults,
+                'page_size': self.page_size,
                 'template': self.get_template()}
 
     def is_visible_to_user(self, user):
@@ -175,6 +692,116 @@ class Report(object):
             return True
 
 
+def parse_sort(sort):
+    '''Parses a sort parameter - a column name, optionally followed by " asc"
+    or " desc". Returns (column, descending).'''
+    if not sort:
+        return None, False
+    column, _, direction = sort.strip().rpartition(' ')
+    if direction.lower() not in ('asc', 'desc'):
+        column, direction = sort.strip(), 'asc'
+    return column, direction.lower() == 'desc'
+
+
+def check_columns(columns, filters=None, sort=None):
+    '''Raises ValueError if the filters or sort refer to columns that are not
+    in the table.'''
+    unknown = [column for column in list(filters or []) + ([sort] if sort else [])
+               if column not in columns]
+    if unknown:
+        raise ValueError('Unknown column(s): %s' % ', '.join(unknown))
+
+
+def as_timedelta(value):
+    '''Converts a max_age, schedule or timeout value from a report info dict - a
+    timedelta or a number of seconds - to a timedelta (or None).'''
+    if value is None or isinstance(value, datetime.timedelta):
+        return value
+    return datetime.timedelta(seconds=value)
+
+
+def is_streamed(data):
+    '''Says whether data returned by a report's generate function is a
+    generator (or other iterator) that yields the data, rather than the data
+    itself (see IReport). Data that is a list or any other JSON-able value
+    is not.'''
+    return isinstance(data, Iterator)
+
+
+def with_table(data, rows):
+    '''Returns data cached from a streaming generate function (see
+    Report._write_streamed_cache) as the function gave it, with the given
+    table rows.'''
+    data = OrderedDict((field, value) for field, value in data.items()
+                       if field not in ('total_rows', 'table_columns',
+                                        TABLE_ROWS_HASH_KEY))
+    data['table'] = rows
+    return data
+
+
+class CachedRows(object):
+    '''The table rows cached for a report by Report._write_streamed_cache,
+    read from the database a chunk at a time, each time they are iterated,
+    with their columns in the given order. Indexing or slicing reads just
+    those rows, and len() is the number of rows there were when it was made.
+
+    CKAN's API encodes it as a list, with for_json().'''
+    def __init__(self, entity_name, key, created, columns, num_rows):
+        self.entity_name = entity_name
+        self.key = key
+        self.created = created
+        self.columns = columns
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def __iter__(self):
+        from ckanext.report import model as report_model
+        for row in report_model.DataCacheRow.iter_rows(
+                self.entity_name, self.key, self.created):
+            yield self._with_columns(row)
+
+    def __getitem__(self, index):
+        from ckanext.report import model as report_model
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return [self._with_columns(row) for row in
+                    report_model.DataCacheRow.get_rows(
+                        self.entity_name, self.key, self.created,
+                        start, max(stop - start, 0))]
+        position = index + len(self) if index < 0 else index
+        rows = report_model.DataCacheRow.get_rows(
+            self.entity_name, self.key, self.created, position, 1) \
+            if position >= 0 else []
+        if not rows:
+            raise IndexError('Row index out of range')
+        return self._with_columns(rows[0])
+
+    def query(self, filters=None, search=None, sort=None, descending=False,
+              offset=0, limit=None):
+        '''Returns the rows that match the query, with the number of them
+        (see DataCacheRow.query_rows), which is done by the database.
+
+        Returns (rows, count)
+        '''
+        from ckanext.report import model as report_model
+        rows, count = report_model.DataCacheRow.query_rows(
+            self.entity_name, self.key, self.created, filters=filters,
+            search=search, sort=sort, descending=descending, offset=offset,
+            limit=limit)
+        return [self._with_columns(row) for row in rows], count
+
+    def for_json(self):
+        return list(self)
+
+    def _with_columns(self, row):
+        return OrderedDict((column, row[column]) for column in self.columns
+                           if column in row)
+
+
 def extract_entity_name(option_dict):
     '''Hunts for an option key that is the entity name and returns its
     value. Used in the DataCache storage.'''
@@ -218,10 +845,498 @@ class ReportRegistry(object):
     def get_report(self, report_name):
         return self._reports[report_name]
 
-    def refresh_cache_for_all_reports(self):
-        '''Generates all the reports for all the option combinations and caches them.'''
+    def get_fresh_reports(self, report_options):
+        '''Like Report.get_fresh_report, but for a list of
+        (report_name, option_dict), looking up the cached data for all of them
+        together. Any that are not cached are generated.
+
+        Returns a list of (data, date) in the same order.
+        '''
+        from ckanext.report import model as report_model
+        reports = [(self.get_report(report_name), option_dict)
+                   for report_name, option_dict in report_options]
+        cached = report_model.DataCache.get_many(
+            [(extract_entity_name(option_dict), report.generate_key(option_dict))
+             for report, option_dict in reports],
+            convert_json=True)
+        now = datetime.datetime.utcnow()
+        results = []
+        for (report, option_dict), (data, date) in zip(reports, cached):
+            if data is None or now - date > report.max_age:
+                data, date = report.get_fresh_report(**option_dict)
+            elif TABLE_ROWS_HASH_KEY in data:
+                data, date = report._add_cached_rows(
+                    extract_entity_name(option_dict),
+                    report.generate_key(option_dict), data, date)
+            results.append((data, date))
+        return results
+
+    def mark_organization_reports_dirty(self, organization):
+        '''Marks the cached data as dirty (see DataCache.mark_dirty) for the
+        reports with invalidate_on_change set, for the given organization (an
+        object, name or id), the organizations above it in the hierarchy, and
+        for all organizations.'''
+        from ckanext.report import lib
+        from ckanext.report import model as report_model
+        report_names = [report.name for report in self._reports.values()
+                        if report.invalidate_on_change]
+        if not report_names:
+            return
+        object_ids = lib.organization_and_ancestor_names(organization) + [None]
+        report_model.DataCache.mark_dirty(object_ids, report_names)
+
+    def get_due_combinations(self):
+        '''Returns (report_name, option_dict) for every option combination of
+        every report that is due to be regenerated, according to the report's
+        schedule.'''
+        now = datetime.datetime.utcnow()
+        return [(report.name, option_dict)
+                for report in self._reports.values()
+                for option_dict in report.get_due_option_combinations(now)]
+
+    def refresh_cache_for_combinations(self, combinations, workers=1, stats=None,
+                                       batch_size=1, batch_megabytes=None,
+                                       atomic=False, run=None):
+        '''Generates the given (report_name, option_dict) combinations and
+        caches them. A combination that fails is logged and the others carry
+        on. Returns a list of the failures (see refresh_cache_in_pool).
+
+        For batch_size, batch_megabytes and atomic (which commits each
+        report's combinations together), see
+        Report.refresh_cache_for_all_options. If run (a GenerationRun) is
+        given, each combination is recorded in it as done or failed, as soon
+        as it is committed.
+        '''
+        if workers > 1:
+            if atomic:
+                raise ValueError('Cannot commit the combinations atomically '
+                                 'when they are spread over several workers')
+            return refresh_cache_in_pool(combinations, workers, stats=stats,
+                                         batch_size=batch_size,
+                                         batch_megabytes=batch_megabytes,
+                                         run=run)
+        failures = []
+        if batch_size <= 1 and not atomic:
+            for combination in combinations:
+                failures.extend(record_results(
+                    [_refresh_cache_catching_errors(combination)], stats, run))
+            return failures
+        for report_name, report_combinations in itertools.groupby(
+                combinations, key=lambda combination: combination[0]):
+            report = self.get_report(report_name)
+            batch = CacheBatch(batch_size=None if atomic else batch_size,
+                               batch_megabytes=batch_megabytes,
+                               commit=not atomic)
+            for report_name_, option_dict in report_combinations:
+                batch.refresh(report, option_dict)
+                if not atomic:
+                    # (recording them commits)
+                    failures.extend(record_results(batch.pop_results(), stats, run))
+            batch.finish()
+            failures.extend(record_results(batch.pop_results(), stats, run))
+        return failures
+
+    def refresh_cache_for_all_reports(self, workers=1, stats=None,
+                                      batch_size=1, batch_megabytes=None,
+                                      atomic=False):
+        '''Generates all the reports for all the option combinations and caches them.
+
+        If workers > 1 then the combinations of all the reports are spread over
+        a pool of that many processes. Returns a list of the failures. If
+        stats (a Counter) is given, the combinations that were changed and
+        unchanged are counted in it. For batch_size, batch_megabytes and
+        atomic (which commits each report's combinations together), see
+        Report.refresh_cache_for_all_options.
+        '''
+        if workers <= 1:
+            failures = []
+            for report in self._reports.values():
+                failures.extend(report.refresh_cache_for_all_options(
+                    stats=stats, batch_size=batch_size,
+                    batch_megabytes=batch_megabytes, atomic=atomic))
+            return failures
+        if atomic:
+            raise ValueError('Cannot commit the combinations atomically '
+                             'when they are spread over several workers')
+        jobs = []
         for report in self._reports.values():
-            report.refresh_cache_for_all_options()
+            log.info('Report: %s %s', report.plugin, report.name)
+            jobs.extend((report.name, option_dict)
+                        for option_dict in report.get_option_combinations())
+        return refresh_cache_in_pool(jobs, workers, stats=stats,
+                                     batch_size=batch_size,
+                                     batch_megabytes=batch_megabytes)
+
+    def enqueue_combinations(self, combinations, report_names):
+        '''Queues the given (report_name, option_dict) combinations for
+        "ckan report worker" processes to generate, as a GenerationRun of the
+        given report names. Combinations that are already queued are skipped.
+
+        Returns the number queued.
+        '''
+        from ckanext.report import model as report_model
+        queued_keys = report_model.GenerationRun.get_queued_keys()
+        items = []
+        for report_name, option_dict in combinations:
+            key = self.get_report(report_name).generate_key(
+                option_dict, defaults_for_missing_keys=False)
+            if key not in queued_keys:
+                items.append((report_name, key, option_dict))
+        if items:
+            report_model.GenerationRun.start(report_names, items, queued=True)
+        return len(items)
+
+
+def refresh_cache_for_queue(worker_id, claim=1, stats=None):
+    '''Claims up to claim of the queued option combinations (see
+    ReportRegistry.enqueue_combinations) for the worker, generates them and
+    records them as done or failed. The claim is renewed while they are
+    generated, and if the worker dies it expires after ckanext-report.worker_lease
+    seconds, for another worker to claim them. If stats (a Counter) is given,
+    the combinations are counted in it (see record_results).
+
+    Returns the number of combinations claimed - 0 if there were none queued.
+    '''
+    from ckanext.report import model as report_model
+    lease_seconds = asint(config.get('ckanext-report.worker_lease', WORKER_LEASE))
+    max_attempts = asint(config.get('ckanext-report.worker_max_attempts',
+                                    WORKER_MAX_ATTEMPTS))
+    items = report_model.GenerationRun.claim(worker_id, lease_seconds,
+                                             limit=claim, max_attempts=max_attempts)
+    if not items:
+        return 0
+    with report_model.lease_heartbeat(worker_id, [item[0] for item in items],
+                                      lease_seconds):
+        for item_id, report_name, option_dict in items:
+            result = _refresh_cache_catching_errors((report_name, option_dict))
+            record_results([result], stats)
+            report_model.GenerationRun.complete(item_id, worker_id, result[2])
+    return len(items)
+
+
+class CacheBatch(object):
+    '''Generates report option combinations and writes their data to the
+    cache in batches - each with one bulk upsert (see
+    DataCache.set_many_if_changed) and one commit, rather than a commit per
+    combination.
+
+    The data is buffered until there are batch_size combinations, or
+    batch_megabytes of it encoded as JSON (either may be None, for no limit),
+    or finish() is called. Each combination is generated inside a savepoint,
+    so one that fails is rolled back without losing the rest of the batch.
+    If the batch can't be written in one go, its combinations are written
+    one by one, each in a savepoint, so only the failing one is lost.
+
+    If commit is False, the batches are written but only committed by
+    finish(), so readers see all the combinations change together.
+
+    results has (report_name, option_dict, traceback_str or None, changed) for
+    each combination, once it is committed or has failed.
+    '''
+    def __init__(self, batch_size=None, batch_megabytes=None, commit=True):
+        self.batch_size = batch_size
+        self.batch_bytes = batch_megabytes * 1024 * 1024 \
+            if batch_megabytes else None
+        self.commit = commit
+        self.results = []
+        self._entries = []
+        self._bytes = 0
+        self._uncommitted = []
+
+    def refresh(self, report, option_dict):
+        '''Generates the report for the options and adds its data to the
+        batch, writing the batch if it is now full.'''
+        if any(report.get_generation_limits()):
+            if self.commit:
+                # (the subprocess needs the batch committed)
+                self.flush()
+                try:
+                    changed = report.refresh_cache_supervised(option_dict)
+                except Exception:
+                    self._failed(report, option_dict)
+                    return
+                self.results.append((report.name, option_dict, None, changed))
+                return
+            log.warning('Report %s has time or memory limits, which are not '
+                        'applied when committing atomically', report.name)
+        log.info('  Gen for options: %r', option_dict)
+        streamed = False
+        try:
+            entity_name, key = report._cache_key(option_dict)
+            with model.Session.begin_nested():
+                data = report.generate(**option_dict)
+                if is_streamed(data):
+                    # it is written as it is generated, rather than buffered,
+                    # and committed with the batch
+                    streamed = True
+                    data, date, changed = report._write_streamed_cache(
+                        entity_name, key, data)
+            if not streamed:
+                items, rows = report._prepare_cache(entity_name, key, data)
+        except Exception:
+            self._failed(report, option_dict)
+            return
+        if streamed:
+            self._uncommitted.append(
+                ((report, option_dict, entity_name, key), changed))
+            return
+        self._entries.append(
+            (report, option_dict, entity_name, key, data, items, rows))
+        self._bytes += sum(len(value) for object_id, key_, value in items)
+        if (self.batch_size and len(self._entries) >= self.batch_size) or \
+                (self.batch_bytes and self._bytes >= self.batch_bytes):
+            self.flush()
+
+    def flush(self):
+        '''Writes the buffered data to the cache, and commits it (unless
+        commit is False).'''
+        from ckanext.report import model as report_model
+        entries, self._entries, self._bytes = self._entries, [], 0
+        if entries:
+            log.info('  Writing batch of %s', len(entries))
+            try:
+                with model.Session.begin_nested():
+                    date, changed = report_model.DataCache.set_many_if_changed(
+                        [item for entry in entries for item in entry[5]])
+                    written = [(entry, self._write_extras(entry, date, changed))
+                               for entry in entries]
+            except Exception:
+                log.warning('Batch write failed - writing its %s combinations '
+                            'one by one', len(entries), exc_info=True)
+                written = []
+                for entry in entries:
+                    try:
+                        with model.Session.begin_nested():
+                            date, changed = report_model.DataCache \
+                                .set_many_if_changed(entry[5])
+                            written.append(
+                                (entry, self._write_extras(entry, date, changed)))
+                    except Exception:
+                        self._failed(entry[0], entry[1])
+            self._uncommitted.extend(written)
+        if self.commit:
+            self._commit()
+
+    def finish(self):
+        '''Writes and commits whatever is left in the batch.'''
+        self.flush()
+        self._commit()
+
+    def pop_results(self):
+        '''Returns the results so far, and removes them from the batch.'''
+        results, self.results = self.results, []
+        return results
+
+    def abort(self):
+        '''To call when an exception has been raised writing the batch: rolls
+        back whatever is uncommitted, and records those combinations as
+        failed.'''
+        model.Session.rollback()
+        for entry in self._entries + [entry for entry, changed in self._uncommitted]:
+            self._failed(entry[0], entry[1])
+        self._entries, self._bytes, self._uncommitted = [], 0, []
+
+    def _write_extras(self, entry, date, changed):
+        report, option_dict, entity_name, key, data, items, rows = entry
+        return report._write_cache_extras(entity_name, key, data, rows,
+                                          date, changed)
+
+    def _commit(self):
+        model.Session.commit()
+        for entry, changed in self._uncommitted:
+            report, option_dict, entity_name, key = entry[:4]
+            report._cache_written(entity_name, key, changed)
+            self.results.append((report.name, option_dict, None, changed))
+        self._uncommitted = []
+
+    def _failed(self, report, option_dict):
+        self.results.append(
+            (report.name, option_dict, traceback.format_exc(), False))
+
+
+def record_results(results, stats=None, run=None):
+    '''Logs the failures among the (report_name, option_dict, traceback_str
+    or None, changed) results, and counts and records all of them in stats
+    and run (committed), if given. Returns the failures, without 'changed'.
+    '''
+    failures = []
+    for report_name, option_dict, error, changed in results:
+        if error:
+            log.error('Report %s failed for options %r:\n%s',
+                      report_name, option_dict, error)
+            failures.append((report_name, option_dict, error))
+            if stats is not None:
+                stats['failed'] += 1
+        elif stats is not None:
+            stats['changed' if changed else 'unchanged'] += 1
+        if run is not None:
+            key = ReportRegistry.instance().get_report(report_name) \
+                .generate_key(option_dict, defaults_for_missing_keys=False)
+            run.set_state(key, 'failed' if error else 'done', error)
+    if run is not None and results:
+        model.Session.commit()
+    return failures
+
+
+def refresh_cache_in_pool(jobs, workers, stats=None, batch_size=1,
+                          batch_megabytes=None, run=None):
+    '''Runs Report.refresh_cache for each of the (report_name, option_dict)
+    jobs, in a pool of worker processes.
+
+    Each worker opens its own database connections. A job that raises is
+    logged and skipped, so one bad combination does not stop the rest. If
+    stats (a Counter) is given, the jobs whose data was changed and unchanged
+    are counted in it. If batch_size > 1, the workers are given the jobs in
+    batches of that many, which they write with a CacheBatch. If run (a
+    GenerationRun) is given, the results are recorded in it as they come in.
+
+    Returns a list of (report_name, option_dict, traceback_str) for the jobs
+    that failed.
+    '''
+    import multiprocessing
+    # Forked workers would otherwise share the parent's pooled connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+    failures = []
+    if batch_size > 1:
+        jobs = list(jobs)
+        tasks = [(jobs[i:i + batch_size], batch_megabytes)
+                 for i in range(0, len(jobs), batch_size)]
+        run_task = _refresh_cache_batch_catching_errors
+    else:
+        tasks = jobs
+        run_task = _refresh_cache_catching_errors
+    pool = multiprocessing.get_context('fork').Pool(
+        workers, initializer=_init_pool_worker)
+    try:
+        for results in pool.imap_unordered(run_task, tasks):
+            if batch_size <= 1:
+                results = [results]
+            failures.extend(record_results(results, stats, run))
+    finally:
+        pool.close()
+        pool.join()
+    return failures
+
+
+def _init_pool_worker():
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _refresh_cache_batch_catching_errors(task):
+    '''Returns a list of (report_name, option_dict, traceback_str or None,
+    changed)'''
+    jobs, batch_megabytes = task
+    registry = ReportRegistry.instance()
+    batch = CacheBatch(batch_megabytes=batch_megabytes)
+    try:
+        for i, (report_name, option_dict) in enumerate(jobs):
+            batch.refresh(registry.get_report(report_name), option_dict)
+        batch.finish()
+    except Exception:
+        batch.abort()
+        error = traceback.format_exc()
+        batch.results.extend((report_name, option_dict, error, False)
+                             for report_name, option_dict in jobs[i + 1:])
+    finally:
+        model.Session.remove()
+    return batch.results
+
+
+def _refresh_cache_catching_errors(job):
+    '''Returns (report_name, option_dict, traceback_str or None, changed)'''
+    report_name, option_dict = job
+    try:
+        changed = ReportRegistry.instance().get_report(report_name) \
+            .refresh_cache_supervised(option_dict)
+    except Exception:
+        model.Session.rollback()
+        return report_name, option_dict, traceback.format_exc(), False
+    finally:
+        model.Session.remove()
+    return report_name, option_dict, None, changed
+
+
+class GenerationFailed(Exception):
+    '''Raised when generating a report in a subprocess fails or is killed
+    (see run_in_subprocess).'''
+    pass
+
+
+def run_in_subprocess(func, timeout=None, memory_limit=None):
+    '''Calls func() in a forked subprocess and returns its result, which must
+    be picklable.
+
+    If it takes longer than timeout seconds, the subprocess is killed. The
+    subprocess's address space can grow by memory_limit bytes beyond what it
+    starts with (inherited from this process), so allocating more raises
+    MemoryError. If func raises, or the subprocess is killed or dies,
+    GenerationFailed is raised, with the traceback from the subprocess.
+    '''
+    import os
+    import pickle
+    import resource
+    import select
+    import signal
+    import time
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the subprocess - it must not return to the caller's code
+        status = 1
+        try:
+            os.close(read_fd)
+            if memory_limit:
+                limit = _address_space_size() + memory_limit
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+            try:
+                result = (None, func())
+            except BaseException:
+                result = (traceback.format_exc(), None)
+            with os.fdopen(write_fd, 'wb') as pipe:
+                pipe.write(pickle.dumps(result))
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    deadline = time.time() + timeout if timeout else None
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                raise GenerationFailed('Timed out after %s seconds' % timeout)
+            readable, _, _ = select.select([read_fd], [], [], remaining)
+            if readable:
+                chunk = os.read(read_fd, 64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+    pid, status = os.waitpid(pid, 0)
+    if not chunks:
+        raise GenerationFailed('The subprocess died (wait status %s)' % status)
+    error, result = pickle.loads(b''.join(chunks))
+    if error:
+        raise GenerationFailed(error)
+    return result
+
+
+def _address_space_size():
+    '''Returns the size of this process's address space (as limited by
+    RLIMIT_AS) in bytes, or 0 if it is not known (without /proc).'''
+    import os
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
 
 #    'name': 'feedback-report',
 #    'option_combinations': nii_report_combinations,
@@ -79,4 +79,7 @@ tagless_report_info = {
     'option_combinations': tagless_report_option_combinations,
     'generate': tagless_report,
     'template': 'report/tagless-datasets.html',
+    'invalidate_on_change': True,
+    'download_artifacts': ('csv', 'json.gz'),
+    'page_size': 100,
 }
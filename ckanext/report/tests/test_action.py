@@ -0,0 +1,133 @@
+import datetime
+
+import pytest
+from ckan.tests import factories, helpers
+import ckanext.report.model as report_model
+from ckanext.report.report_registry import ReportRegistry
+
+
+@pytest.fixture
+def report_setup():
+    report_model.init_tables()
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestReportDataGetMany(object):
+
+    def test_returns_each_item(self):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+
+        results = helpers.call_action(u'report_data_get_many', items=[
+            {u'id': u'tagless-datasets'},
+            {u'id': u'tagless-datasets',
+             u'options': {u'organization': org['name'],
+                          u'include_sub_organizations': False}},
+        ])
+
+        assert len(results) == 2
+        all_data, all_date = results[0]
+        org_data, org_date = results[1]
+        assert all_data['num_packages'] == 1
+        assert org_data['num_packages'] == 1
+
+    def test_unknown_report(self):
+        from ckan.plugins import toolkit as tk
+        with pytest.raises(tk.ObjectNotFound):
+            helpers.call_action(u'report_data_get_many',
+                                items=[{u'id': u'not-a-report'}])
+
+    def test_item_not_a_dict(self):
+        from ckan.plugins import toolkit as tk
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(u'report_data_get_many',
+                                items=[u'tagless-datasets'])
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestReportDataGet(object):
+
+    def test_offset_and_limit(self):
+        for _ in range(3):
+            factories.Dataset()
+
+        data, date = helpers.call_action(u'report_data_get', id=u'tagless-datasets',
+                                         offset=2, limit=5)
+
+        assert data['total_rows'] == 3
+        assert len(data['table']) == 1
+
+    def test_bad_limit(self):
+        from ckan.plugins import toolkit as tk
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(u'report_data_get', id=u'tagless-datasets',
+                                limit=u'-1')
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.ckan_config(u'ckanext-report.job_queue', u'sync')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestReportRefresh(object):
+
+    def test_returns_job_id(self):
+        factories.Dataset()
+
+        result = helpers.call_action(u'report_refresh', id=u'tagless-datasets')
+
+        assert result[u'job_id'].startswith(u'report-refresh-')
+        # with the sync job queue the refresh is done straight away
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        assert report.get_cached_date() is not None
+
+    def test_same_options_share_a_job(self):
+        first = helpers.call_action(u'report_refresh', id=u'tagless-datasets')
+        second = helpers.call_action(u'report_refresh', id=u'tagless-datasets',
+                                     options={u'include_sub_organizations': False})
+
+        assert first[u'job_id'] == second[u'job_id']
+
+    def test_status(self):
+        job_id = helpers.call_action(u'report_refresh',
+                                     id=u'tagless-datasets')[u'job_id']
+
+        result = helpers.call_action(u'report_refresh_status', job_id=job_id)
+
+        # with the sync job queue there are no jobs to look up
+        assert result[u'status'] == u'unknown'
+
+    def test_status_of_other_job(self):
+        from ckan.plugins import toolkit as tk
+        with pytest.raises(tk.ObjectNotFound):
+            helpers.call_action(u'report_refresh_status', job_id=u'some-job')
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestReportRefreshStatus(object):
+
+    def test_unknown_job(self):
+        result = helpers.call_action(u'report_refresh_status',
+                                     job_id=u'report-refresh-%s' % (u'0' * 40))
+
+        assert result[u'status'] == u'unknown'
+
+    def test_job_id_must_be_a_string(self):
+        from ckan.plugins import toolkit as tk
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action(u'report_refresh_status', job_id=[u'report-refresh-'])
+
+    def test_job_is_given_the_report_timeout(self, monkeypatch):
+        from ckanext.report import jobs
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'timeout', datetime.timedelta(seconds=600))
+        enqueued = []
+        monkeypatch.setattr(jobs.toolkit, u'enqueue_job',
+                            lambda *args, **kwargs: enqueued.append(kwargs))
+
+        job_id = jobs.enqueue_refresh(report, report.add_option_defaults({}))
+        jobs._connect_to_redis().delete(jobs._claim_key(job_id))
+
+        assert enqueued[0][u'rq_kwargs'][u'timeout'] == \
+            600 + jobs.REFRESH_JOB_TIMEOUT_MARGIN
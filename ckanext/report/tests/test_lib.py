@@ -0,0 +1,93 @@
+import pytest
+from ckan import model
+from ckan.tests import factories
+from ckanext.report import lib
+
+
+@pytest.fixture
+def organization_tree():
+    parent = factories.Organization()
+    child = factories.Organization(groups=[{u'name': parent['name']}])
+    grandchild = factories.Organization(groups=[{u'name': child['name']}])
+    other = factories.Organization()
+    return parent, child, grandchild, other
+
+
+@pytest.mark.usefixtures(u'clean_db')
+class TestOrganizationHierarchy(object):
+
+    def test_descendant_ids(self, organization_tree):
+        parent, child, grandchild, other = organization_tree
+
+        assert lib.get_organization_and_descendant_ids(parent['id']) == \
+            sorted([parent['id'], child['id'], grandchild['id']])
+        assert lib.get_organization_and_descendant_ids(grandchild['id']) == \
+            [grandchild['id']]
+
+    def test_descendant_ids_for_run(self, organization_tree):
+        parent, child, grandchild, other = organization_tree
+
+        with lib.organization_hierarchy_for_run() as hierarchy:
+            assert hierarchy.get_organization_and_descendant_ids(child['id']) == \
+                sorted([child['id'], grandchild['id']])
+            assert lib.get_organization_and_descendant_ids(parent['id']) == \
+                sorted([parent['id'], child['id'], grandchild['id']])
+
+    def test_filter_by_organizations(self, organization_tree):
+        parent, child, grandchild, other = organization_tree
+        dataset = factories.Dataset(owner_org=grandchild['id'])
+        factories.Dataset(owner_org=other['id'])
+
+        query = lib.filter_by_organizations(model.Session.query(model.Package),
+                                            parent['name'], True)
+
+        assert [pkg.id for pkg in query] == [dataset['id']]
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins')
+class TestGetAllOrganizations(object):
+
+    def test_only_orgs_with_active_packages(self):
+        org_with_dataset = factories.Organization(title=u'A')
+        org_with_deleted_dataset = factories.Organization(title=u'B')
+        factories.Organization(title=u'C')
+        factories.Dataset(owner_org=org_with_dataset['id'])
+        factories.Dataset(owner_org=org_with_deleted_dataset['id'],
+                          state=u'deleted')
+
+        all_orgs = list(lib.get_all_organizations())
+        orgs_with_packages = list(lib.get_all_organizations(only_orgs_with_packages=True))
+
+        assert [org['title'] for org in all_orgs] == [u'A', u'B', u'C']
+        assert [org['name'] for org in orgs_with_packages] == \
+            [org_with_dataset['name']]
+
+    def test_cache_cleared_when_organization_created(self):
+        factories.Organization(title=u'A')
+        assert len(list(lib.get_all_organizations())) == 1
+
+        factories.Organization(title=u'B')
+
+        assert len(list(lib.get_all_organizations())) == 2
+
+
+class TestFilterAndSortRows(object):
+
+    def test_filter_numeric_column(self):
+        rows = [{u'name': u'a', u'count': 5}, {u'name': u'b', u'count': 50}]
+
+        assert lib.filter_and_sort_rows(rows, filters={u'count': u'5'}) == \
+            [{u'name': u'a', u'count': 5}]
+
+    def test_sort_column_with_none(self):
+        rows = [{u'name': u'a', u'count': 10}, {u'name': u'b', u'count': None},
+                {u'name': u'c', u'count': 9}, {u'name': u'd'},
+                {u'name': u'e', u'count': u'n/a'}]
+
+        assert [row[u'name'] for row in
+                lib.filter_and_sort_rows(rows, sort=u'count')] == \
+            [u'e', u'c', u'a', u'b', u'd']
+        assert [row[u'name'] for row in
+                lib.filter_and_sort_rows(rows, sort=u'count', descending=True)] == \
+            [u'a', u'c', u'e', u'b', u'd']
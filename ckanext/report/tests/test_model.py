@@ -0,0 +1,324 @@
+import datetime
+import json
+import pytest
+from ckan import model
+import ckanext.report.model as report_model
+from ckanext.report.model import DataCache, DecodedValueCache, GenerationRun, decoded_size
+
+
+@pytest.fixture
+def report_setup():
+    report_model.init_tables()
+
+
+@pytest.mark.usefixtures(u'clean_db', u'report_setup')
+class TestDataCache(object):
+
+    def test_set_and_get(self):
+        DataCache.set(u'org1', u'count', u'2112')
+
+        value, date = DataCache.get(u'org1', u'count')
+
+        assert value == u'2112'
+        assert date
+
+    def test_set_updates_existing(self):
+        DataCache.set(u'org1', u'report', {u'a': 1}, convert_json=True)
+        DataCache.set(u'org1', u'report', {u'a': 2}, convert_json=True)
+
+        value, date = DataCache.get(u'org1', u'report', convert_json=True)
+
+        assert value == {u'a': 2}
+        assert model.Session.query(DataCache).count() == 1
+
+    def test_set_updates_existing_without_object_id(self):
+        DataCache.set(None, u'report', u'1')
+        DataCache.set(None, u'report', u'2')
+
+        assert DataCache.get(None, u'report')[0] == u'2'
+        assert model.Session.query(DataCache).count() == 1
+
+    def test_set_many(self):
+        DataCache.set(u'org1', u'report', u'old')
+
+        DataCache.set_many([(u'org1', u'report', u'new'),
+                            (u'org2', u'report', u'other'),
+                            (u'org2', u'report', u'latest')])
+
+        assert DataCache.get(u'org1', u'report')[0] == u'new'
+        assert DataCache.get(u'org2', u'report')[0] == u'latest'
+        assert model.Session.query(DataCache).count() == 2
+
+    def test_get_many(self):
+        DataCache.set(u'org1', u'report', {u'a': 1}, convert_json=True)
+        DataCache.set(None, u'report', {u'a': 2}, convert_json=True)
+
+        results = DataCache.get_many([(None, u'report'),
+                                      (u'org2', u'report'),
+                                      (u'org1', u'report')],
+                                     convert_json=True)
+
+        assert [value for value, date in results] == \
+            [{u'a': 2}, None, {u'a': 1}]
+
+    @pytest.mark.ckan_config(u'ckanext-report.cache_compression', u'zlib')
+    def test_set_compressed(self):
+        DataCache.set(u'org1', u'report', {u'a': [1, 2]}, convert_json=True)
+
+        item = model.Session.query(DataCache).one()
+        assert item.compression == u'zlib'
+        assert item.value is None
+        value, date = DataCache.get(u'org1', u'report', convert_json=True)
+        assert value == {u'a': [1, 2]}
+
+    def test_get_decoded_value_from_memory(self):
+        DataCache.set(u'org1', u'report', {u'a': 1}, convert_json=True)
+        value, date = DataCache.get(u'org1', u'report', convert_json=True)
+        value[u'a'] = 5  # must not change the copy held in memory
+
+        assert DataCache.get(u'org1', u'report', convert_json=True)[0] == {u'a': 1}
+
+        DataCache.set(u'org1', u'report', {u'a': 2}, convert_json=True)
+
+        assert DataCache.get(u'org1', u'report', convert_json=True)[0] == {u'a': 2}
+
+    def test_unchanged_value_is_written_with_changed_compression(self, ckan_config, monkeypatch):
+        DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})], convert_json=True)
+        monkeypatch.setitem(ckan_config, u'ckanext-report.cache_compression', u'zlib')
+
+        date, changed = DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})],
+                                                      convert_json=True)
+
+        assert changed == [(u'org1', u'report')]
+        assert model.Session.query(DataCache).one().compression == u'zlib'
+        assert DataCache.get(u'org1', u'report', convert_json=True)[0] == {u'a': 1}
+
+
+@pytest.fixture
+def filesystem_backend(ckan_config, monkeypatch, tmp_path):
+    monkeypatch.setitem(ckan_config, u'ckanext-report.cache_backend', u'filesystem')
+    monkeypatch.setitem(ckan_config, u'ckanext-report.cache_directory', str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.usefixtures(u'clean_db', u'report_setup', u'filesystem_backend')
+class TestDataCacheFilesystemBackend(object):
+
+    def test_set_and_get(self, filesystem_backend):
+        DataCache.set(u'org1', u'report', {u'a': [1, 2]}, convert_json=True)
+
+        item = model.Session.query(DataCache).one()
+        assert item.storage == u'filesystem'
+        assert item.value is None
+        assert len(list(filesystem_backend.glob(u'*/*.value'))) == 1
+        value, date = DataCache.get(u'org1', u'report', convert_json=True)
+        assert value == {u'a': [1, 2]}
+
+    @pytest.mark.ckan_config(u'ckanext-report.cache_compression', u'zlib')
+    def test_set_compressed(self):
+        DataCache.set(None, u'report', {u'a': 1}, convert_json=True)
+        DataCache.set(None, u'report', {u'a': 2}, convert_json=True)
+
+        assert DataCache.get(None, u'report', convert_json=True)[0] == {u'a': 2}
+
+    def test_keeps_two_versions(self, filesystem_backend):
+        for i in range(3):
+            DataCache.set(u'org1', u'report', {u'a': i}, convert_json=True)
+
+        assert len(list(filesystem_backend.glob(u'*/*.value'))) == 2
+
+    def test_failed_writes_keep_the_committed_version(self):
+        DataCache.set(u'org1', u'report', {u'a': 0}, convert_json=True)
+        model.Session.commit()
+        for i in range(1, 4):
+            DataCache.set(u'org1', u'report', {u'a': i}, convert_json=True)
+            model.Session.rollback()
+
+        assert DataCache.get(u'org1', u'report', convert_json=True)[0] == {u'a': 0}
+
+    def test_missing_file_is_not_cached(self, filesystem_backend):
+        DataCache.set(u'org1', u'report', {u'a': 1}, convert_json=True)
+        for path in filesystem_backend.glob(u'*/*.value'):
+            path.unlink()
+
+        assert DataCache.get(u'org1', u'report', convert_json=True) == (None, None)
+
+    def test_missing_file_is_written_again(self, filesystem_backend):
+        DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})], convert_json=True)
+        for path in filesystem_backend.glob(u'*/*.value'):
+            path.unlink()
+
+        date, changed = DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})],
+                                                      convert_json=True)
+
+        assert changed == [(u'org1', u'report')]
+        assert DataCache.get(u'org1', u'report', convert_json=True)[0] == {u'a': 1}
+
+    def test_unchanged_value_is_moved_to_the_configured_backend(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, u'ckanext-report.cache_backend', u'sql')
+        DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})], convert_json=True)
+        monkeypatch.setitem(ckan_config, u'ckanext-report.cache_backend', u'filesystem')
+
+        date, changed = DataCache.set_many_if_changed([(u'org1', u'report', {u'a': 1})],
+                                                      convert_json=True)
+
+        assert changed == [(u'org1', u'report')]
+        assert model.Session.query(DataCache).one().storage == u'filesystem'
+
+
+@pytest.mark.usefixtures(u'clean_db', u'report_setup')
+class TestGenerationRun(object):
+
+    def test_records_states(self):
+        run = GenerationRun.start([u'test-report'], [
+            (u'test-report', u'test-report?org=a', {u'org': u'a'}),
+            (u'test-report', u'test-report?org=b', {u'org': u'b'}),
+            (u'test-report', u'test-report?org=c', {u'org': u'c'})])
+
+        run.set_state(u'test-report?org=a', u'done')
+        run.set_state(u'test-report?org=b', u'failed', u'Traceback...')
+        model.Session.commit()
+
+        assert run.get_combinations() == [(u'test-report', {u'org': u'b'}),
+                                          (u'test-report', {u'org': u'c'})]
+        assert run.get_failures() == [(u'test-report', {u'org': u'b'},
+                                       u'Traceback...')]
+        assert run.count_states() == {u'done': 1, u'failed': 1, u'pending': 1}
+
+    def test_get_interrupted(self):
+        run = GenerationRun.start([u'test-report'], [])
+
+        assert GenerationRun.get_interrupted([u'test-report']).id == run.id
+        assert GenerationRun.get_interrupted([u'other-report']) is None
+
+        run.finish()
+        assert GenerationRun.get_interrupted([u'test-report']) is None
+
+    def test_old_unfinished_runs_are_deleted(self):
+        crashed = GenerationRun.start([u'test-report'], [
+            (u'test-report', u'test-report?org=a', {u'org': u'a'})])
+        crashed.started -= report_model.GENERATION_RUN_MAX_AGE
+        model.Session.commit()
+        for i in range(report_model.GENERATION_RUNS_KEPT):
+            GenerationRun.start([u'test-report'], []).finish()
+
+        assert model.Session.query(GenerationRun).filter_by(id=crashed.id).count() == 0
+        assert model.Session.query(GenerationRun).count() == \
+            report_model.GENERATION_RUNS_KEPT
+
+    def test_options_that_are_not_json(self):
+        run = GenerationRun.start([u'test-report'], [
+            (u'test-report', u'test-report?date=2020-01-02',
+             {u'date': datetime.date(2020, 1, 2)})])
+
+        assert run.get_combinations() == [(u'test-report', {u'date': u'2020-01-02'})]
+        assert run.get_keys() == {u'test-report?date=2020-01-02'}
+
+    def test_queued_options_must_be_json(self):
+        with pytest.raises(ValueError):
+            GenerationRun.start([u'test-report'], [
+                (u'test-report', u'test-report?dates=2020,2021',
+                 {u'dates': (2020, 2021)})], queued=True)
+
+
+@pytest.mark.usefixtures(u'clean_db', u'report_setup')
+class TestGenerationQueue(object):
+
+    def _enqueue(self, *orgs):
+        return GenerationRun.start([u'test-report'], [
+            (u'test-report', u'test-report?org=%s' % org, {u'org': org})
+            for org in orgs], queued=True)
+
+    def test_claim_and_complete(self):
+        self._enqueue(u'a', u'b')
+
+        claimed = GenerationRun.claim(u'worker1', 60)
+        other_claimed = GenerationRun.claim(u'worker2', 60, limit=10)
+        assert [options for item_id, report_name, options in claimed] == \
+            [{u'org': u'a'}]
+        assert [options for item_id, report_name, options in other_claimed] == \
+            [{u'org': u'b'}]
+        assert GenerationRun.claim(u'worker3', 60) == []
+
+        GenerationRun.complete(claimed[0][0], u'worker1')
+        GenerationRun.complete(other_claimed[0][0], u'worker2', u'Traceback...')
+        GenerationRun.finish_completed()
+        assert GenerationRun.get_queued_keys() == set()
+
+    def test_expired_lease_is_reclaimed(self):
+        self._enqueue(u'a')
+        claimed = GenerationRun.claim(u'worker1', -1)
+
+        reclaimed = GenerationRun.claim(u'worker2', 60)
+
+        assert [item[0] for item in reclaimed] == [claimed[0][0]]
+        # the first worker's lease has gone
+        GenerationRun.complete(claimed[0][0], u'worker1', u'Too late')
+        assert GenerationRun.get_queued_keys() == {u'test-report?org=a'}
+
+    def test_gives_up_after_max_attempts(self):
+        run = self._enqueue(u'a')
+        GenerationRun.claim(u'worker1', -1, max_attempts=1)
+
+        assert GenerationRun.claim(u'worker2', 60, max_attempts=1) == []
+        assert [options for report_name, options, error in run.get_failures()] == \
+            [{u'org': u'a'}]
+
+    def test_forks_while_renewing_leases(self):
+        from ckanext.report.report_registry import run_in_subprocess
+        self._enqueue(u'a')
+        claimed = GenerationRun.claim(u'worker1', 60)
+        model.Session.commit()
+
+        # the heartbeat renews every 0.02 seconds
+        with report_model.lease_heartbeat(u'worker1', [claimed[0][0]], 0.06):
+            results = [run_in_subprocess(lambda: 42, timeout=30)
+                       for _ in range(20)]
+
+        assert results == [42] * 20
+
+
+class TestDecodedValueCache(object):
+
+    def test_get_checks_date(self):
+        cache = DecodedValueCache(max_entries=10, max_bytes=1000)
+        cache.put((u'org1', u'report'), 1, {u'a': 1}, 10)
+
+        assert cache.get((u'org1', u'report'), 1) == {u'a': 1}
+        assert cache.get((u'org1', u'report'), 2) is None
+        assert cache.stats()[u'hits'] == 1
+        assert cache.stats()[u'misses'] == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = DecodedValueCache(max_entries=2, max_bytes=1000)
+        cache.put((None, u'a'), 1, u'a', 10)
+        cache.put((None, u'b'), 1, u'b', 10)
+        cache.get((None, u'a'), 1)
+
+        cache.put((None, u'c'), 1, u'c', 10)
+
+        assert cache.get((None, u'b'), 1) is None
+        assert cache.get((None, u'a'), 1) == u'a'
+        assert cache.stats()[u'evictions'] == 1
+
+    def test_evicts_by_size(self):
+        cache = DecodedValueCache(max_entries=10, max_bytes=25)
+        cache.put((None, u'a'), 1, u'a', 10)
+        cache.put((None, u'b'), 1, u'b', 10)
+        cache.put((None, u'c'), 1, u'c', 10)
+        cache.put((None, u'd'), 1, u'd', 100)
+
+        assert cache.stats()[u'entries'] == 2
+        assert cache.stats()[u'bytes'] == 20
+        assert cache.get((None, u'd'), 1) is None
+
+    def test_decoded_size_is_memory_not_json_length(self):
+        value = {u'table': [{u'name': u'dataset-%s' % i, u'num': i}
+                            for i in range(1000)]}
+        text = json.dumps(value)
+
+        size = decoded_size(json.loads(text))
+
+        assert size > 2 * len(text)
+        # the table is estimated from a sample of its rows
+        assert abs(size - decoded_size(value, sample_rows=1000)) < size * 0.1
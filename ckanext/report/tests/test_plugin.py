@@ -1,7 +1,7 @@
 import pytest
 import six
-from ckan.plugins import toolkit as tk
-from ckan.tests import factories
+from ckan import model
+from ckan.tests import factories, helpers
 import ckanext.report.model as report_model
 
 
@@ -54,11 +54,13 @@ class TestReportPlugin(object):
 
     def test_tagless_report_csv(self, app):
         u"""Test tagless report generation"""
-        dataset1 = factories.Dataset()  # noqa F841
+        dataset1 = factories.Dataset()
         dataset2 = factories.Dataset()  # noqa F841
 
         res = app.get(u'/report/tagless-datasets?format=csv')
         _assert_status(res, 200)
+        _assert_in_body(u'"name","title","notes","user","created"', res)
+        _assert_in_body(dataset1['name'], res)
 
     def test_tagless_report_json(self, app):
         u"""Test tagless report generation"""
@@ -66,18 +68,122 @@ class TestReportPlugin(object):
         dataset2 = factories.Dataset()  # noqa F841
         res = app.get(u'/report/tagless-datasets?format=json')
         _assert_status(res, 200)
+        assert len(res.json['table']) == 2
 
+    @pytest.mark.ckan_config(u'ckanext-report.job_queue', u'sync')
     def test_tagless_report_refresh_ok(self, app):
         u"""Test tagless refresh report"""
         user = factories.Sysadmin()
         dataset = factories.Dataset()  # noqa F841
         env = {'REMOTE_USER': user['name'].encode('ascii')}
 
-        res = app.post('/report/tagless-datasets', extra_environ=env)
+        res = app.post('/report/tagless-datasets', extra_environ=env,
+                       follow_redirects=False)
+
+        # redirects to show the progress of the refresh job
+        _assert_status(res, 302)
+        assert 'refresh_job=report-refresh-' in res.headers.get('Location')
+
+    @pytest.mark.ckan_config(u'ckanext-report.job_queue', u'sync')
+    def test_tagless_report_refresh_done(self, app):
+        u"""Test the refresh progress redirects to the report when done"""
+        user = factories.Sysadmin()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        job_id = helpers.call_action(u'report_refresh',
+                                     id=u'tagless-datasets')['job_id']
+
+        res = app.get(u'/report/tagless-datasets?refresh_job=%s' % job_id,
+                      extra_environ=env, follow_redirects=False)
+
+        _assert_status(res, 302)
+        assert 'refresh_job' not in res.headers.get('Location')
+
+    def test_organization_autocomplete(self, app):
+        u"""Test organization autocomplete only returns matches"""
+        org1 = factories.Organization(title=u'Water board')
+        org2 = factories.Organization(title=u'Forestry')
+        factories.Dataset(owner_org=org1['id'])
+        factories.Dataset(owner_org=org2['id'])
 
-        # for CKAN >= 2.9, the response is not a redirect
-        if tk.check_ckan_version(min_version="2.9.0"):
-            _assert_status(res, 200)
-        else:
-            _assert_status(res, 302)
-            assert res.headers.get('Location') == 'http://localhost:5000/report/tagless-datasets'
+        res = app.get(u'/report/organization_autocomplete?q=wat')
+
+        _assert_status(res, 200)
+        assert res.json == [{u'name': org1['name'], u'title': u'Water board'}]
+
+    def test_tagless_report_download_artifacts(self, app):
+        u"""Test downloads are served from the artifacts made at generation"""
+        dataset = factories.Dataset()
+        app.get(u'/report/tagless-datasets')  # generates the report
+
+        res = app.get(u'/report/tagless-datasets?format=csv')
+        _assert_status(res, 200)
+        _assert_in_body(dataset['name'], res)
+        assert model.Session.query(report_model.DataCacheArtifact) \
+            .filter_by(format=u'csv').count() == 1
+
+        res = app.get(u'/report/tagless-datasets?format=json',
+                      headers={u'Accept-Encoding': u'gzip'})
+        _assert_status(res, 200)
+        assert res.headers.get(u'Content-Encoding') == u'gzip'
+
+        res = app.get(u'/report/tagless-datasets?format=json')
+        _assert_status(res, 200)
+        assert u'Content-Encoding' not in res.headers
+        assert len(res.json['table']) == 1
+
+    def test_tagless_report_generated_at_same_with_or_without_artifact(self, app):
+        u"""Test the JSON download gives the same date, however it is made"""
+        factories.Dataset()
+        app.get(u'/report/tagless-datasets')  # generates the report
+        from_artifact = app.get(u'/report/tagless-datasets?format=json').json
+        model.Session.query(report_model.DataCacheArtifact).delete()
+        model.Session.commit()
+
+        from_data = app.get(u'/report/tagless-datasets?format=json').json
+
+        assert from_data[u'generated_at'] == from_artifact[u'generated_at']
+
+    def test_tagless_report_not_modified(self, app):
+        u"""Test conditional requests for an unchanged report get a 304"""
+        factories.Dataset()
+        res = app.get(u'/report/tagless-datasets?format=json')
+        etag = res.headers[u'ETag']
+        assert res.headers.get(u'Last-Modified')
+
+        res = app.get(u'/report/tagless-datasets?format=json',
+                      headers={u'If-None-Match': etag})
+        _assert_status(res, 304)
+
+        res = app.get(u'/report/tagless-datasets?format=csv',
+                      headers={u'If-None-Match': etag})
+        _assert_status(res, 200)
+
+    def test_tagless_report_not_modified_after_unchanged_regeneration(self, app):
+        u"""Test the ETag is kept when the report is regenerated unchanged"""
+        from ckanext.report.report_registry import ReportRegistry
+        factories.Dataset()
+        res = app.get(u'/report/tagless-datasets?format=json')
+        etag = res.headers[u'ETag']
+
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+
+        res = app.get(u'/report/tagless-datasets?format=json',
+                      headers={u'If-None-Match': etag})
+        _assert_status(res, 304)
+
+    def test_tagless_report_date_shown_kept_after_unchanged_regeneration(self, app):
+        u"""Test the date shown is that of the validators, when the report is
+        regenerated unchanged"""
+        from ckanext.report.report_registry import ReportRegistry
+        factories.Dataset()
+        res = app.get(u'/report/tagless-datasets')
+        last_modified = res.headers[u'Last-Modified']
+        generated = [line for line in res.body.splitlines() if u'Generated' in line]
+
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+
+        res = app.get(u'/report/tagless-datasets')
+        assert res.headers[u'Last-Modified'] == last_modified
+        assert [line for line in res.body.splitlines() if u'Generated' in line] == generated
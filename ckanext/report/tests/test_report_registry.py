@@ -0,0 +1,406 @@
+import collections
+import datetime
+import time
+from collections import OrderedDict
+
+import pytest
+from ckan import model
+from ckan.tests import factories, helpers
+from ckanext.report import lib
+import ckanext.report.model as report_model
+from ckanext.report.model import DataCache, DataCacheRow
+from ckanext.report.report_registry import (GenerationFailed, ReportRegistry,
+                                            is_streamed, run_in_subprocess)
+
+
+@pytest.fixture
+def report_setup():
+    report_model.init_tables()
+
+
+def _make_stale(report, days):
+    model.Session.execute(
+        report_model.data_cache_table.update()
+        .where(report_model.data_cache_table.c.key.like(report.name + '%'))
+        .values(created=datetime.datetime.utcnow() - datetime.timedelta(days=days),
+                checked=datetime.datetime.utcnow() - datetime.timedelta(days=days)))
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestGetFreshReport(object):
+
+    def test_regenerates_stale_data(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+        _make_stale(report, days=3)
+
+        data, date = report.get_fresh_report()
+
+        assert datetime.datetime.utcnow() - date < datetime.timedelta(hours=1)
+
+    @pytest.mark.ckan_config(u'ckanext-report.stale_while_revalidate', u'true')
+    @pytest.mark.ckan_config(u'ckanext-report.job_queue', u'sync')
+    def test_stale_while_revalidate(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+        _make_stale(report, days=3)
+
+        data, date = report.get_fresh_report()
+
+        # the stale data is returned, and refreshed in the "background"
+        assert datetime.datetime.utcnow() - date > datetime.timedelta(days=2)
+        data, date = DataCache.get(None, report.generate_key({}))
+        assert datetime.datetime.utcnow() - date < datetime.timedelta(hours=1)
+
+    @pytest.mark.ckan_config(u'ckanext-report.stale_while_revalidate', u'true')
+    @pytest.mark.ckan_config(u'ckanext-report.stale_max_age', u'345600')
+    @pytest.mark.ckan_config(u'ckanext-report.job_queue', u'sync')
+    def test_stale_while_revalidate_hard_expiry(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+        _make_stale(report, days=5)
+
+        data, date = report.get_fresh_report()
+
+        assert datetime.datetime.utcnow() - date < datetime.timedelta(hours=1)
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestRefreshCache(object):
+
+    def test_unchanged_data_is_not_rewritten(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        options = report.add_option_defaults({})
+        key = report.generate_key(options)
+        stats = collections.Counter()
+        report.refresh_cache(options, stats=stats)
+        created = DataCache.get_metadata([(None, key)])[0].created
+
+        data, date = report.refresh_cache(options, stats=stats)
+
+        metadata = DataCache.get_metadata([(None, key)])[0]
+        assert metadata.created == created
+        assert metadata.checked == date > created
+        assert stats == {u'changed': 1, u'unchanged': 1}
+
+    def test_changed_data_is_rewritten(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        options = report.add_option_defaults({})
+        stats = collections.Counter()
+        report.refresh_cache(options, stats=stats)
+        factories.Dataset()
+
+        data, date = report.refresh_cache(options, stats=stats)
+
+        assert DataCache.get_metadata([(None, report.generate_key(options))])[0].created == date
+        assert stats == {u'changed': 2}
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestRefreshCacheOnce(object):
+
+    def test_generates(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+
+        data, date = report.refresh_cache_once(report.add_option_defaults({}))
+
+        assert data[u'num_packages'] == 0
+        assert DataCache.get_date(None, report.generate_key({})) == date
+
+    @pytest.mark.ckan_config(u'ckanext-report.generation_lock_timeout', u'0')
+    def test_returns_cached_data_while_locked(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        options = report.add_option_defaults({})
+        data, date = report.refresh_cache(options)
+
+        with report_model.generation_lock(report.generate_key(options), 0) as acquired:
+            assert acquired
+            locked_data, locked_date = report.refresh_cache_once(options)
+
+        assert locked_date == date
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestDueOptionCombinations(object):
+
+    def test_uncached_are_due(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+
+        due = report.get_due_option_combinations()
+
+        assert len(due) == len(report.get_option_combinations())
+
+    def test_old_are_due(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        for option_dict in report.get_option_combinations():
+            report.refresh_cache(option_dict)
+        assert report.get_due_option_combinations() == []
+
+        _make_stale(report, days=3)
+
+        due = report.get_due_option_combinations()
+        assert len(due) == len(report.get_option_combinations())
+
+    def test_dirty_are_due(self):
+        org = factories.Organization()
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        for option_dict in report.get_option_combinations():
+            report.refresh_cache(option_dict)
+
+        factories.Dataset(owner_org=org['id'])
+
+        due = report.get_due_option_combinations()
+        assert sorted((o['organization'] or '', o['include_sub_organizations'])
+                      for o in due) == \
+            [('', False), ('', True),
+             (org['name'], False), (org['name'], True)]
+
+    @pytest.mark.parametrize(u'action', [u'package_patch', u'package_owner_org_update'])
+    def test_moved_dataset_marks_both_organizations_dirty(self, action):
+        org1 = factories.Organization()
+        org2 = factories.Organization()
+        dataset = factories.Dataset(owner_org=org1['id'])
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        for option_dict in report.get_option_combinations():
+            report.refresh_cache(option_dict)
+
+        if action == u'package_patch':
+            helpers.call_action(action, id=dataset['id'], owner_org=org2['id'])
+        else:
+            helpers.call_action(action, id=dataset['id'], organization_id=org2['id'])
+
+        due = report.get_due_option_combinations()
+        assert sorted(set(o['organization'] or '' for o in due)) == \
+            sorted(['', org1['name'], org2['name']])
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestGetFreshReportPage(object):
+
+    def test_page_from_cached_rows(self):
+        datasets = [factories.Dataset() for _ in range(3)]
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        data, date = report.refresh_cache(report.add_option_defaults({}))
+
+        page, page_date = report.get_fresh_report_page(1, 1)
+
+        assert page_date == date
+        assert page[u'total_rows'] == 3
+        assert page[u'num_packages'] == data[u'num_packages']
+        assert page[u'table'] == data[u'table'][1:2]
+        assert list(page[u'table'][0].keys()) == list(data[u'table'][0].keys())
+        assert page[u'table'][0][u'name'] in [d[u'name'] for d in datasets]
+
+    def test_page_without_page_size(self, monkeypatch):
+        factories.Dataset()
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'page_size', None)
+
+        page, date = report.get_fresh_report_page(0, 10)
+
+        assert page[u'total_rows'] == 1
+        assert len(page[u'table']) == 1
+
+    def test_filter_search_and_sort(self):
+        user = factories.User()
+        factories.Dataset(title=u'Apples', user=user)
+        factories.Dataset(title=u'Pears', user=user)
+        factories.Dataset(title=u'Pineapples')
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+
+        page, date = report.get_fresh_report_page(
+            0, 10, filters={u'user': user['id']}, search=u'PLE',
+            sort=u'title desc')
+        assert [row[u'title'] for row in page[u'table']] == [u'Apples']
+        assert page[u'total_rows'] == 1
+
+        page, date = report.get_fresh_report_page(0, 2, sort=u'title desc')
+        assert [row[u'title'] for row in page[u'table']] == [u'Pineapples', u'Pears']
+        assert page[u'total_rows'] == 3
+
+    def test_unknown_column(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        report.refresh_cache(report.add_option_defaults({}))
+
+        with pytest.raises(ValueError):
+            report.get_fresh_report_page(0, 10, sort=u'not_a_column')
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestBatchedRefresh(object):
+
+    def test_writes_all_combinations(self):
+        factories.Organization()
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        combinations = report.get_option_combinations()
+        stats = collections.Counter()
+
+        failures = report.refresh_cache_for_all_options(batch_size=3, stats=stats)
+
+        assert failures == []
+        assert stats == {u'changed': len(combinations)}
+        assert report.get_due_option_combinations() == []
+
+    def test_failed_combination_does_not_lose_batch(self, monkeypatch):
+        org = factories.Organization()
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        generate = report.generate
+
+        def failing_generate(organization=None, **kwargs):
+            if organization == org['name']:
+                model.Session.execute(u'SELECT * FROM no_such_table')
+            return generate(organization=organization, **kwargs)
+        monkeypatch.setattr(report, u'generate', failing_generate)
+
+        failures = report.refresh_cache_for_all_options(batch_size=100)
+
+        assert sorted((o[u'organization'] or u'', o[u'include_sub_organizations'])
+                      for name, o, error in failures) == \
+            [(org['name'], False), (org['name'], True)]
+        assert len(report.get_due_option_combinations()) == 2
+
+    def test_unchanged_rows_in_batch_are_not_rewritten(self, monkeypatch):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'page_size', 10)
+        report.refresh_cache_for_all_options(batch_size=100)
+        unchanged_key = report.generate_key(report.add_option_defaults({}))
+        row_ids = sorted(row.id for row in model.Session.query(DataCacheRow)
+                         .filter_by(key=unchanged_key))
+        generate = report.generate
+
+        def generate_changed_for_org(organization=None, **kwargs):
+            data = generate(organization=organization, **kwargs)
+            if organization == org['name']:
+                data['table'][0]['notes'] = u'Changed'
+            return data
+        monkeypatch.setattr(report, u'generate', generate_changed_for_org)
+        stats = collections.Counter()
+
+        report.refresh_cache_for_all_options(batch_size=100, stats=stats)
+
+        assert stats[u'changed'] == 2
+        assert row_ids
+        assert sorted(row.id for row in model.Session.query(DataCacheRow)
+                      .filter_by(key=unchanged_key)) == row_ids
+
+    def test_atomic(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        stats = collections.Counter()
+
+        report.refresh_cache_for_all_options(atomic=True, stats=stats)
+
+        assert stats[u'changed'] == len(report.get_option_combinations())
+        assert report.get_due_option_combinations() == []
+
+
+def _streamed_generate(num_rows):
+    def generate(**option_dict):
+        yield lib.ReportFields(num_packages=num_rows)
+        for i in range(num_rows):
+            yield OrderedDict(((u'name', u'dataset-%s' % i),
+                               (u'title', u'Dataset %s' % i)))
+        yield lib.ReportFields(packages_without_tags_percent=100)
+    return generate
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestStreamedGenerate(object):
+
+    def test_rows_are_cached(self, monkeypatch):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'generate', _streamed_generate(3))
+        report.refresh_cache(report.add_option_defaults({}))
+
+        data, date = report.get_fresh_report()
+        page, page_date = report.get_fresh_report_page(1, 1)
+
+        assert data[u'num_packages'] == 3
+        assert data[u'packages_without_tags_percent'] == 100
+        assert [row[u'name'] for row in data[u'table']] == \
+            [u'dataset-0', u'dataset-1', u'dataset-2']
+        assert list(data[u'table'][0].keys()) == [u'name', u'title']
+        assert page[u'total_rows'] == 3
+        assert page[u'table'] == data[u'table'][1:2]
+
+    def test_unchanged_rows_are_not_rewritten(self, monkeypatch):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'generate', _streamed_generate(3))
+        options = report.add_option_defaults({})
+        stats = collections.Counter()
+        report.refresh_cache(options, stats=stats)
+        created = DataCache.get_metadata([(None, report.generate_key(options))])[0].created
+
+        report.refresh_cache(options, stats=stats)
+
+        assert DataCache.get_metadata([(None, report.generate_key(options))])[0].created == created
+        assert stats == {u'changed': 1, u'unchanged': 1}
+        data, date = report.get_fresh_report()
+        assert len(data[u'table']) == 3
+
+    def test_rows_are_queried_from_the_cache(self, monkeypatch):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        monkeypatch.setattr(report, u'generate', _streamed_generate(3))
+        report.refresh_cache(report.add_option_defaults({}))
+
+        page, date = report.get_fresh_report_page(
+            filters={u'name': u'dataset-2'})
+
+        assert page[u'total_rows'] == 1
+        assert page[u'table'] == [{u'name': u'dataset-2', u'title': u'Dataset 2'}]
+
+    def test_only_iterators_are_streamed(self):
+        assert is_streamed(_streamed_generate(1)())
+        assert not is_streamed({u'table': []})
+        assert not is_streamed([{u'name': u'dataset-0'}])
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestGenerationLimits(object):
+
+    def test_timed_out_combination_keeps_cached_data(self, monkeypatch):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        options = report.add_option_defaults({})
+        report.refresh_cache(options)
+        created = DataCache.get_metadata([(None, report.generate_key(options))])[0].created
+
+        def slow_generate(**option_dict):
+            time.sleep(30)
+        monkeypatch.setattr(report, u'generate', slow_generate)
+        monkeypatch.setattr(report, u'timeout', datetime.timedelta(seconds=1))
+        failures = ReportRegistry.instance().refresh_cache_for_combinations(
+            [(report.name, options)])
+
+        assert len(failures) == 1
+        assert u'Timed out' in failures[0][2]
+        assert DataCache.get_metadata([(None, report.generate_key(options))])[0].created == created
+
+    @pytest.mark.ckan_config(u'ckanext-report.generate_timeout', u'60')
+    def test_generates_in_subprocess(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        options = report.add_option_defaults({})
+        stats = collections.Counter()
+
+        failures = ReportRegistry.instance().refresh_cache_for_combinations(
+            [(report.name, options)], stats=stats)
+
+        assert failures == []
+        assert stats[u'changed'] + stats[u'unchanged'] == 1
+        assert report.get_fresh_cached_date(options) is not None
+
+    def test_run_in_subprocess(self):
+        assert run_in_subprocess(lambda: 42) == 42
+        with pytest.raises(GenerationFailed) as exc_info:
+            run_in_subprocess(lambda: 1 / 0)
+        assert u'ZeroDivisionError' in str(exc_info.value)
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+from ckan import model
+from ckan.tests import factories
+import ckanext.report.model as report_model
+from ckanext.report import utils
+from ckanext.report.model import GenerationRun
+from ckanext.report.report_registry import ReportRegistry
+
+
+@pytest.fixture
+def report_setup():
+    report_model.init_tables()
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestGenerate(object):
+
+    def test_records_run(self):
+        timings = utils.generate([u'tagless-datasets'])
+
+        timing = timings[u'tagless-datasets']
+        assert timing[u'changed'] + timing[u'unchanged'] == 2
+        assert timing[u'failed'] == timing[u'skipped'] == 0
+        # it finished, so there is nothing to resume
+        assert GenerationRun.get_interrupted([u'tagless-datasets']) is None
+
+    def test_resume_skips_completed(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        combinations = report.get_option_combinations()
+        run = GenerationRun.start([u'tagless-datasets'], [
+            (report.name,
+             report.generate_key(option_dict, defaults_for_missing_keys=False),
+             option_dict)
+            for option_dict in combinations])
+        # interrupted after the first combination
+        report.refresh_cache(combinations[0])
+        run.set_state(report.generate_key(combinations[0]), u'done')
+        model.Session.commit()
+
+        timings = utils.generate([u'tagless-datasets'], resume=True)
+
+        timing = timings[u'tagless-datasets']
+        assert timing[u'skipped'] == 1
+        assert timing[u'changed'] + timing[u'unchanged'] == len(combinations) - 1
+        assert report.get_due_option_combinations() == []
+
+    def test_workers_skip_failed_combination(self, monkeypatch):
+        org = factories.Organization()
+        factories.Organization()
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        combinations = report.get_option_combinations()
+        failing = {u'organization': org[u'name'], u'include_sub_organizations': False}
+        generate = report.generate
+
+        def generate_in_worker(**option_dict):
+            if option_dict == failing:
+                raise ValueError(u'Bad combination')
+            data = generate(**option_dict)
+            data[u'pid'] = os.getpid()
+            return data
+        monkeypatch.setattr(report, u'generate', generate_in_worker)
+
+        timings = utils.generate([u'tagless-datasets'], workers=2)
+
+        timing = timings[u'tagless-datasets']
+        assert timing[u'failed'] == 1
+        assert timing[u'changed'] + timing[u'unchanged'] == len(combinations) - 1
+        assert report.get_cached_date(**failing) is None
+        for option_dict in combinations:
+            if option_dict != failing:
+                data, date = report.get_fresh_report(**option_dict)
+                # generated by a worker, not this process
+                assert data[u'pid'] != os.getpid()
+        run = model.Session.query(GenerationRun) \
+            .order_by(GenerationRun.started.desc()).first()
+        assert [(name, dict(option_dict)) for name, option_dict, error
+                in run.get_failures()] == [(u'tagless-datasets', failing)]
+
+
+@pytest.mark.ckan_config(u'ckan.plugins', u'report tagless_report')
+@pytest.mark.usefixtures(u'clean_db', u'with_plugins', u'report_setup')
+class TestWorker(object):
+
+    def test_generates_queued_combinations(self):
+        report = ReportRegistry.instance().get_report(u'tagless-datasets')
+        num_combinations = len(report.get_option_combinations())
+
+        assert utils.enqueue([u'tagless-datasets']) == num_combinations
+        # already queued
+        assert utils.enqueue([u'tagless-datasets']) == 0
+        stats = utils.worker(once=True)
+
+        assert stats[u'changed'] + stats[u'unchanged'] == num_combinations
+        assert report.get_due_option_combinations() == []
+        assert GenerationRun.get_queued_keys() == set()
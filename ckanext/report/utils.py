@@ -3,26 +3,175 @@ def initdb():
     report_model.init_tables()
 
 
-def generate(report_list):
+def generate(report_list, workers=1, batch_size=1, batch_megabytes=None,
+             atomic=False, resume=False):
+    '''Generates the reports, returning for each the seconds it took and the
+    number of option combinations whose data was changed and unchanged, and
+    that failed (see Report.refresh_cache_for_all_options for the other
+    arguments).
+
+    The run is recorded in the database (see GenerationRun). With resume, if
+    the last run of the same reports was interrupted, the combinations that it
+    had completed are skipped (counted as "skipped"), and the rest are
+    generated. The failures of the run are printed at the end, with their
+    tracebacks.'''
+    import collections
     import time
+    from ckanext.report import model as report_model
+    from ckanext.report.lib import organization_hierarchy_for_run
     from ckanext.report.report_registry import ReportRegistry
     timings = {}
 
     registry = ReportRegistry.instance()
-    if report_list:
-        print(report_list)
-        for report_name in report_list:
-            s = time.time()
-            registry.get_report(report_name).refresh_cache_for_all_options()
-            timings[report_name] = time.time() - s
+    report_names = report_list or \
+        [report.name for report in registry.get_reports()]
+    combinations = [
+        (report.name, option_dict)
+        for report in map(registry.get_report, report_names)
+        for option_dict in report.get_option_combinations()]
+    keys = [registry.get_report(report_name).generate_key(
+                option_dict, defaults_for_missing_keys=False)
+            for report_name, option_dict in combinations]
+    run = report_model.GenerationRun.get_interrupted(report_names) \
+        if resume else None
+    if run:
+        print('Resuming the run started at %s: %s'
+              % (run.started, run.count_states()))
+        # The options recorded in the run may not be as the report gave them
+        # (see GenerationRun.start), so go by the keys left to generate
+        keys_left = run.get_keys()
+        combinations = [combination
+                        for combination, key in zip(combinations, keys)
+                        if key in keys_left]
     else:
-        s = time.time()
-        registry.refresh_cache_for_all_reports()
-        timings["All Reports"] = time.time() - s
+        run = report_model.GenerationRun.start(report_names, [
+            (report_name, key, option_dict)
+            for (report_name, option_dict), key in zip(combinations, keys)])
+
+    def get_combinations(report_name=None):
+        return [combination for combination in combinations
+                if report_name in (None, combination[0])]
+
+    # load the organization hierarchy once for all the reports
+    with organization_hierarchy_for_run():
+        if report_list:
+            print(report_list)
+            for report_name in report_list:
+                s = time.time()
+                stats = collections.Counter()
+                stats['skipped'] = len(run.get_combinations(
+                    states=('done',), report_name=report_name))
+                registry.refresh_cache_for_combinations(
+                    get_combinations(report_name=report_name),
+                    workers=workers, stats=stats, batch_size=batch_size,
+                    batch_megabytes=batch_megabytes, atomic=atomic, run=run)
+                timings[report_name] = _timing(time.time() - s, stats)
+        else:
+            s = time.time()
+            stats = collections.Counter()
+            stats['skipped'] = run.count_states().get('done', 0)
+            registry.refresh_cache_for_combinations(
+                get_combinations(), workers=workers, stats=stats,
+                batch_size=batch_size, batch_megabytes=batch_megabytes,
+                atomic=atomic, run=run)
+            timings["All Reports"] = _timing(time.time() - s, stats)
+    run.finish()
 
+    for report_name, option_dict, error in run.get_failures():
+        print('Failed: %s %r\n%s' % (report_name, dict(option_dict), error))
     return timings
 
 
+def _timing(seconds, stats):
+    return {'seconds': round(seconds, 1),
+            'changed': stats['changed'],
+            'unchanged': stats['unchanged'],
+            'failed': stats['failed'],
+            'skipped': stats['skipped']}
+
+
+def scheduler(interval, once=False, workers=1, enqueue=False):
+    '''Regenerates the report option combinations that are due, according to
+    each report's schedule, checking every interval seconds. With enqueue,
+    they are queued for "report worker" processes to generate instead.'''
+    import collections
+    import time
+    from ckan import model
+    from ckanext.report.lib import organization_hierarchy_for_run
+    from ckanext.report.report_registry import ReportRegistry
+
+    registry = ReportRegistry.instance()
+    while True:
+        combinations = registry.get_due_combinations()
+        if combinations and enqueue:
+            num_queued = registry.enqueue_combinations(
+                combinations,
+                sorted(set(report_name for report_name, option_dict in combinations)))
+            print('Queued %s of the %s report option combinations that are due'
+                  % (num_queued, len(combinations)))
+        elif combinations:
+            print('Generating %s report option combinations that are due'
+                  % len(combinations))
+            s = time.time()
+            stats = collections.Counter()
+            with organization_hierarchy_for_run():
+                failures = registry.refresh_cache_for_combinations(
+                    combinations, workers=workers, stats=stats)
+            print('Generated in %.1fs - %s changed, %s unchanged, %s failures'
+                  % (time.time() - s, stats['changed'], stats['unchanged'],
+                     len(failures)))
+        model.Session.remove()
+        if once:
+            break
+        time.sleep(interval)
+
+
+def enqueue(report_list):
+    '''Queues all the option combinations of the reports (or all reports)
+    for "report worker" processes to generate. Returns the number queued.'''
+    from ckanext.report.report_registry import ReportRegistry
+    registry = ReportRegistry.instance()
+    report_names = report_list or \
+        [report.name for report in registry.get_reports()]
+    return registry.enqueue_combinations(
+        [(report_name, option_dict) for report_name in report_names
+         for option_dict in registry.get_report(report_name).get_option_combinations()],
+        report_names)
+
+
+def worker(once=False, poll_interval=10, claim=1):
+    '''Generates the report option combinations that are queued, claiming
+    claim of them at a time, so that any number of workers can share the
+    work, on any number of hosts. Checks the queue every poll_interval seconds
+    when it is empty, or with once, exits.'''
+    import collections
+    import os
+    import socket
+    import time
+    from ckan import model
+    from ckanext.report import model as report_model
+    from ckanext.report.report_registry import refresh_cache_for_queue
+
+    worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+    print('Report worker %s started' % worker_id)
+    stats = collections.Counter()
+    generated = False
+    while True:
+        if refresh_cache_for_queue(worker_id, claim=claim, stats=stats):
+            generated = True
+            continue
+        report_model.GenerationRun.finish_completed()
+        if generated:
+            print('Queue empty - %s changed, %s unchanged, %s failures so far'
+                  % (stats['changed'], stats['unchanged'], stats['failed']))
+            generated = False
+        model.Session.remove()
+        if once:
+            break
+        time.sleep(poll_interval)
+    return stats
+
+
 def list():
     from ckanext.report.report_registry import ReportRegistry
     registry = ReportRegistry.instance()